@@ -4,19 +4,41 @@
 
 # standard libraries
 import gettext
+import logging
+import threading
 
 # third party libraries
-# None
+import numpy
 
 # local libraries
 from . import dm3_image_utils
+from . import dm_header_cache
 
 
 _ = gettext.gettext
 
+_header_cache = None
+_header_cache_lock = threading.Lock()
+
+
+def get_header_cache():
+    """Return the header cache shared by the DM readers, or None if it cannot be opened."""
+    global _header_cache
+    with _header_cache_lock:
+        if _header_cache is None:
+            try:
+                _header_cache = dm_header_cache.HeaderCache()
+            except Exception as e:
+                logging.warning("DM header cache not available: %s", e)
+                _header_cache = False
+        return _header_cache or None
+
 
 class DM3IODelegate(object):
 
+    # pixel payloads of at least this many bytes are memory-mapped rather than read into memory.
+    memmap_threshold = 64 * 1024 * 1024
+
     def __init__(self, api):
         self.__api = api
         self.io_handler_id = "dm-io-handler"
@@ -24,7 +46,13 @@ class DM3IODelegate(object):
         self.io_handler_extensions = ["dm3", "dm4"]
 
     def read_data_and_metadata(self, extension, file_path):
-        data, calibrations, intensity, title, metadata = dm3_image_utils.load_image(file_path)
+        # map the pixel data rather than reading it, so that files larger than memory can be opened. small payloads
+        # are copied into memory so that the returned data is writeable and the file is not kept open (which on
+        # Windows would prevent overwriting or deleting it).
+        # the tags come from the header cache unless the file is new or has changed.
+        data, calibrations, intensity, title, metadata = dm3_image_utils.load_image(file_path, memmap=True, cache=get_header_cache())
+        if data.nbytes < self.memmap_threshold:
+            data = numpy.array(data)
         dimensional_calibrations = list()
         for calibration in calibrations:
             offset, scale, units = calibration[0], calibration[1], calibration[2]
@@ -34,7 +62,7 @@ class DM3IODelegate(object):
         return self.__api.create_data_and_metadata_from_data(data, dimensional_calibrations=dimensional_calibrations, intensity_calibration=intensity_calibration, metadata=metadata)
 
     def can_write_data_and_metadata(self, data_and_metadata, extension):
-        return extension == "dm3"
+        return extension in ("dm3", "dm4")
 
     def write_data_and_metadata(self, data_and_metadata, file_path, extension):
         data = data_and_metadata.data
@@ -46,12 +74,25 @@ class DM3IODelegate(object):
         offset, scale, units = intensity_calibration.offset, intensity_calibration.scale, intensity_calibration.units
         intensity_calibration = self.__api.create_calibration(offset, scale, units)
         metadata = data_and_metadata.metadata
+        version = 4 if extension == "dm4" else 3
         with open(file_path, 'wb') as f:
-            dm3_image_utils.save_image(data, dimensional_calibrations, intensity_calibration, metadata, f)
+            dm3_image_utils.save_image(data, dimensional_calibrations, intensity_calibration, metadata, f, version)
+
+
+def load_image(file_path, memmap=False, img_index=-1):
+    return dm3_image_utils.load_image(file_path, memmap, img_index)
+
+
+def load_image_region(file_path, region, img_index=-1):
+    return dm3_image_utils.load_image_region(file_path, region, img_index)
+
+
+def read_tags(file_path, patterns):
+    return dm3_image_utils.read_tags(file_path, patterns)
 
 
-def load_image(file_path):
-    return dm3_image_utils.load_image(file_path)
+def list_images(file_path):
+    return dm3_image_utils.list_images(file_path)
 
 
 class DM3IOExtension(object):
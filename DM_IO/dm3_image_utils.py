@@ -11,6 +11,7 @@
 # from the tag file datatype. I think these are used more than the tag
 # datratypes in describing the data.
 # from .parse_dm3 import *
+import collections
 import logging
 import numpy
 
@@ -64,13 +65,14 @@ def imagedatadict_to_ndarray(imdict):
     """
     arr = imdict['Data']
     im = None
-    if isinstance(arr, parse_dm3.array.array):
+    if isinstance(arr, numpy.ndarray):
+        im = arr
+    elif isinstance(arr, parse_dm3.array.array):
         im = numpy.asarray(arr, dtype=arr.typecode)
     elif isinstance(arr, parse_dm3.structarray):
+        # view the struct elements as complex numbers, without copying
         t = tuple(arr.typecodes)
-        im = numpy.frombuffer(
-            arr.raw_data,
-            dtype=structarray_to_np_map[t])
+        im = arr.data.view(numpy.dtype(structarray_to_np_map[t]).newbyteorder(arr.byte_order))
     # print "Image has dmimagetype", imdict["DataType"], "numpy type is", im.dtype
     assert dm_image_dtypes[imdict["DataType"]][1] == im.dtype
     assert imdict['PixelDepth'] == im.dtype.itemsize
@@ -81,11 +83,54 @@ def imagedatadict_to_ndarray(imdict):
     return im
 
 
+def dmtagdata_dtype(tag):
+    """
+    Return the numpy dtype (with the byte order of the file) of the elements
+    of the array payload described by the parse_dm3.DMTagData tag.
+    """
+    typecodes = tuple(tag.typecodes)
+    if tag.element_type == parse_dm3.get_dmtype_for_name('struct'):
+        dtype = numpy.dtype(structarray_to_np_map[typecodes])
+    else:
+        dtype = numpy.dtype(typecodes[0])
+    return dtype.newbyteorder(tag.byte_order)
+
+
+def payload_view(f, offset, count, dtype):
+    """
+    Return a read-only numpy view of count elements of dtype at offset in
+    the file-like object f, without reading or copying them.
+    Files are memory mapped, in-memory streams are viewed directly.
+    """
+    if count == 0:
+        return numpy.empty((0, ), dtype)
+    if hasattr(f, "getbuffer"):
+        im = numpy.frombuffer(f.getbuffer(), dtype, count, offset)
+        im.flags.writeable = False
+        return im
+    return numpy.memmap(f, dtype=dtype, mode='r', offset=offset, shape=(count, ))
+
+
+def dmtagdata_to_ndarray_view(tag):
+    """
+    Return a read-only numpy view of the array payload described by the
+    parse_dm3.DMTagData tag, without reading or copying the payload.
+    """
+    return payload_view(tag.f, tag.offset, tag.count, dmtagdata_dtype(tag))
+
+
+# where the pixel data of an image is in the file, see read_image_headers.
+# dtype is the numpy dtype string, including the byte order of the file.
+PayloadLocation = collections.namedtuple("PayloadLocation", ["offset", "count", "dtype"])
+
+
 def ndarray_to_imagedatadict(nparr):
     """
     Convert the numpy array nparr into a suitable ImageList entry dictionary.
     Returns a dictionary with the appropriate Data, DataType, PixelDepth
     to be inserted into a dm3 tag dictionary and written to a file.
+    Data refers to nparr itself (or a view of it) where possible, it gets
+    streamed from there when the file is written.
     """
     ret = {}
     dm_type = None
@@ -105,17 +150,15 @@ def ndarray_to_imagedatadict(nparr):
             rgba_image[:,:,3] = 255
             rgb_view = rgba_image.view(numpy.int32).reshape(rgba_image.shape[:-1])  # squash the color into uint32
         ret["Dimensions"] = list(rgb_view.shape[::-1])
-        ret["Data"] = parse_dm3.array.array(rgb_view.dtype.char, rgb_view.flatten())
+        ret["Data"] = rgb_view
     else:
+        if dm_type is None:
+            raise Exception("Unsupported dtype: {}".format(nparr.dtype))
         ret["DataType"] = dm_type
         ret["PixelDepth"] = nparr.dtype.itemsize
         ret["Dimensions"] = list(nparr.shape[::-1])
-        if nparr.dtype.type in np_to_structarray_map:
-            types = np_to_structarray_map[nparr.dtype.type]
-            ret["Data"] = parse_dm3.structarray(types)
-            ret["Data"].raw_data = bytes(nparr.data)
-        else:
-            ret["Data"] = parse_dm3.array.array(nparr.dtype.char, nparr.flatten())
+        # complex data is written as an array of structs by parse_dm3
+        ret["Data"] = nparr
     return ret
 
 
@@ -147,6 +190,12 @@ def display_keys(tag, indent=None):
 
 
 def fix_strings(d):
+    """
+    Converts the arrays in the tag tree d returned by parse_dm_header to
+    strings ('H' arrays) or lists, except those under 'Data' tags.
+    Trees decoded from an index can do this in the same pass, see
+    parse_dm3.DMTagGroup.to_python(decode_arrays=True).
+    """
     if isinstance(d, dict):
         r = dict()
         for k, v in d.items():
@@ -162,40 +211,272 @@ def fix_strings(d):
         return l
     elif isinstance(d, parse_dm3.array.array):
         if d.typecode == 'H':
-            return d.tostring().decode("utf-16")
+            return d.tobytes().decode("utf-16")
         else:
             return d.tolist()
     else:
         return d
 
-def load_image(file):
+def image_calibrations(calibration_tags, moved_axis):
     """
-    Loads the image from the file-like object or string file.
-    If file is a string, the file is opened and then read.
-    Returns a numpy ndarray of our best guess for the most important image
-    in the file.
+    Return the dimensional calibrations (in the axis order of the data
+    load_image returns) and the intensity calibration from the Calibrations
+    tags of an image. moved_axis tells whether the first DM axis gets moved
+    to the end, as load_image does for 3d data.
     """
-    if isinstance(file, str) or isinstance(file, unicode_type):
-        with open(file, "rb") as f:
-            return load_image(f)
-    dmtag = parse_dm3.parse_dm_header(file)
-    dmtag = fix_strings(dmtag)
-    #display_keys(dmtag)
-    img_index = -1
-    image_tags = dmtag['ImageList'][img_index]
-    data = imagedatadict_to_ndarray(image_tags['ImageData'])
     calibrations = []
-    calibration_tags = image_tags['ImageData'].get('Calibrations', dict())
     for dimension in calibration_tags.get('Dimension', list()):
         origin, scale, units = dimension.get('Origin', 0.0), dimension.get('Scale', 1.0), dimension.get('Units', str())
         calibrations.append((-origin * scale, scale, units))
     calibrations = tuple(reversed(calibrations))
-    if len(data.shape) == 3 and data.dtype != numpy.uint8:
-        data = numpy.moveaxis(data, 0, 2)
+    if moved_axis and calibrations:
         calibrations = tuple(calibrations[1:]) + (calibrations[0],)
     brightness = calibration_tags.get('Brightness', dict())
     origin, scale, units = brightness.get('Origin', 0.0), brightness.get('Scale', 1.0), brightness.get('Units', str())
     intensity = -origin * scale, scale, units
+    return calibrations, intensity
+
+
+ImageInfo = collections.namedtuple("ImageInfo", ["index", "title", "shape", "dtype", "calibrations", "intensity"])
+
+
+def image_info_from_index(image, img_index):
+    """
+    Return the ImageInfo for the image tag group image (a parse_dm3.DMTagGroup),
+    using only the small tags describing the image; neither the pixel data nor
+    the ImageTags are decoded.
+    """
+    image_data = image['ImageData']
+    calibration_tags = image_data.get('Calibrations')
+    image_tags = {"ImageData": {"DataType": image_data['DataType'], "Dimensions": image_data['Dimensions'].to_python()}}
+    if calibration_tags is not None:
+        image_tags["ImageData"]["Calibrations"] = calibration_tags.to_python(decode_arrays=True)
+    if 'Name' in image:
+        image_tags["Name"] = image['Name']
+    return image_info_from_tags(image_tags, img_index)
+
+
+def image_info_from_tags(image_tags, img_index):
+    """
+    Return the ImageInfo for the decoded tags image_tags of an ImageList entry.
+    """
+    image_data = image_tags['ImageData']
+    data_type = image_data['DataType']
+    shape = tuple(image_data['Dimensions'][::-1])
+    dtype = numpy.dtype(dm_image_dtypes[data_type][1])
+    if data_type == 23:  # RGB
+        shape, dtype = shape + (3, ), numpy.dtype(numpy.uint8)
+    moved_axis = len(shape) == 3 and dtype != numpy.uint8
+    if moved_axis:
+        shape = shape[1:] + shape[:1]
+    calibrations, intensity = image_calibrations(image_data.get('Calibrations', dict()), moved_axis)
+    return ImageInfo(img_index, image_tags.get('Name'), shape, dtype, calibrations, intensity)
+
+
+def list_images(file, cache=None):
+    """
+    Lists the images in the file-like object or string file.
+    Returns an ImageInfo (index, title, shape, dtype, calibrations and
+    intensity calibration, as load_image would return them) for every entry
+    of the ImageList. Only the file index is read, no pixel data, so this is
+    cheap even for very large files. The first image is usually the
+    thumbnail DigitalMicrograph stores with the file.
+    If file is a string and cache (e.g. a dm_header_cache.HeaderCache) is
+    given, the headers are taken from the cache, see read_image_headers.
+    """
+    if isinstance(file, str) or isinstance(file, unicode_type):
+        if cache is not None:
+            headers = cache.read_image_headers(file)
+            return [image_info_from_tags(image_tags, img_index) for img_index, image_tags in enumerate(headers)]
+        with open(file, "rb") as f:
+            return list_images(f)
+    dmtag = parse_dm3.index_dm_header(file)
+    return [image_info_from_index(image, img_index) for img_index, image in enumerate(dmtag['ImageList'])]
+
+
+def read_tags(file, patterns):
+    """
+    Reads selected tags from the file-like object or string file.
+    patterns lists tag paths like "ImageList/1/ImageTags/ImageScanned/EHT",
+    which may contain wildcards (see parse_dm3.DMTagGroup.glob).
+    Returns a dict mapping the path of every matching tag to its value.
+    Only the file index and the matched tags are read.
+    """
+    if isinstance(file, str) or isinstance(file, unicode_type):
+        with open(file, "rb") as f:
+            return read_tags(f, patterns)
+    dmtag = parse_dm3.index_dm_header(file)
+    tags = dict()
+    for pattern in patterns:
+        tags.update(dmtag.glob(pattern))
+    return tags
+
+
+def read_image_headers(file):
+    """
+    Reads the tags of all images of the file-like object or string file,
+    except for the pixel data.
+    Returns a list with the decoded tags of every ImageList entry, in which
+    the ImageData 'Data' is the PayloadLocation of the pixel data in the
+    file. The result only consists of plain python objects, so it can be
+    stored (see dm_header_cache) and used with load_image_from_header later
+    to load the images without parsing the file again.
+    """
+    if isinstance(file, str) or isinstance(file, unicode_type):
+        with open(file, "rb") as f:
+            return read_image_headers(f)
+    headers = list()
+    for image in parse_dm3.index_dm_header(file)['ImageList']:
+        data_tag = image['ImageData'].tag('Data')
+        image_tags = image.to_python(skip=(data_tag, ), decode_arrays=True)
+        image_tags['ImageData']['Data'] = PayloadLocation(data_tag.offset, data_tag.count, dmtagdata_dtype(data_tag).str)
+        headers.append(image_tags)
+    return headers
+
+
+def load_image_from_header(file, image_tags, memmap=False, region=None):
+    """
+    Loads the image described by image_tags, an entry of what
+    read_image_headers returned for the file-like object file.
+    memmap and region are as for load_image and load_image_region.
+    Returns data, calibrations, intensity, title, properties like load_image.
+    """
+    location = image_tags['ImageData']['Data']
+    data = payload_view(file, location.offset, location.count, numpy.dtype(location.dtype))
+    if not memmap and region is None:
+        data = data.astype(data.dtype.newbyteorder('='))  # read into memory
+    image_tags = dict(image_tags)
+    image_tags['ImageData'] = dict(image_tags['ImageData'], Data=data)
+    return image_from_tags(image_tags, region)
+
+
+def load_image(file, memmap=False, img_index=-1, cache=None):
+    """
+    Loads the image from the file-like object or string file.
+    If file is a string, the file is opened and then read.
+    Returns a numpy ndarray of our best guess for the most important image
+    in the file, or of the image at img_index in the ImageList (see
+    list_images).
+    If memmap is True the pixel data is not read; instead a read-only
+    numpy.memmap of the payload in the file is returned, which also works
+    for images larger than the available memory.
+    If file is a string and cache (e.g. a dm_header_cache.HeaderCache) is
+    given, the tags are taken from the cache and the file is only parsed if
+    it is not in the cache or has changed since.
+    """
+    if isinstance(file, str) or isinstance(file, unicode_type):
+        if cache is not None:
+            image_tags = cache.read_image_headers(file)[img_index]
+            with open(file, "rb") as f:
+                return load_image_from_header(f, image_tags, memmap)
+        with open(file, "rb") as f:
+            return load_image(f, memmap, img_index)
+    # index the file and only decode the image we want, the other images
+    # (e.g. the thumbnail) and the rest of the tag tree are never read.
+    dmtag = parse_dm3.index_dm_header(file)
+    return load_image_from_index(dmtag['ImageList'][img_index], memmap)
+
+
+def load_images(file, img_indexes=None, memmap=False):
+    """
+    Loads several images from the file-like object or string file, indexing
+    the file only once. img_indexes lists the ImageList indexes to load and
+    defaults to all images. Returns a list of what load_image returns.
+    """
+    if isinstance(file, str) or isinstance(file, unicode_type):
+        with open(file, "rb") as f:
+            return load_images(f, img_indexes, memmap)
+    image_list = parse_dm3.index_dm_header(file)['ImageList']
+    if img_indexes is None:
+        img_indexes = range(len(image_list))
+    return [load_image_from_index(image_list[img_index], memmap) for img_index in img_indexes]
+
+
+def load_image_region(file, region, img_index=-1):
+    """
+    Loads part of the image from the file-like object or string file.
+    region is a numpy style index into the data load_image would return,
+    made of slices and integers (e.g. numpy.s_[10:20, :, 5] for a crop of
+    energy channel 5 of a y, x, energy spectrum image).
+    Only the parts of the file covering the region are read, through a
+    memory map of the payload, so regions of files much larger than the
+    available memory can be read. The returned data is an in-memory copy,
+    the calibrations are those of the region.
+    Returns data, calibrations, intensity, title, properties like load_image.
+    """
+    if isinstance(file, str) or isinstance(file, unicode_type):
+        with open(file, "rb") as f:
+            return load_image_region(f, region, img_index)
+    dmtag = parse_dm3.index_dm_header(file)
+    return load_image_from_index(dmtag['ImageList'][img_index], region=region)
+
+
+def normalize_region(region, ndim):
+    """
+    Return region (an index made of slices, integers and at most one
+    Ellipsis) as a tuple with an integer or a slice for each of ndim axes.
+    """
+    if not isinstance(region, tuple):
+        region = (region, )
+    if any(index is Ellipsis for index in region):
+        i = region.index(Ellipsis)
+        region = region[:i] + (slice(None), ) * (ndim - len(region) + 1) + region[i + 1:]
+    if len(region) > ndim:
+        raise IndexError("too many indices for image: image is {}-dimensional, but {} were indexed".format(ndim, len(region)))
+    for index in region:
+        if not isinstance(index, (slice, int, numpy.integer)):
+            raise IndexError("only integers, slices and ellipsis are valid region indices, not {}".format(type(index)))
+    return tuple(region) + (slice(None), ) * (ndim - len(region))
+
+
+def region_calibrations(calibrations, region, shape):
+    """
+    Return the dimensional calibrations of the region (see normalize_region)
+    of data with the given shape and calibrations. Axes indexed by an integer
+    are dropped, sliced axes get their offset and scale adjusted.
+    """
+    region_calibrations = list()
+    for (offset, scale, units), index, length in zip(calibrations, region, shape):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(length)
+            region_calibrations.append((offset + start * scale, scale * step, units))
+    return tuple(region_calibrations)
+
+
+def load_image_from_index(image, memmap=False, region=None):
+    """
+    Loads the image from the image tag group image (a parse_dm3.DMTagGroup).
+    Returns data, calibrations, intensity, title, properties like load_image.
+    If region is given only that part of the data is read, see
+    load_image_region.
+    """
+    # strings are decoded while decoding the tree, see parse_dm3.DMTagGroup.to_python
+    if memmap or region is not None:
+        data_tag = image['ImageData'].tag('Data')
+        image_tags = image.to_python(skip=(data_tag, ), decode_arrays=True)
+        image_tags['ImageData']['Data'] = dmtagdata_to_ndarray_view(data_tag)
+    else:
+        image_tags = image.to_python(decode_arrays=True)
+    return image_from_tags(image_tags, region)
+
+
+def image_from_tags(image_tags, region=None):
+    """
+    Returns data, calibrations, intensity, title, properties like load_image
+    for the decoded tags image_tags of an ImageList entry.
+    """
+    #display_keys(image_tags)
+    data = imagedatadict_to_ndarray(image_tags['ImageData'])
+    moved_axis = len(data.shape) == 3 and data.dtype != numpy.uint8
+    if moved_axis:
+        data = numpy.moveaxis(data, 0, 2)
+    calibrations, intensity = image_calibrations(image_tags['ImageData'].get('Calibrations', dict()), moved_axis)
+    if region is not None:
+        region = normalize_region(region, len(data.shape))
+        calibrations = region_calibrations(calibrations, region, data.shape)
+        # indexing the view only touches the pages of the region, copy them out
+        # so that the data does not refer to the file any more.
+        data = numpy.array(data[region])
     title = image_tags.get('Name')
     properties = dict()
     if 'ImageTags' in image_tags:
@@ -206,9 +487,21 @@ def load_image(file):
     return data, tuple(calibrations), intensity, title, properties
 
 
-def save_image(data, dimensional_calibrations, intensity_calibration, metadata, file):
+def save_image(data, dimensional_calibrations, intensity_calibration, metadata, file, version=3):
     """
     Saves the nparray data to the file-like object (or string) file.
+    The file is written in a single forward pass, so file does not need to be
+    seekable, and the data is streamed from the array without copying it.
+    version is the DM format version, 3 or 4. DM3 files are limited to 4 GB,
+    use DM4 for anything larger.
+    """
+    ret = image_file_tags(data, dimensional_calibrations, intensity_calibration, metadata)
+    parse_dm3.DMFile(file, version).parse_dm_header(ret)
+
+
+def image_file_tags(data, dimensional_calibrations, intensity_calibration, metadata):
+    """
+    Return the tag tree save_image writes for the nparray data.
     """
     # we need to create a basic DM tree suitable for an image
     # we'll try the minimum: just an data list
@@ -216,7 +509,8 @@ def save_image(data, dimensional_calibrations, intensity_calibration, metadata,
     # and a DocumentObjectList?
     if len(data.shape) == 3 and data.dtype != numpy.uint8:
         data = numpy.moveaxis(data, 2, 0)
-        dimensional_calibrations = (dimensional_calibrations[2],) + tuple(dimensional_calibrations[0:2])
+        if dimensional_calibrations and len(dimensional_calibrations) == 3:
+            dimensional_calibrations = (dimensional_calibrations[2],) + tuple(dimensional_calibrations[0:2])
     data_dict = ndarray_to_imagedatadict(data)
     ret = {}
     ret["ImageList"] = [{"ImageData": data_dict}]
@@ -251,7 +545,7 @@ def save_image(data, dimensional_calibrations, intensity_calibration, metadata,
     ret["Image Behavior"] = {"ViewDisplayID": 8}
     ret["ImageList"][0]["ImageTags"] = metadata
     ret["InImageMode"] = 1
-    parse_dm3.parse_dm_header(file, ret)
+    return ret
 
 
 # logging.debug(image_tags['ImageData']['Calibrations'])
@@ -0,0 +1,248 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for DM3/DM4 reading and writing.
+
+Tag parsing: writes DM3 files with synthetic tag trees of several sizes
+(similar to the ImageTags written by auto-acquisition software) and reports
+tags/second for
+ - the stream parser (parse_dm_header), which issues a read for every field
+ - the buffered index (index_dm_header), which unpacks the tag structure
+   from large blocks with precompiled structs
+ - the buffered index followed by decoding the whole tree (to_python)
+ - decoding strings and lists as load_image does, either with a second
+   pass over the stream parser's tree (fix_strings) or while decoding the
+   index (to_python(decode_arrays=True))
+ - reading a few tags by path from the index (glob), as metadata harvesting does
+
+Image I/O: writes synthetic DM3 and DM4 images of several sizes and dtypes
+(including complex data, stored as arrays of structs, and RGB) and reports
+MB/second for save_image, load_image, load_image with memmap=True (plus
+touching all pixels) and parse_dm_header.
+
+The results are compared against the baseline stored next to this module
+(dm3parserbenchmark_baseline.json, or --baseline file); benchmarks that got
+slower by more than the tolerance are flagged as regressions and make the
+run fail. The stored baseline holds the lowest rate of three runs with the
+default options on the reference machine; the rates depend on the machine,
+so store a new baseline (--save-baseline) when benchmarking on another one.
+
+Run from the extensions directory with
+    python -m DM_IO.dm3parserbenchmark [--tags 1000,10000,40000] [--sizes 256,1024] [--baseline file] [--save-baseline file]
+"""
+
+import argparse
+import array
+import collections
+import json
+import os
+import sys
+import tempfile
+import time
+
+import numpy
+
+from DM_IO import dm3_image_utils
+from DM_IO import parse_dm3
+
+
+BenchmarkResult = collections.namedtuple("BenchmarkResult", ["name", "elapsed", "rate", "unit"])
+
+image_dtypes = ("int16", "float32", "complex64", "complex128", "rgb")
+
+Calibration = collections.namedtuple("Calibration", ["offset", "scale", "units"])
+
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "dm3parserbenchmark_baseline.json")
+
+
+def make_tags(number_of_tags):
+    """Return a tag tree with roughly number_of_tags data tags of mixed types"""
+    groups = dict()
+    for i in range(number_of_tags // 4):
+        groups["Group {}".format(i // 50)] = group = groups.get("Group {}".format(i // 50), dict())
+        group["Long {}".format(i)] = i
+        group["Double {}".format(i)] = i * 0.5
+        group["Name {}".format(i)] = "value {}".format(i)
+        group["Struct {}".format(i)] = (i, i + 1, 0.25)
+    return {"ImageList": [{"ImageTags": groups, "ImageData": {"Data": array.array('f', [0.0] * 16), "Dimensions": [4, 4]}}]}
+
+
+def make_image(size, dtype):
+    """Return a synthetic size x size image of dtype (a numpy dtype name or 'rgb')"""
+    if dtype == "rgb":
+        return numpy.random.randint(0, 256, size=(size, size, 3)).astype(numpy.uint8)
+    data = numpy.random.randn(size, size)
+    if dtype.startswith("complex"):
+        data = data + 1j * numpy.random.randn(size, size)
+    elif dtype.startswith("int"):
+        data = data * 1000
+    return data.astype(dtype)
+
+
+def count_tags(tags):
+    if isinstance(tags, dict):
+        return sum(count_tags(v) for v in tags.values()) + len(tags)
+    elif isinstance(tags, list):
+        return sum(count_tags(v) for v in tags) + len(tags)
+    return 0
+
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run(tag_sizes=(1000, 10000, 40000), repeat=5):
+    """Run the tag parsing benchmarks for tag trees of the given sizes, return a list of BenchmarkResult"""
+    results = list()
+    with tempfile.TemporaryDirectory() as directory:
+        for number_of_tags in tag_sizes:
+            results.extend(run_tags(os.path.join(directory, "tags{}.dm3".format(number_of_tags)), number_of_tags, repeat))
+    return results
+
+
+def run_tags(file_path, number_of_tags, repeat):
+    """Run the tag parsing benchmarks on a tag tree of number_of_tags tags written to file_path"""
+    tags = make_tags(number_of_tags)
+    tag_count = count_tags(tags)
+    with open(file_path, "wb") as f:
+        parse_dm3.parse_dm_header(f, tags)
+
+    def stream():
+        with open(file_path, "rb") as f:
+            parse_dm3.parse_dm_header(f)
+
+    def index():
+        with open(file_path, "rb") as f:
+            parse_dm3.index_dm_header(f)
+
+    def index_and_decode():
+        with open(file_path, "rb") as f:
+            parse_dm3.index_dm_header(f).to_python()
+
+    def stream_and_fix_strings():
+        with open(file_path, "rb") as f:
+            dm3_image_utils.fix_strings(parse_dm3.parse_dm_header(f))
+
+    def index_and_decode_strings():
+        with open(file_path, "rb") as f:
+            parse_dm3.index_dm_header(f).to_python(decode_arrays=True)
+
+    def index_and_query():
+        with open(file_path, "rb") as f:
+            parse_dm3.index_dm_header(f).glob("ImageList/0/ImageTags/Group 1*/Name 1?")
+
+    benchmarks = (("stream (parse_dm_header)", stream), ("index (index_dm_header)", index),
+                  ("index + to_python", index_and_decode), ("stream + fix_strings", stream_and_fix_strings),
+                  ("index + decode strings", index_and_decode_strings), ("index + glob", index_and_query))
+    results = list()
+    for name, fn in benchmarks:
+        elapsed = best_time(fn, repeat)
+        results.append(BenchmarkResult("tags {}: {}".format(number_of_tags, name), elapsed, tag_count / elapsed, "tags/s"))
+    return results
+
+
+def run_images(sizes=(256, 1024), dtypes=image_dtypes, versions=(3, 4), repeat=3):
+    """Run the image read and write benchmarks, return a list of BenchmarkResult"""
+    results = list()
+    with tempfile.TemporaryDirectory() as directory:
+        for version in versions:
+            for size in sizes:
+                for dtype in dtypes:
+                    data = make_image(size, dtype)
+                    calibrations = [Calibration(0.0, 1.0, "nm")] * 2
+                    intensity = Calibration(0.0, 1.0, "counts")
+                    megabytes = data.nbytes / 1e6
+                    file_path = os.path.join(directory, "image.dm{}".format(version))
+
+                    def save():
+                        with open(file_path, "wb") as f:
+                            dm3_image_utils.save_image(data, calibrations, intensity, dict(), f, version)
+
+                    def load():
+                        dm3_image_utils.load_image(file_path)
+
+                    def load_memmap():
+                        numpy.sum(dm3_image_utils.load_image(file_path, memmap=True)[0])
+
+                    def stream():
+                        with open(file_path, "rb") as f:
+                            parse_dm3.parse_dm_header(f)
+
+                    benchmarks = (("save_image", save), ("load_image", load), ("load_image memmap + sum", load_memmap),
+                                  ("parse_dm_header", stream))
+                    for name, fn in benchmarks:
+                        elapsed = best_time(fn, repeat)
+                        results.append(BenchmarkResult("dm{} {}x{} {}: {}".format(version, size, size, dtype, name), elapsed, megabytes / elapsed, "MB/s"))
+    return results
+
+
+def save_baseline(results, file_path):
+    with open(file_path, "w") as f:
+        json.dump({result.name: {"rate": result.rate, "unit": result.unit} for result in results}, f, indent=1, sort_keys=True)
+
+
+def compare_to_baseline(results, file_path, tolerance=0.25):
+    """
+    Compare results to the baseline stored at file_path.
+    Returns a dict mapping the benchmark names to rate / baseline rate and a
+    list of the names of benchmarks that are slower than the baseline by
+    more than tolerance (a fraction).
+    """
+    with open(file_path, "r") as f:
+        baseline = json.load(f)
+    ratios, regressions = dict(), list()
+    for result in results:
+        if result.name in baseline:
+            ratio = result.rate / baseline[result.name]["rate"]
+            ratios[result.name] = ratio
+            if ratio < 1.0 - tolerance:
+                regressions.append(result.name)
+    return ratios, regressions
+
+
+def print_results(results, ratios=None, regressions=()):
+    ratios = ratios or dict()
+    for result in results:
+        line = "{:52s} {:8.3f} s {:12.1f} {}".format(result.name, result.elapsed, result.rate, result.unit)
+        if result.name in ratios:
+            line += "  {:6.2f}x baseline".format(ratios[result.name])
+        if result.name in regressions:
+            line += "  REGRESSION"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark DM3/DM4 reading and writing.")
+    parser.add_argument("--tags", default="1000,10000,40000", help="comma separated numbers of tags of the tag parsing benchmarks (empty to skip)")
+    parser.add_argument("--sizes", default="256,1024", help="comma separated image sizes of the image benchmarks (empty to skip)")
+    parser.add_argument("--repeat", type=int, default=5, help="number of runs, the best is reported")
+    parser.add_argument("--baseline", default=default_baseline_path, help="compare with the baseline stored in this file (empty to skip)")
+    parser.add_argument("--save-baseline", default=None, help="store the results as baseline in this file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="slowdown relative to the baseline flagged as regression")
+    args = parser.parse_args(argv)
+    results = list()
+    tag_sizes = [int(tag_size) for tag_size in args.tags.split(",") if tag_size]
+    if tag_sizes:
+        results.extend(run(tag_sizes, args.repeat))
+    sizes = [int(size) for size in args.sizes.split(",") if size]
+    if sizes:
+        results.extend(run_images(sizes, repeat=args.repeat))
+    ratios, regressions = None, list()
+    if args.baseline:
+        ratios, regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+    print_results(results, ratios, regressions)
+    if args.save_baseline:
+        save_baseline(results, args.save_baseline)
+    if regressions:
+        print("{} regressions (more than {:.0%} slower than the baseline)".format(len(regressions), args.tolerance))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Batch conversion of DM3/DM4 files to TIFF or NPY.
+
+Files are converted in parallel by a process pool. TIFF files are written
+by the TIFF_IO_ROI export (imagej compatible, with the Nion metadata), so
+they import into Swift like files exported from there. NPY files get a
+.json side car with the calibrations, title and tags.
+
+Every output is written to a temporary file first and renamed when it is
+complete, so an interrupted run can be resumed: files whose output exists
+and is newer than the source are skipped.
+
+Run from the extensions directory with
+    python -m DM_IO.dm_convert [-f tiff|npy] [-o output directory] [-j workers] [-r] files or directories
+"""
+
+import argparse
+import collections
+import concurrent.futures
+import datetime
+import json
+import os
+import sys
+import time
+
+import numpy
+
+from DM_IO import dm3_image_utils
+
+
+dm_extensions = (".dm3", ".dm4")
+
+output_extensions = {"tiff": ".tif", "npy": ".npy"}
+
+ConversionResult = collections.namedtuple("ConversionResult", ["source", "target", "nbytes", "elapsed", "skipped"])
+
+# the calibration interface the TIFF export expects
+Calibration = collections.namedtuple("Calibration", ["offset", "scale", "units"])
+
+
+class DataAndMetadata(object):
+    """
+    The parts of a Swift DataAndMetadata the TIFF export uses, for the data
+    and calibrations returned by dm3_image_utils.load_image.
+    """
+
+    def __init__(self, data, calibrations, intensity, metadata, timestamp):
+        self.data = data
+        self.data_shape = data.shape
+        self.is_data_rgb = data.dtype == numpy.uint8 and len(data.shape) == 3 and data.shape[-1] == 3
+        self.is_data_rgba = data.dtype == numpy.uint8 and len(data.shape) == 3 and data.shape[-1] == 4
+        dimension_count = len(data.shape) - int(self.is_data_rgb or self.is_data_rgba)
+        if len(calibrations) != dimension_count:
+            calibrations = [(0.0, 1.0, "")] * dimension_count
+        self.dimensional_calibrations = [Calibration(*calibration) for calibration in calibrations]
+        self.intensity_calibration = Calibration(*intensity)
+        self.metadata = metadata
+        self.timestamp = timestamp
+        self.is_sequence = False
+        # DM 3d images are loaded as y, x, signal: a 2d collection of spectra
+        datum_dimension_count = dimension_count
+        self.collection_dimension_count = 2 if datum_dimension_count == 3 else 0
+        self.datum_dimension_count = datum_dimension_count - self.collection_dimension_count
+
+
+def target_path(source, output_directory, base_directory, output_format):
+    """
+    Return the output path for source. The directory structure below
+    base_directory is repeated below output_directory, without an output
+    directory the output goes next to the source.
+    """
+    name = os.path.splitext(source)[0] + output_extensions[output_format]
+    if output_directory is None:
+        return name
+    return os.path.join(output_directory, os.path.relpath(name, base_directory))
+
+
+def is_converted(source, target):
+    """Return whether target exists and is at least as new as source."""
+    return os.path.exists(target) and os.path.getmtime(target) >= os.path.getmtime(source)
+
+
+def write_tiff(file_path, data, calibrations, intensity, metadata, timestamp):
+    import TIFF_IO_ROI
+    data_and_metadata = DataAndMetadata(data, calibrations, intensity, metadata, timestamp)
+    TIFF_IO_ROI.TIFFIODelegate(None).write_data_and_metadata(data_and_metadata, file_path, "tif")
+
+
+def write_npy(file_path, data, calibrations, intensity, title, metadata):
+    with open(file_path, "wb") as f:
+        numpy.save(f, data)
+    description = {"title": title,
+                   "spatial_calibrations": [Calibration(*calibration)._asdict() for calibration in calibrations],
+                   "intensity_calibration": Calibration(*intensity)._asdict(),
+                   "properties": metadata}
+    with open(file_path + ".json", "w") as f:
+        json.dump(description, f, default=str)
+
+
+def convert_file(source, target, output_format, overwrite=False):
+    """
+    Convert the DM file source to target in output_format ('tiff' or 'npy').
+    Returns a ConversionResult. target is only replaced once it is complete.
+    """
+    if not overwrite and is_converted(source, target):
+        return ConversionResult(source, target, 0, 0.0, True)
+    start = time.perf_counter()
+    target_directory = os.path.dirname(target)
+    if target_directory:
+        os.makedirs(target_directory, exist_ok=True)
+    # the pixel data is mapped, not read, so files larger than memory can be converted
+    data, calibrations, intensity, title, metadata = dm3_image_utils.load_image(source, memmap=True)
+    partial_target = target + ".part"
+    try:
+        if output_format == "tiff":
+            timestamp = datetime.datetime.fromtimestamp(os.path.getmtime(source))
+            write_tiff(partial_target, data, calibrations, intensity, metadata, timestamp)
+        else:
+            write_npy(partial_target, data, calibrations, intensity, title, metadata)
+            os.replace(partial_target + ".json", os.path.splitext(target)[0] + ".json")
+        nbytes = data.nbytes
+        os.replace(partial_target, target)
+    except BaseException:
+        # do not leave partial files behind if the conversion fails or is interrupted
+        for file_path in (partial_target, partial_target + ".json"):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        raise
+    finally:
+        del data
+    return ConversionResult(source, target, nbytes, time.perf_counter() - start, False)
+
+
+def find_dm_files(paths, recursive=False):
+    """
+    Yield (file path, base directory) for the DM files in paths, which lists
+    files and directories. Directories are searched recursively if recursive.
+    """
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, directory_names, file_names in os.walk(path):
+                for file_name in sorted(file_names):
+                    if os.path.splitext(file_name)[1].lower() in dm_extensions:
+                        yield os.path.join(directory, file_name), path
+                if not recursive:
+                    break
+                directory_names.sort()
+        else:
+            yield path, os.path.dirname(path)
+
+
+def convert_files(paths, output_format="tiff", output_directory=None, max_workers=None, recursive=False, overwrite=False, report=None):
+    """
+    Convert the DM files in paths (files or directories) in parallel using a
+    process pool with max_workers processes (default: one per cpu).
+    report is called with each ConversionResult, or with (source, exception)
+    if a file could not be converted.
+    Returns the list of ConversionResults and the list of failures.
+    """
+    results, failures = list(), list()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = dict()
+        for source, base_directory in find_dm_files(paths, recursive):
+            target = target_path(source, output_directory, base_directory, output_format)
+            futures[executor.submit(convert_file, source, target, output_format, overwrite)] = source
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+                results.append(result)
+            except Exception as e:
+                result = (futures[future], e)
+                failures.append(result)
+            if report:
+                report(result)
+    return results, failures
+
+
+def print_result(result):
+    if isinstance(result, ConversionResult):
+        if result.skipped:
+            print("skipped {} (already converted)".format(result.source))
+        else:
+            megabytes = result.nbytes / 1e6
+            print("{} -> {}  {:.1f} MB in {:.2f} s ({:.1f} MB/s)".format(result.source, result.target, megabytes, result.elapsed, megabytes / max(result.elapsed, 1e-9)))
+    else:
+        print("failed {}: {}".format(*result), file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert DM3/DM4 files to TIFF or NPY.")
+    parser.add_argument("paths", nargs="+", help="DM files or directories containing DM files")
+    parser.add_argument("-f", "--format", choices=sorted(output_extensions), default="tiff", help="output format")
+    parser.add_argument("-o", "--output", default=None, help="output directory (default: next to the source files)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of worker processes (default: number of cpus)")
+    parser.add_argument("-r", "--recursive", action="store_true", help="search directories recursively")
+    parser.add_argument("--overwrite", action="store_true", help="convert files even if they are already converted")
+    args = parser.parse_args(argv)
+    start = time.perf_counter()
+    results, failures = convert_files(args.paths, args.format, args.output, args.workers, args.recursive, args.overwrite, print_result)
+    elapsed = time.perf_counter() - start
+    converted = [result for result in results if not result.skipped]
+    megabytes = sum(result.nbytes for result in converted) / 1e6
+    print("{} converted, {} skipped, {} failed: {:.1f} MB in {:.1f} s ({:.1f} MB/s, {:.1f} files/s)".format(
+        len(converted), len(results) - len(converted), len(failures), megabytes, elapsed, megabytes / max(elapsed, 1e-9), len(converted) / max(elapsed, 1e-9)))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+# HeaderCache keeps the image headers of DM files (see
+# dm3_image_utils.read_image_headers) in an sqlite database on disk, so that
+# opening the same files again, e.g. when browsing a directory of thousands
+# of files, does not need to parse them again.
+#
+# Entries are keyed by the real path of the file and are only used while
+# the size and modification time of the file are unchanged. The cache is
+# bounded in number of entries and in bytes, the least recently used entries
+# are evicted first.
+
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+from . import dm3_image_utils
+
+
+def default_cache_path():
+    """
+    Return the path of the default cache database in the user's cache directory.
+    """
+    if os.name == "nt":
+        cache_directory = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    else:
+        cache_directory = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_directory, "nionswift-dm-io", "dm_headers.sqlite")
+
+
+class HeaderCache(object):
+    """
+    A persistent cache of DM image headers.
+    path is the sqlite database file (created if needed, ":memory:" for a
+    cache that is not persistent). At most max_entries files and
+    max_bytes of pickled headers are kept.
+    A HeaderCache can be shared between threads, several processes can use
+    the same database.
+    """
+    schema_version = 1
+
+    def __init__(self, path=None, max_entries=20000, max_bytes=256 * 1024 * 1024):
+        self.path = path if path is not None else default_cache_path()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.__lock = threading.Lock()
+        self.__connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        with self.__connection:
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, schema INTEGER, last_access REAL, nbytes INTEGER, headers BLOB)")
+            self.__connection.execute("CREATE INDEX IF NOT EXISTS headers_last_access ON headers (last_access)")
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+            self.__connection = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COUNT(*) FROM headers").fetchone()[0]
+
+    @property
+    def nbytes(self):
+        with self.__lock:
+            return self.__connection.execute("SELECT COALESCE(SUM(nbytes), 0) FROM headers").fetchone()[0]
+
+    def get(self, file_path):
+        """
+        Return the cached headers of the file at file_path, or None if the
+        file is not in the cache or has changed since it was cached.
+        """
+        key, st = self.__key(file_path)
+        with self.__lock:
+            row = self.__connection.execute("SELECT size, mtime_ns, schema, headers FROM headers WHERE path = ?", (key, )).fetchone()
+            if row is None:
+                return None
+            size, mtime_ns, schema, headers = row
+            if (size, mtime_ns, schema) != (st.st_size, st.st_mtime_ns, self.schema_version):
+                with self.__connection:
+                    self.__connection.execute("DELETE FROM headers WHERE path = ?", (key, ))
+                return None
+            with self.__connection:
+                self.__connection.execute("UPDATE headers SET last_access = ? WHERE path = ?", (time.time(), key))
+        try:
+            return pickle.loads(headers)
+        except Exception as e:
+            logging.debug("Unreadable DM header cache entry for %s: %s", key, e)
+            return None
+
+    def put(self, file_path, headers, st=None):
+        """
+        Store headers for the file at file_path. st is the os.stat result of
+        the file taken before the headers were read; if the file changes
+        while it is being read the entry is then invalidated on the next get.
+        """
+        key, current_st = self.__key(file_path)
+        st = st if st is not None else current_st
+        data = pickle.dumps(headers, pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute("INSERT OR REPLACE INTO headers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                          (key, st.st_size, st.st_mtime_ns, self.schema_version, time.time(), len(data), sqlite3.Binary(data)))
+                self.__evict()
+
+    def read_image_headers(self, file_path):
+        """
+        Return the headers of the file at file_path like
+        dm3_image_utils.read_image_headers, from the cache if possible.
+        """
+        headers = self.get(file_path)
+        if headers is None:
+            st = os.stat(file_path)
+            headers = dm3_image_utils.read_image_headers(file_path)
+            self.put(file_path, headers, st)
+        return headers
+
+    def clear(self):
+        with self.__lock:
+            with self.__connection:
+                self.__connection.execute("DELETE FROM headers")
+
+    def __key(self, file_path):
+        return os.path.realpath(file_path), os.stat(file_path)
+
+    def __evict(self):
+        # drop the least recently used entries until both bounds are met
+        count, nbytes = self.__connection.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM headers").fetchone()
+        if count <= self.max_entries and nbytes <= self.max_bytes:
+            return
+        evicted = list()
+        for path, entry_nbytes in self.__connection.execute("SELECT path, nbytes FROM headers ORDER BY last_access, rowid"):
+            if count <= self.max_entries and nbytes <= self.max_bytes:
+                break
+            evicted.append((path, ))
+            count -= 1
+            nbytes -= entry_nbytes
+        self.__connection.executemany("DELETE FROM headers WHERE path = ?", evicted)
@@ -0,0 +1,221 @@
+# DMStackWriter writes a DM file to which frames can be appended one at a
+# time, e.g. during a long acquisition, without keeping the stack in memory.
+#
+# The file is written like save_image writes it, but with the pixel data as
+# the very last tag of the file (DM readers find tags by name, not position):
+#
+#   header | other tags ... | ImageList[-1] ... ImageData ... Data | payload | trailer
+#
+# so that frames can be added to the end of the payload. Each append then
+# patches the fields that depend on the number of frames in place: the
+# array length of Data, the last entry of Dimensions, the tag sizes of the
+# groups around Data (dm4 only) and the file size in the header.
+#
+# The writes are ordered such that the file can be indexed at any time:
+#  1. the new frame, except for its first 8 bytes, and a new trailer behind
+#     it; the old trailer is untouched
+#  2. Dimensions, tag sizes and file size
+#  3. the array length of Data, which commits the frame
+#  4. the first 8 bytes of the frame, over the old trailer
+# After a crash, recover_stack (or a DMStackWriter opened with resume=True)
+# makes the fields of 2. agree with the committed array length again and
+# cuts off anything behind the trailer. A crash between 3. and 4. leaves
+# the first 8 bytes of the last frame zero.
+
+import collections
+import os
+
+import numpy
+
+from . import dm3_image_utils
+from . import parse_dm3
+
+
+Calibration = collections.namedtuple("Calibration", ["offset", "scale", "units"])
+
+trailer = bytes(8)
+
+
+class DMStackWriter(object):
+    """
+    Write frames of frame_shape and dtype to the DM file at file_path as they
+    arrive. Frames are stacked along a new slowest axis of the file, so 2d
+    frames form a 3d stack (which load_image returns as y, x, frame) and 1d
+    frames a 2d image (frame, x).
+    frame_calibrations (one per frame axis), frame_axis_calibration,
+    intensity_calibration and metadata are written like save_image writes
+    them. version is 4 (default) or 3; DM3 files are limited to 4 GB.
+    If resume is True and file_path exists, it is recovered (see
+    recover_stack) and the new frames are appended to it.
+    If fsync is True, every append is flushed to the disk, not only to the
+    operating system.
+    """
+
+    def __init__(self, file_path, frame_shape=None, dtype=None, frame_calibrations=None, frame_axis_calibration=None,
+                 intensity_calibration=None, metadata=None, version=4, resume=False, fsync=False):
+        self.file_path = file_path
+        self.fsync = fsync
+        if resume and os.path.exists(file_path):
+            self.__f = open(file_path, "r+b")
+        else:
+            if frame_shape is None or dtype is None:
+                raise ValueError("frame_shape and dtype are needed to create a new stack")
+            self.__f = open(file_path, "w+b")
+            try:
+                self.__write_empty_stack(tuple(frame_shape), numpy.dtype(dtype), frame_calibrations, frame_axis_calibration,
+                                         intensity_calibration, metadata, version)
+            except Exception:
+                self.__f.close()
+                raise
+        try:
+            self.__locate_fields()
+            self.__write_frame_count_fields()
+            self.__f.truncate(self.__payload_end + len(trailer))
+            self.__flush()
+        except Exception:
+            self.__f.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def frame_count(self):
+        return self.__frame_count
+
+    @property
+    def frame_shape(self):
+        return self.__frame_shape
+
+    @property
+    def dtype(self):
+        return self.__dtype
+
+    def append(self, frames):
+        """
+        Append a frame, or a block of frames stacked along the first axis, to
+        the file. The frames are streamed from their buffer. Once append
+        returns, the file can be read with the new frames.
+        """
+        frames = numpy.asarray(frames)
+        if frames.shape == self.__frame_shape:
+            frames = frames[numpy.newaxis]
+        if frames.shape[1:] != self.__frame_shape:
+            raise ValueError("Frames of shape {} expected, not {}".format(self.__frame_shape, frames.shape[1:]))
+        frames = numpy.ascontiguousarray(frames, self.__dtype.newbyteorder(self.__dm_file.byte_order))
+        buffer = memoryview(frames.reshape(-1).view(numpy.uint8))
+        nbytes = len(buffer)
+        if nbytes == 0:
+            return
+        if self.__dm_file.version == 3 and self.__payload_end + nbytes + len(trailer) > 2**32 - 1:
+            raise Exception("Data too large for a DM3 file, write a DM4 file instead")
+        f = self.__f
+        head = min(nbytes, len(trailer))
+        old_payload_end = self.__payload_end
+        f.seek(old_payload_end + head)
+        f.write(buffer[head:])
+        f.write(trailer)
+        self.__flush()
+        self.__frame_count += frames.shape[0]
+        self.__payload_end += nbytes
+        self.__write_frame_count_fields()
+        f.seek(old_payload_end)
+        f.write(buffer[:head])
+        self.__flush()
+
+    def close(self):
+        if self.__f is not None:
+            self.__f.close()
+            self.__f = None
+
+    def __write_empty_stack(self, frame_shape, dtype, frame_calibrations, frame_axis_calibration, intensity_calibration, metadata, version):
+        # save_image moves the last axis of 3d data to the front, which is where the frames go
+        if len(frame_shape) == 2:
+            data = numpy.empty(frame_shape + (0, ), dtype)
+        elif len(frame_shape) == 1:
+            data = numpy.empty((0, ) + frame_shape, dtype)
+        else:
+            raise ValueError("Only stacks of 1d or 2d frames are supported")
+        dimensional_calibrations = None
+        if frame_calibrations is not None or frame_axis_calibration is not None:
+            frame_calibrations = list(frame_calibrations) if frame_calibrations is not None else [Calibration(0.0, 1.0, "")] * len(frame_shape)
+            frame_axis_calibration = frame_axis_calibration if frame_axis_calibration is not None else Calibration(0.0, 1.0, "")
+            if len(frame_shape) == 2:
+                dimensional_calibrations = frame_calibrations + [frame_axis_calibration]
+            else:
+                dimensional_calibrations = [frame_axis_calibration] + frame_calibrations
+        tags = dm3_image_utils.image_file_tags(data, dimensional_calibrations, intensity_calibration, metadata if metadata is not None else dict())
+        # make the pixel data the last tag of the file
+        image = tags["ImageList"][-1]
+        image_data = image["ImageData"]
+        image_data["Data"] = image_data.pop("Data")
+        image["ImageData"] = image.pop("ImageData")
+        tags["ImageList"] = tags.pop("ImageList")
+        parse_dm3.DMFile(self.__f, version).parse_dm_header(tags)
+
+    def __locate_fields(self):
+        # find the fields that depend on the number of frames from the index of the file
+        f = self.__f
+        f.seek(0)
+        self.__dm_file = dm_file = parse_dm3.DMFile(f)
+        root = dm_file.index_dm_header()
+        image = root["ImageList"][-1]
+        image_data = image["ImageData"]
+        data_tag = image_data.tag("Data")
+        dimensions = image_data["Dimensions"]
+        size_struct = parse_dm3.dm_structs[dm_file.size_type].size
+        if list(root.keys())[-1] != "ImageList" or list(image.keys())[-1] != "ImageData" or list(image_data.keys())[-1] != "Data" or not data_tag.is_array:
+            raise Exception("{} is not a DM stack that can be appended to".format(self.file_path))
+        dimension_values = dimensions.to_python()
+        self.__frame_shape = tuple(dimension_values[:-1][::-1])
+        self.__dtype = dm3_image_utils.dmtagdata_dtype(data_tag).newbyteorder("=")
+        self.__frame_nbytes = int(numpy.prod(self.__frame_shape)) * data_tag.itemsize
+        self.__payload_start = data_tag.offset
+        # a crash may have left frames that were not committed (see above), the array length counts
+        self.__frame_count = data_tag.count * data_tag.itemsize // self.__frame_nbytes if self.__frame_nbytes else 0
+        self.__payload_end = self.__payload_start + self.__frame_count * self.__frame_nbytes
+        self.__count_offset = data_tag.offset - size_struct.size
+        dimension_tag = dimensions.tag(len(dimensions) - 1)
+        self.__dimension_struct = parse_dm3.compiled_struct(dimension_tag.byte_order + dimension_tag.typecodes[0])
+        self.__dimension_offset = dimension_tag.offset
+        # the fields holding the size of something that ends with the payload: the file
+        # size in the header and, in dm4, the sizes of Data and the groups around it.
+        # (field offset, offset the size counts from, extra bytes)
+        file_size_offset = parse_dm3.compiled_struct(">l").size  # behind the version
+        self.__sizes = [(file_size_offset, root.offset, 4 if dm_file.version == 3 else 0)]
+        if dm_file.version == 4:
+            data_tag_start = data_tag.offset - dm_file.tag_data_size(numpy.empty((0, ), self.__dtype))
+            for content_offset in (root["ImageList"].offset, image.offset, image_data.offset, data_tag_start):
+                self.__sizes.append((content_offset - size_struct.size, content_offset, 0))
+
+    def __write_frame_count_fields(self):
+        f = self.__f
+        size_struct = parse_dm3.dm_structs[self.__dm_file.size_type].size
+        payload_nbytes = self.__payload_end - self.__payload_start
+        f.seek(self.__dimension_offset)
+        f.write(self.__dimension_struct.pack(self.__frame_count))
+        for offset, content_offset, extra in self.__sizes:
+            f.seek(offset)
+            f.write(size_struct.pack(self.__payload_end - content_offset + extra))
+        self.__flush()
+        # the array length commits the frames
+        f.seek(self.__count_offset)
+        f.write(size_struct.pack(payload_nbytes // self.__dtype.itemsize))
+        self.__flush()
+
+    def __flush(self):
+        self.__f.flush()
+        if self.fsync:
+            os.fsync(self.__f.fileno())
+
+
+def recover_stack(file_path):
+    """
+    Make the DM stack at file_path, which may have been left behind by a
+    crashed DMStackWriter, consistent again. Returns the number of frames.
+    """
+    with DMStackWriter(file_path, resume=True) as writer:
+        return writer.frame_count
@@ -1,9 +1,13 @@
 import array
+import fnmatch
 import io
 import struct
+import sys
 import logging
 import re
 
+import numpy
+
 def u(x=None, y=None):
     return str(x if x is not None else str(), y)
 
@@ -15,9 +19,8 @@ def str_to_iso8859_bytes(s):
     return bytes(s, 'ISO-8859-1')
 
 # mfm 2013-11-15 initial dm4 support
-# this should probably migrate into a class at some point.
-# No support for writing dm4 files, but shouldn't be hard -
-# just need to make sure functions are symmetric
+# dm4 is written by the same (symmetric) functions as dm3, with 64 bit
+# size fields and a size for every tag; use DMFile(f, version=4).
 # mfm 2013-05-21 do we need the numpy array stuff? The python array module
 # allows us to store arrays easily and efficiently. How do we deal
 # with arrays of complex data? We could use numpy arrays with custom dtypes
@@ -34,21 +37,19 @@ def str_to_iso8859_bytes(s):
 # this one doesn't). Is easier to follow though
 verbose = False
 
-# we treat sizes separately to distinguish 32bit (dm3) and 64 bit (dm4)
-# these globals can get changed in parse_dm3_header
-version = 3
-size_type = "L"
-
+TAG_TYPE_BOOL = 8
+TAG_TYPE_STRUCT = 15
 TAG_TYPE_ARRAY = 20
 TAG_TYPE_DATA = 21
 
 def get_from_file(f, stype):
-    #print("reading", stype, "size", struct.calcsize(stype))
-    src = f.read(struct.calcsize(stype))
-    if len(src) != struct.calcsize(stype):
-        print("%s %s %s" % (stype, len(src), struct.calcsize(stype)))
-    assert(len(src) == struct.calcsize(stype))
-    d = struct.unpack(stype, src)
+    s = compiled_struct(stype)
+    #print("reading", stype, "size", s.size)
+    src = f.read(s.size)
+    if len(src) != s.size:
+        print("%s %s %s" % (stype, len(src), s.size))
+    assert(len(src) == s.size)
+    d = s.unpack(src)
     if len(d) == 1:
         return d[0]
     else:
@@ -56,18 +57,51 @@ def get_from_file(f, stype):
 
 
 def put_into_file(f, stype, *args):
-    f.write(struct.pack(stype, *args))
+    f.write(compiled_struct(stype).pack(*args))
+
+
+def read_buffer(f, nbytes):
+    """
+    Read nbytes from f into a new (writable) bytearray, without the
+    intermediate bytes object f.read would create.
+    """
+    buffer = bytearray(nbytes)
+    if not hasattr(f, "readinto"):
+        buffer[:] = f.read(nbytes)
+        return buffer
+    view = memoryview(buffer)
+    position = 0
+    while position < nbytes:
+        n = f.readinto(view[position:])
+        if not n:
+            raise EOFError("Expected {} bytes, got {}".format(nbytes, position))
+        position += n
+    return buffer
 
 
 class structarray(object):
     """
-    A class to represent struct arrays. We store the data as a list of
-    tuples, with the dm_types telling us the dm id for the  types
+    A class to represent struct arrays. The elements are kept in a single
+    numpy array (data) with a structured dtype, one field per typecode, in
+    the byte order of the file. It is filled straight from the file, written
+    straight from its buffer and can be viewed as another dtype (e.g.
+    complex, see dm3_image_utils) without copying.
     """
-    def __init__(self, typecodes):
+    def __init__(self, typecodes, byte_order=None):
         #self.dm_types = dm_types
         self.typecodes = typecodes
-        self.raw_data = None
+        self.byte_order = byte_order if byte_order is not None else native_byte_order
+        self.dtype = numpy.dtype([("f{}".format(i), self.byte_order + typecode) for i, typecode in enumerate(typecodes)])
+        self.data = numpy.empty((0, ), self.dtype)
+
+    @property
+    def raw_data(self):
+        """The bytes of the elements, a memoryview of data"""
+        return memoryview(self.data.reshape(-1).view(numpy.uint8))
+
+    @raw_data.setter
+    def raw_data(self, raw_data):
+        self.data = numpy.frombuffer(raw_data, self.dtype)
 
     def __eq__(self, other):
         return self.raw_data == other.raw_data and self.typecodes == other.typecodes
@@ -76,217 +110,755 @@ class structarray(object):
         return self.raw_data != other.raw_data or self.typecodes != other.typecodes
 
     def __repr__(self):
-        return "structarray({}, {})".format(self.typecodes, self.raw_data)
+        return "structarray({}, {})".format(self.typecodes, self.data)
 
     def bytelen(self, num_elements):
-        return num_elements * struct.calcsize(" ".join(self.typecodes))
+        return num_elements * self.dtype.itemsize
 
     def num_elements(self):
-        b = self.bytelen(1)
-        assert(len(self.raw_data) % b == 0)
-        return len(self.raw_data) // b
+        return self.data.size
 
     def from_file(self, f, num_elements):
-        self.raw_data = array.array('b', f.read(self.bytelen(num_elements)))
+        self.data = numpy.frombuffer(read_buffer(f, self.bytelen(num_elements)), self.dtype)
 
     def to_file(self, f):
-        f.write(bytearray(self.raw_data))
+        f.write(self.raw_data)
 
 
-def parse_dm_header(f, outdata=None):
+class DMFile(object):
     """
-    This is the start of the DM file. We check for some
-    magic values and then treat the next entry as a tag_root
+    Reads and writes the DM tag format on the file-like object f.
 
-    If outdata is supplied, we write instead of read using the dictionary outdata as a source
-    Hopefully parse_dm_header(newf, outdata=parse_dm_header(f)) copies f to newf
+    The format version (3 or 4, which decides between 32 and 64 bit size
+    fields) and the byte order of the values are properties of the file, so
+    they are kept here rather than in module state. parse_dm_header and
+    index_dm_header set them from the file header; to read or write parts of
+    a file directly, pass them in. Separate DMFile objects can be used from
+    different threads at the same time.
+
+    The parse_* and dm_read_* methods read, or write if outdata is given,
+    like the module level functions of the same name.
     """
-    # filesize is sizeondisk - 16. But we have 8 bytes of zero at the end of
-    # the file.
-    if outdata is not None:  # this means we're WRITING to the file
-        if verbose:
-            print("write_dm_header start", f.tell())
-        ver, file_size, endianness = 3, -1, 1
-        put_into_file(f, "> l l l", ver, file_size, endianness)
-        start = f.tell()
-        parse_dm_tag_root(f, outdata)
-        end = f.tell()
-        # start is end of 3 long header. We want to write 2nd long
-        f.seek(start - 8)
-        # the real file size. We started counting after 12-byte version,fs,end
-        # and we need to subtract 16 total:
-        put_into_file(f, "> l", end - start + 4)
-        f.seek(end)
-        enda, endb = 0, 0
-        put_into_file(f, "> l l", enda, endb)
-        if verbose:
-            print("write_dm_header end", f.tell())
-    else:
-        if verbose:
-            print("read_dm_header start", f.tell())
-        ver = get_from_file(f, "> l")
+    # values up to this size are kept in memory by index_dm_header
+    inline_value_limit = 4096
+    # arrays that have to be copied for writing are copied in chunks of this size
+    chunk_size = 1 << 24
+
+    def __init__(self, f, version=3, byte_order="<"):
+        self.f = f
+        self.version = version
+        self.byte_order = byte_order
+
+    @property
+    def size_type(self):
+        # we treat sizes separately to distinguish 32bit (dm3) and 64 bit (dm4)
+        return "L" if self.version == 3 else "Q"
+
+    def parse_dm_header(self, outdata=None):
+        """
+        This is the start of the DM file. We check for some
+        magic values and then treat the next entry as a tag_root
+
+        If outdata is supplied, we write instead of read using the dictionary outdata as a source
+        Hopefully parse_dm_header(newf, outdata=parse_dm_header(f)) copies f to newf
+        """
+        f = self.f
+        # filesize is sizeondisk - 16. But we have 8 bytes of zero at the end of
+        # the file.
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("write_dm_header start", f.tell())
+            ver, endianness = self.version, 1
+            self.byte_order = "<"
+            # all sizes are worked out before writing, so we write in a single
+            # forward pass and never seek; f does not need to be seekable.
+            # the real file size. We start counting after the version,fs,end
+            # header (12 bytes in dm3, 16 in dm4) and we need to subtract 16
+            # total in dm3 and 24 in dm4:
+            file_size = self.tag_root_size(outdata) + (4 if ver == 3 else 0)
+            if file_size > 2**32 - 1 and ver == 3:
+                raise Exception("Data too large for a DM3 file ({} bytes), save as DM4 instead".format(file_size))
+            put_into_file(f, "> l %c l" % self.size_type, ver, file_size, endianness)
+            self.parse_dm_tag_root(outdata)
+            enda, endb = 0, 0
+            put_into_file(f, "> l l", enda, endb)
+            if verbose:
+                print("write_dm_header end", f.tell())
+        else:
+            if verbose:
+                print("read_dm_header start", f.tell())
+            self.read_dm_version()
+            start = f.tell()
+            ret = self.parse_dm_tag_root()
+            end = f.tell()
+            # print("fs", file_size, end - start, (end-start)%8)
+            # mfm 2013-07-11 the file_size value is not always
+            # end-start, sometimes there seems to be an extra 4 bytes,
+            # other times not. Let's just ignore it for the moment
+            # assert(file_size == end - start)
+            enda, endb = get_from_file(f, "> l l")
+            assert(enda == endb == 0)
+            if verbose:
+                print("read_dm_header end", f.tell())
+            return ret
+
+    def read_dm_version(self):
+        """Read version, file size and endianness at the start of the file and set up self accordingly"""
+        ver = get_from_file(self.f, "> l")
         assert ver in [3,4], "Version must be 3 or 4, not %s" % ver
-        # argh. why a global?
-        global size_type, version
-        if ver == 3:
-            size_type = 'L'  # may be Q?
-            version = 3
-        if ver == 4:
-            size_type = 'Q'  # may be Q?
-            version = 4
-        file_size, endianness = get_from_file(f, ">%c l" % size_type)
-        assert endianness == 1, "Endianness must be 1, not %s"%endianness
-        start = f.tell()
-        ret = parse_dm_tag_root(f, outdata)
-        end = f.tell()
-        # print("fs", file_size, end - start, (end-start)%8)
-        # mfm 2013-07-11 the file_size value is not always
-        # end-start, sometimes there seems to be an extra 4 bytes,
-        # other times not. Let's just ignore it for the moment
-        # assert(file_size == end - start)
-        enda, endb = get_from_file(f, "> l l")
-        assert(enda == endb == 0)
-        if verbose:
-            print("read_dm_header end", f.tell())
-        return ret
+        self.version = ver
+        file_size, endianness = get_from_file(self.f, ">%c l" % self.size_type)
+        assert endianness in [0, 1], "Endianness must be 0 or 1, not %s" % endianness
+        # endianness is that of the values, the tag structure is always big endian
+        self.byte_order = "<" if endianness == 1 else ">"
+        return file_size
+
+    def parse_dm_tag_root(self, outdata=None):
+        f = self.f
+        if outdata is not None:  # this means we're WRITING to the file
+            is_dict = 0 if isinstance(outdata, list) else 1
+            _open = 0
+            entries = tag_root_entries(outdata)
+            num_tags = len(entries)
+            if verbose:
+                print("write_dm_tag_root start {} {} {}".format(f.tell(), is_dict, num_tags))
+            put_into_file(f, "> b b %c" % self.size_type, is_dict, _open, num_tags)
+            for key, value in entries:
+                self.parse_dm_tag_entry(value, key)
+            if verbose:
+                print("write_dm_tag_root end", f.tell())
+        else:
+            if verbose:
+                print("read_dm_tag_root start", f.tell())
+            is_dict, _open, num_tags = get_from_file(f, ("> b b %c" % self.size_type))
+            if is_dict:
+                new_obj = {}
+                for i in range(num_tags):
+                    name, data = self.parse_dm_tag_entry()
+                    assert(name is not None)
+                    new_obj[name] = data
+            else:
+                new_obj = []
+                for i in range(num_tags):
+                    name, data = self.parse_dm_tag_entry()
+                    assert(name is None)
+                    new_obj.append(data)
+            if verbose:
+                print("read_dm_tag_root end", f.tell())
+            return new_obj
 
+    def parse_dm_tag_entry(self, outdata=None, outname=None):
+        f = self.f
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("write_dm_tag_entry start", f.tell())
+            dtype = TAG_TYPE_ARRAY if isinstance(outdata, (dict, list)) else TAG_TYPE_DATA
+            name_len = len(outname) if outname else 0
+            put_into_file(f, "> b H", dtype, name_len)
+            if outname:
+                put_into_file(f, ">" + str(name_len) + "s", str_to_iso8859_bytes(outname))
+            if self.version == 4:
+                # dm4 stores the size of the tag data or group that follows
+                tag_size = self.tag_data_size(outdata) if dtype == TAG_TYPE_DATA else self.tag_root_size(outdata)
+                put_into_file(f, ">%c" % self.size_type, tag_size)
+
+            if dtype == TAG_TYPE_DATA:
+                self.parse_dm_tag_data(outdata)
+            else:
+                self.parse_dm_tag_root(outdata)
+            if verbose:
+                print("write_dm_tag_entry end", f.tell())
 
-def parse_dm_tag_root(f, outdata=None):
-    if outdata is not None:  # this means we're WRITING to the file
-        is_dict = 0 if isinstance(outdata, list) else 1
-        _open = 0
-        if is_dict:
-            num_tags = sum(1 if k is not None and len(k) > 0 and v is not None else 0 for k, v in outdata.items())
         else:
-            num_tags = sum(1 if v is not None else 0 for v in outdata)
-        if verbose:
-            print("write_dm_tag_root start {} {} {}".format(f.tell(), is_dict, num_tags))
-        put_into_file(f, "> b b l", is_dict, _open, num_tags)
-        if not is_dict:
-            for subdata in outdata:
-                if subdata is not None:
-                    parse_dm_tag_entry(f, subdata, None)
+            if verbose:
+                print("read_dm_tag_entry start", f.tell())
+            dtype, name_len = get_from_file(f, "> b H")
+            if name_len:
+                name = get_from_file(f, ">" + str(name_len) + "s").decode("latin")
+            else:
+                name = None
+
+            if self.version == 4:
+                extra_tag_flags = get_from_file(f, ">%c" % self.size_type)
+
+            if dtype == TAG_TYPE_DATA:
+                arr = string_for_name_tag(name, self.parse_dm_tag_data())
+                if verbose:
+                    print("read_dm_tag_entry end", f.tell())
+                return name, arr
+            elif dtype == TAG_TYPE_ARRAY:
+                result = self.parse_dm_tag_root()
+                if verbose:
+                    print("read_dm_tag_entry end", f.tell())
+                return name, result
+            else:
+                raise Exception("Unknown data type=" + str(dtype))
+
+    def parse_dm_tag_data(self, outdata=None):
+        # todo what is id??
+        # it is normally one of 1,3,7,11,19
+        # we can parse lists of numbers with them all 1
+        # strings work with 3
+        # could id be some offset to the start of the data?
+        # for simple types we just read data, for strings, we read type, length
+        # for structs we read len,num, len0,type0,len1,... =num*2+2
+        # structs (15) can be 7,9,11,19
+        # arrays (TAG_TYPE_ARRAY) can be 3 or 11
+        f = self.f
+        if outdata is not None:  # this means we're WRITING to the file
+                # can we get away with a limited set that we write?
+            # ie can all numbers be doubles or ints, and we have lists
+            if verbose:
+                print("write_dm_tag_data start", f.tell())
+            data_type = get_dmtype_for_outdata(outdata)
+            header = self.dm_header_len(data_type, outdata)
+            _delim = "%%%%"
+            put_into_file(f, "> 4s {size} {size}".format(size=self.size_type), str_to_iso8859_bytes(_delim), header+1, data_type)
+            assert self.dm_read(data_type, outdata) == header
+            if verbose:
+                print("write_dm_tag_data end", f.tell())
         else:
-            for key in outdata:
-                if key is not None and len(key) > 0:  # don't write out invalid dict's
-                    value = outdata[key]
-                    if value is not None:
-                        parse_dm_tag_entry(f, value, key)
-        if verbose:
-            print("write_dm_tag_root end", f.tell())
-    else:
-        if verbose:
-            print("read_dm_tag_root start", f.tell())
-        is_dict, _open, num_tags = get_from_file(f, ("> b b %c" % size_type))
-        if is_dict:
-            new_obj = {}
-            for i in range(num_tags):
-                pos = f.tell()
-                name, data = parse_dm_tag_entry(f)
-                assert(name is not None)
-                new_obj[name] = data
+            if verbose:
+                print("read_dm_tag_data start", f.tell())
+            _delim, header_len, data_type = get_from_file(f, "> 4s {size} {size}".format(size=self.size_type))
+            assert(_delim == str_to_iso8859_bytes("%%%%"))
+            ret, header = self.dm_read(data_type)
+            assert(header + 1 == header_len)
+            if verbose:
+                print("read_dm_tag_data end", f.tell())
+            return ret
+
+    # sizes of what the parse_* methods write for outdata, so that size fields
+    # can be written before the data they describe.
+
+    def tag_root_size(self, outdata):
+        size = compiled_struct(">" + self.size_type).size
+        return 2 + size + sum(self.tag_entry_size(value, key) for key, value in tag_root_entries(outdata))
+
+    def tag_entry_size(self, outdata, outname=None):
+        size = 3 + (len(outname) if outname else 0)
+        if self.version == 4:
+            size += compiled_struct(">" + self.size_type).size
+        if isinstance(outdata, (dict, list)):
+            return size + self.tag_root_size(outdata)
+        return size + self.tag_data_size(outdata)
+
+    def tag_data_size(self, outdata):
+        # delimiter, header length and data type, then the rest of the header and the value
+        size = compiled_struct(">" + self.size_type).size
+        return 4 + 2 * size + self.dm_size(get_dmtype_for_outdata(outdata), outdata)
+
+    def dm_header_len(self, dm_type, outdata):
+        """The number of header fields dm_read writes for outdata"""
+        if dm_type == get_dmtype_for_name('string'):
+            return 1
+        elif dm_type == get_dmtype_for_name('struct'):
+            return 2 + 2 * len(outdata)
+        elif dm_type == get_dmtype_for_name('array'):
+            element_types = get_dmtypes_for_array(outdata)
+            return 2 if len(element_types) == 1 else 4 + 2 * len(element_types)
+        return 0
+
+    def dm_size(self, dm_type, outdata):
+        """The number of bytes dm_read writes for outdata"""
+        size = compiled_struct(">" + self.size_type).size
+        if dm_type == get_dmtype_for_name('string'):
+            return 4 + len(outdata.encode("utf_16_le"))
+        elif dm_type == get_dmtype_for_name('struct'):
+            types = [get_dmtype_for_outdata(x) for x in outdata]
+            return size * (2 + 2 * len(types)) + sum(self.dm_size(t, x) for t, x in zip(types, outdata))
+        elif dm_type == get_dmtype_for_name('array'):
+            element_types = get_dmtypes_for_array(outdata)
+            header = size * (2 if len(element_types) == 1 else 4 + 2 * len(element_types))
+            return header + get_array_nbytes(outdata)
+        return compiled_struct("<" + get_structchar_for_dmtype(dm_type)).size
+
+    def dm_read(self, dm_type, outdata=None):
+        """
+        Read (or write if outdata is given) a value of the dm type dm_type.
+        Returns the value and the number of header fields when reading and
+        the number of header fields when writing.
+        """
+        if dm_type == get_dmtype_for_name('bool'):
+            return self.dm_read_bool(outdata)
+        elif dm_type == get_dmtype_for_name('string'):
+            return self.dm_read_string(outdata)
+        elif dm_type == get_dmtype_for_name('struct'):
+            return self.dm_read_struct(outdata)
+        elif dm_type == get_dmtype_for_name('array'):
+            return self.dm_read_array(outdata)
+        return self.dm_read_simple(dm_type, outdata)
+
+    def dm_read_simple(self, dm_type, outdata=None):
+        """Reads (or write if outdata is given) a simple data type.
+        returns the data if reading and the number of bytes of header
+        """
+        f = self.f
+        structchar = get_structchar_for_dmtype(dm_type)
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("dm_write start", structchar, outdata, "at", f.tell())
+            put_into_file(f, self.byte_order + structchar, outdata)
+            if verbose:
+                print("dm_write end", f.tell())
+            return 0
         else:
-            new_obj = []
-            for i in range(num_tags):
-                pos = f.tell()
-                name, data = parse_dm_tag_entry(f)
-                assert(name is None)
-                new_obj.append(data)
-        if verbose:
-            print("read_dm_tag_root end", f.tell())
-        return new_obj
+            if verbose:
+                print("dm_read start", structchar, "at", f.tell())
+            result = get_from_file(f, self.byte_order + structchar)
+            if verbose:
+                print("dm_read end", f.tell())
+            return result, 0
 
+    # 8 is boolean, and relatively easy:
+    def dm_read_bool(self, outdata=None):
+        f = self.f
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("dm_write_bool start", f.tell())
+            put_into_file(f, "<b", 1 if outdata else 0)
+            if verbose:
+                print("dm_write_bool end", f.tell())
+            return 0
+        else:
+            if verbose:
+                print("dm_read_bool start", f.tell())
+            result = get_from_file(f, "<b")
+            if verbose:
+                print("dm_read_bool end", f.tell())
+            return result != 0, 0
+
+    # string is 18:
+    # mfm 2013-05-13 looks like this is never used, and all strings are
+    # treated as array?
+    def dm_read_string(self, outdata=None):
+        f = self.f
+        header_size = 1  # just a length field
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("dm_write_string start", f.tell())
+            outdata = outdata.encode("utf_16_le")
+            slen = len(outdata)
+            put_into_file(f, ">L", slen)
+            put_into_file(f, ">" + str(slen) + "s", outdata)
+            if verbose:
+                print("dm_write_string end", f.tell())
+            return header_size
+        else:
+            assert(False)
+            if verbose:
+                print("dm_read_string start", f.tell())
+            slen = get_from_file(f, ">L")
+            raws = get_from_file(f, ">" + str(slen) + "s")
+            if verbose:
+                print("dm_read_string end", f.tell())
+            return u(raws, "utf_16_le"), header_size
+
+    # struct is 15
+    def dm_read_struct_types(self, outtypes=None):
+        f = self.f
+        if outtypes is not None:
+            _len, nfields = 0, len(outtypes)
+            put_into_file(f, "> {size} {size}".format(size=self.size_type), _len, nfields)
+            for t in outtypes:
+                _len = 0
+                put_into_file(f, "> {size} {size}".format(size=self.size_type), _len, t)
+            return 2+2*len(outtypes)
+        else:
+            types = []
+            _len, nfields = get_from_file(f, "> {size} {size}".format(size=self.size_type))
+            assert(_len == 0)  # is it always?
+            for i in range(nfields):
+                _len, dtype = get_from_file(f, "> {size} {size}".format(size=self.size_type))
+                types.append(dtype)
+                assert(_len == 0)
+                assert(dtype != 15)  # we don't allow structs of structs?
+            return types, 2+2*nfields
+
+    def dm_read_struct(self, outdata=None):
+        f = self.f
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("dm_write_struct start", f.tell())
+            types = [get_structdmtypes_for_python_typeorobject(x)[1]
+                     for x in outdata]
+            header = self.dm_read_struct_types(types)
+            for t, data in zip(types, outdata):
+                self.dm_read(t, data)
+            if verbose:
+                print("dm_write_struct end", f.tell())
+            return header
+        else:
+            if verbose:
+                print("dm_read_struct start", f.tell())
+            types, header = self.dm_read_struct_types()
+            ret = []
+            for t in types:
+                d, h = self.dm_read(t)
+                ret.append(d)
+            if verbose:
+                print("dm_read_struct end", f.tell())
+            return tuple(ret), header
 
-def parse_dm_tag_entry(f, outdata=None, outname=None):
-    if outdata is not None:  # this means we're WRITING to the file
-        if verbose:
-            print("write_dm_tag_entry start", f.tell())
-        dtype = TAG_TYPE_ARRAY if isinstance(outdata, (dict, list)) else TAG_TYPE_DATA
-        name_len = len(outname) if outname else 0
-        put_into_file(f, "> b H", dtype, name_len)
-        if outname:
-            put_into_file(f, ">" + str(name_len) + "s", str_to_iso8859_bytes(outname))
+    # array is TAG_TYPE_ARRAY
+    def dm_read_array(self, outdata=None):
+        f = self.f
+        array_header = 2  # type, length
+        if outdata is not None:  # this means we're WRITING to the file
+            if verbose:
+                print("dm_write_array start", f.tell())
+            if isinstance(outdata, structarray):
+                # we write type, struct_types, length
+                outdmtypes = [get_dmtype_for_structchar(s) for s in outdata.typecodes]
+                put_into_file(f, "> {size}".format(size=self.size_type), get_dmtype_for_name('struct'))
+                struct_header = self.dm_read_struct_types(outtypes=outdmtypes)
+                put_into_file(f, "> {size}".format(size=self.size_type), outdata.num_elements())
+                self.write_ndarray(outdata.data)
+                if verbose:
+                    print("dm_write_array1 end", f.tell())
+                return struct_header + array_header
+            elif isinstance(outdata, numpy.ndarray):
+                # numpy arrays are streamed from their own buffer. complex
+                # data is written as an array of (real, imag) structs.
+                outdmtypes = get_dmtypes_for_array(outdata)
+                if len(outdmtypes) == 1:
+                    put_into_file(f, "> {size}".format(size=self.size_type), outdmtypes[0])
+                    struct_header = 0
+                else:
+                    put_into_file(f, "> {size}".format(size=self.size_type), get_dmtype_for_name('struct'))
+                    struct_header = self.dm_read_struct_types(outtypes=outdmtypes)
+                put_into_file(f, "> {size}".format(size=self.size_type), outdata.size)
+                self.write_ndarray(outdata)
+                if verbose:
+                    print("dm_write_array4 end", f.tell())
+                return struct_header + array_header
+            elif isinstance(outdata, (str, unicode_type, array.array)):
+                if isinstance(outdata, (str, unicode_type)):
+                    outdata = array.array('H', outdata.encode("utf_16_le"))
+                assert(isinstance(outdata, array.array))
+                dtype = get_dmtype_for_structchar(outdata.typecode)
+                if dtype < 0:
+                    print("typecode %s" % outdata.typecode)
+                assert dtype >= 0
+                put_into_file(f, "> {size}".format(size=self.size_type), dtype)
+                put_into_file(f, "> {size}".format(size=self.size_type), len(outdata))
+                if verbose:
+                    print("dm_write_array2 end", dtype, len(outdata), outdata.typecode, f.tell())
+                f.write(memoryview(outdata))
+                if verbose:
+                    print("dm_write_array3 end", f.tell())
+                return array_header
+            else:
+                logging.warn("Unsupported type for conversion to array:%s", outdata)
 
-        if dtype == TAG_TYPE_DATA:
-            parse_dm_tag_data(f, outdata)
         else:
-            parse_dm_tag_root(f, outdata)
-        if verbose:
-            print("write_dm_tag_entry end", f.tell())
+            # supports arrays of structs and arrays of types,
+            # but not arrays of arrays (Is this possible)
+            # actually lets just use the array object, which only allows arrays of
+            # simple types!
+
+            # arrays of structs are pretty common, eg in a simple image CLUT
+            # data["DocumentObjectList"][0]["ImageDisplayInfo"]["CLUT"] is an
+            # array of 3 bytes
+            # we can't handle arrays of structs easily, as we use lists for
+            # taglists, dicts for taggroups and arrays for array data.
+            # But array.array only supports simple types. We need a new type, then.
+            # let's make a structarray
+            if verbose:
+                print("dm_read_array start", f.tell())
+            dtype = get_from_file(f, "> {size}".format(size=self.size_type))
+            if dtype == get_dmtype_for_name('struct'):
+                types, struct_header = self.dm_read_struct_types()
+                # NB this was '> L', but changing to > {size}. May break things!
+                alen = get_from_file(f, "> {size}".format(size=self.size_type))
+                ret = structarray([get_structchar_for_dmtype(d) for d in types], self.byte_order)
+                ret.from_file(f, alen)
+                if verbose:
+                    print("dm_read_array1 end", f.tell())
+                return ret, array_header + struct_header
+            else:
+                # mfm 2013-08-02 struct.calcsize('l') is 4 on win and 8 on Mac!
+                # however >l, <l is 4 on both... could be a bug?
+                # Can we get around this by adding '>' to out structchar?
+                # nope, array only takes a sinlge char. Trying i, I instead
+                struct_char = get_structchar_for_dmtype(dtype)
+                ret = array.array(struct_char)
+                # NB this was '> L', but changing to > {size}. May break things!
+                alen = get_from_file(f, "> {size}".format(size=self.size_type))
+                if alen:
+                    # faster to read <1024f than <f 1024 times. probly
+                    # stype = "<" + str(alen) + dm_simple_names[dtype][1]
+                    # ret = get_from_file(f, stype)
+                    if verbose:
+                        print("dm_read_array2 end", dtype, alen, ret.typecode, f.tell())
+                    if isinstance(f, file_type):
+                        ret.fromfile(f, alen)
+                    else:
+                        ret.frombytes(f.read(alen*struct.calcsize(ret.typecode)))
+                    if self.byte_order != native_byte_order:
+                        ret.byteswap()
+                # if dtype == get_dmtype_for_name('ushort'):
+                #     ret = ret.tostring().decode("utf-16")
+                if verbose:
+                    print("dm_read_array3 end", f.tell())
+                return ret, array_header
 
-    else:
+    def write_ndarray(self, nparr):
+        """
+        Write the elements of nparr in C order and in our byte order. The
+        data is written straight from the array's buffer when possible, and
+        in chunks of at most chunk_size bytes otherwise, so the array is
+        never copied as a whole.
+        """
+        dtype = nparr.dtype.newbyteorder(self.byte_order)
+        if nparr.flags.c_contiguous and nparr.dtype == dtype:
+            self.f.write(memoryview(nparr.reshape(-1).view(numpy.uint8)))
+        elif nparr.nbytes <= self.chunk_size or nparr.ndim == 1 and nparr.size == 1:
+            self.f.write(memoryview(numpy.ascontiguousarray(nparr, dtype).reshape(-1).view(numpy.uint8)))
+        elif nparr.shape[0] == 1:
+            self.write_ndarray(nparr[0])
+        else:
+            step = max(1, self.chunk_size * nparr.shape[0] // nparr.nbytes)
+            for i in range(0, nparr.shape[0], step):
+                self.write_ndarray(nparr[i:i + step])
+
+    # Lazy reading. index_dm_header walks the tag tree once, recording
+    # the name, type and file offset of every tag but skipping over the values.
+    # Data tags are only read from the file when they are accessed through the
+    # returned DMTagGroup, so e.g. the calibrations of the last image can be read
+    # without ever touching the pixel data of the thumbnail or of the image itself.
+
+    def index_dm_header(self):
+        """
+        Index the DM file, which must be seekable, and return the root tag
+        group as a DMTagGroup. Only the tag structure is read here.
+        """
+        f = self.f
+        if verbose:
+            print("index_dm_header start", f.tell())
+        self.read_dm_version()
+        buffer = TagBuffer(f)
+        ret = self.index_dm_tag_root(buffer)
+        enda, endb = buffer.unpack(trailer_struct)
+        assert(enda == endb == 0)
+        buffer.sync()
         if verbose:
-            print("read_dm_tag_entry start", f.tell())
-        dtype, name_len = get_from_file(f, "> b H")
+            print("index_dm_header end", f.tell())
+        return ret
+
+    def index_dm_tag_root(self, buffer):
+        offset = buffer.tell()
+        is_dict, _open, num_tags = buffer.unpack(dm_structs[self.size_type].tag_root)
+        entries = [self.index_dm_tag_entry(buffer) for i in range(num_tags)]
+        for name, tag in entries:
+            assert (name is not None) == bool(is_dict)
+        return DMTagGroup(offset, bool(is_dict), entries)
+
+    def index_dm_tag_entry(self, buffer):
+        dtype, name_len = buffer.unpack(tag_entry_struct)
         if name_len:
-            name = get_from_file(f, ">" + str(name_len) + "s").decode("latin")
+            name = buffer.read(name_len).decode("latin")
         else:
             name = None
-
-        if version == 4:
-            extra_tag_flags = get_from_file(f, ">%c" % size_type)
-
+        if self.version == 4:
+            extra_tag_flags = buffer.unpack(dm_structs[self.size_type].size)
         if dtype == TAG_TYPE_DATA:
-            arr = parse_dm_tag_data(f)
-            if name and hasattr(arr, "__len__") and len(arr) > 0:
-                # if we find data which matches this regex we return a
-                # string instead of an array
-                treat_as_string_names = ['.*Name']
-                for regex in treat_as_string_names:
-                    if re.match(regex, name):
-                        if isinstance(arr[0], int):
-                            arr = ''.join(chr(x) for x in arr)
-                        elif isinstance(arr[0], str):
-                            arr = ''.join(arr)
-            if verbose:
-                print("read_dm_tag_entry end", f.tell())
-            return name, arr
+            return name, self.index_dm_tag_data(buffer)
         elif dtype == TAG_TYPE_ARRAY:
-            result = parse_dm_tag_root(f)
-            if verbose:
-                print("read_dm_tag_entry end", f.tell())
-            return name, result
+            return name, self.index_dm_tag_root(buffer)
         else:
             raise Exception("Unknown data type=" + str(dtype))
 
+    def index_dm_struct_types(self, buffer):
+        size_pair = dm_structs[self.size_type].size_pair
+        _len, nfields = buffer.unpack(size_pair)
+        return [buffer.unpack(size_pair)[1] for i in range(nfields)]
 
-def parse_dm_tag_data(f, outdata=None):
-    # todo what is id??
-    # it is normally one of 1,3,7,11,19
-    # we can parse lists of numbers with them all 1
-    # strings work with 3
-    # could id be some offset to the start of the data?
-    # for simple types we just read data, for strings, we read type, length
-    # for structs we read len,num, len0,type0,len1,... =num*2+2
-    # structs (15) can be 7,9,11,19
-    # arrays (TAG_TYPE_ARRAY) can be 3 or 11
-    if outdata is not None:  # this means we're WRITING to the file
-            # can we get away with a limited set that we write?
-        # ie can all numbers be doubles or ints, and we have lists
-        if verbose:
-            print("write_dm_tag_data start", f.tell())
-        _, data_type = get_structdmtypes_for_python_typeorobject(outdata)
-        if not data_type:
-            raise Exception("Unsupported type: {}".format(type(outdata)))
-        _delim = "%%%%"
-        put_into_file(f, "> 4s l l", str_to_iso8859_bytes(_delim), 0, data_type)
-        pos = f.tell()
-        header = dm_types[data_type](f, outdata)
-        f.seek(pos-8)  # where our header_len starts
-        put_into_file(f, "> l", header+1)
-        f.seek(0, 2)
-        if verbose:
-            print("write_dm_tag_data end", f.tell())
-    else:
-        if verbose:
-            print("read_dm_tag_data start", f.tell())
-        _delim, header_len, data_type = get_from_file(f, "> 4s {size} {size}".format(size=size_type))
+    def index_dm_tag_data(self, buffer):
+        structs = dm_structs[self.size_type]
+        _delim, header_len, data_type = buffer.unpack(structs.tag_data)
         assert(_delim == str_to_iso8859_bytes("%%%%"))
-        ret, header = dm_types[data_type](f)
-        assert(header + 1 == header_len)
-        if verbose:
-            print("read_dm_tag_data end", f.tell())
-        return ret
+        element_type = count = None
+        if data_type == TAG_TYPE_STRUCT:
+            field_types = self.index_dm_struct_types(buffer)
+        elif data_type == TAG_TYPE_ARRAY:
+            element_type = buffer.unpack(structs.size)[0]
+            if element_type == TAG_TYPE_STRUCT:
+                field_types = self.index_dm_struct_types(buffer)
+            else:
+                field_types = [element_type]
+            count = buffer.unpack(structs.size)[0]
+        elif get_structchar_for_dmtype(data_type) is not None:
+            field_types = [data_type]
+        else:
+            raise Exception("Unsupported data type=" + str(data_type))
+        tag = DMTagData(self, buffer.tell(), data_type, field_types, element_type, count)
+        # small values are usually in the buffer already, keep their bytes so
+        # that decoding them later does not need another read. Everything
+        # else (e.g. pixel data) is skipped and gets read on access.
+        nbytes = tag.nbytes
+        if nbytes <= self.inline_value_limit:
+            tag.raw_bytes = buffer.read(nbytes)
+        else:
+            buffer.skip(nbytes)
+        return tag
+
+
+class DMStructs(object):
+    """
+    Precompiled structs for the fields of the tag structure that depend on
+    the size type (32 bit in dm3, 64 bit in dm4).
+    """
+    def __init__(self, size_type):
+        self.size = struct.Struct("> " + size_type)
+        self.size_pair = struct.Struct("> 2" + size_type)
+        self.tag_root = struct.Struct("> b b " + size_type)
+        self.tag_data = struct.Struct("> 4s 2" + size_type)
+
+dm_structs = {"L": DMStructs("L"), "Q": DMStructs("Q")}
+tag_entry_struct = struct.Struct("> b H")
+trailer_struct = struct.Struct("> l l")
+
+
+class TagBuffer(object):
+    """
+    Reads a file in large blocks and unpacks fields from the block with
+    precompiled structs, rather than issuing a small read for every field.
+    Skipping beyond the current block seeks instead of reading, so large
+    values in between tags are never read.
+    """
+    block_size = 1 << 16
+
+    def __init__(self, f):
+        self.f = f
+        self.base = f.tell()  # file offset of the start of the block
+        self.block = bytes()
+        self.pos = 0  # position in (or past) the block
+
+    def tell(self):
+        return self.base + self.pos
+
+    def __fill(self, size):
+        self.base += self.pos
+        self.pos = 0
+        self.f.seek(self.base)
+        self.block = self.f.read(max(size, self.block_size))
+        if len(self.block) < size:
+            print("%s %s" % (size, len(self.block)))
+        assert(len(self.block) >= size)
+
+    def unpack(self, s):
+        if self.pos + s.size > len(self.block):
+            self.__fill(s.size)
+        d = s.unpack_from(self.block, self.pos)
+        self.pos += s.size
+        return d
+
+    def read(self, size):
+        if self.pos + size > len(self.block):
+            self.__fill(size)
+        d = self.block[self.pos:self.pos + size]
+        self.pos += size
+        return d
+
+    def skip(self, size):
+        self.pos += size
+
+    def sync(self):
+        """Move the file to the position up to which we have read"""
+        self.f.seek(self.tell())
+
+
+compiled_structs = dict()
+
+
+def compiled_struct(stype):
+    """Return a (cached) precompiled struct for the format stype"""
+    s = compiled_structs.get(stype)
+    if s is None:
+        s = compiled_structs.setdefault(stype, struct.Struct(stype))
+    return s
+
+
+native_byte_order = "<" if sys.byteorder == "little" else ">"
+
+
+# if we find data whose tag name matches this regex we return a
+# string instead of an array
+string_tag_names = re.compile('.*Name')
+
+# arrays of these types are decoded to strings as one code point per element
+string_encodings = {
+    'b': 'latin-1',
+    'h': 'utf_16', 'H': 'utf_16',
+    'i': 'utf_32', 'I': 'utf_32',
+}
+
+
+def decode_string_bytes(raw, typecode, byte_order):
+    """
+    Decode the bytes raw of an array of typecode elements to a string with
+    one character per element, or return None if typecode can't be decoded
+    this way.
+    """
+    encoding = string_encodings.get(typecode)
+    if encoding is None:
+        return None
+    if encoding != 'latin-1':
+        encoding += '_le' if byte_order == "<" else '_be'
+    return raw.decode(encoding, 'surrogatepass')
+
+
+def string_for_name_tag(name, arr):
+    """
+    Tags whose name matches string_tag_names hold strings stored as
+    arrays. Return those as a string, everything else is returned unchanged.
+    """
+    if name and isinstance(arr, array.array) and len(arr) > 0 and string_tag_names.match(name):
+        s = decode_string_bytes(arr.tobytes(), arr.typecode, native_byte_order)
+        if s is not None:
+            return s
+        elif isinstance(arr[0], int):
+            return ''.join(chr(x) for x in arr)
+    return arr
+
+
+# the module level functions read and write dm3 (or parts of dm3 files). Use
+# DMFile(f, version=4) to write dm4 or to read parts of dm4 files.
+
+def parse_dm_header(f, outdata=None):
+    """
+    This is the start of the DM file. We check for some
+    magic values and then treat the next entry as a tag_root
+
+    If outdata is supplied, we write instead of read using the dictionary outdata as a source
+    Hopefully parse_dm_header(newf, outdata=parse_dm_header(f)) copies f to newf
+    """
+    return DMFile(f).parse_dm_header(outdata)
+
+
+def parse_dm_tag_root(f, outdata=None):
+    return DMFile(f).parse_dm_tag_root(outdata)
+
+
+def parse_dm_tag_entry(f, outdata=None, outname=None):
+    return DMFile(f).parse_dm_tag_entry(outdata, outname)
+
+
+def parse_dm_tag_data(f, outdata=None):
+    return DMFile(f).parse_dm_tag_data(outdata)
+
+
+def dm_read_struct_types(f, outtypes=None):
+    return DMFile(f).dm_read_struct_types(outtypes)
+
+
+def index_dm_header(f):
+    """
+    Index the DM file f, which must be seekable, and return the root tag
+    group as a DMTagGroup. Only the tag structure is read here.
+    """
+    return DMFile(f).index_dm_header()
 
 
 # we store the id as a key and the name,
@@ -356,15 +928,67 @@ def get_structdmtypes_for_python_typeorobject(typeorobj):
         return None, get_dmtype_for_name('struct')
     elif comparer(structarray):
         return None, get_dmtype_for_name('array')
+    elif comparer(numpy.ndarray):
+        return None, get_dmtype_for_name('array')
     logging.warn("No appropriate DMType found for %s, %s", typeorobj, type(typeorobj))
     return None
 
 
-def get_structchar_for_dmtype(dm_type):
+dm_simple_structchars = {key: sc for key, name, sc, types in dm_simple_names}
+
+
+def get_dmtype_for_outdata(outdata):
+    """The dm type we write the python (or numpy) object outdata as"""
+    structdmtypes = get_structdmtypes_for_python_typeorobject(outdata)
+    if not structdmtypes or not structdmtypes[1]:
+        raise Exception("Unsupported type: {}".format(type(outdata)))
+    return structdmtypes[1]
+
+
+def get_dmtypes_for_array(outdata):
+    """
+    Return the dm types of the elements of the array outdata: a single
+    simple type, or the field types for arrays of structs.
+    """
+    if isinstance(outdata, structarray):
+        return [get_dmtype_for_structchar(s) for s in outdata.typecodes]
+    elif isinstance(outdata, numpy.ndarray):
+        if outdata.dtype.kind == 'c':
+            # complex is stored as struct of real and imaginary part
+            return [get_dmtype_for_ndarray_dtype(outdata.real.dtype)] * 2
+        return [get_dmtype_for_ndarray_dtype(outdata.dtype)]
+    elif isinstance(outdata, (str, unicode_type)):
+        return [get_dmtype_for_structchar('H')]
+    return [get_dmtype_for_structchar(outdata.typecode)]
+
+
+def get_dmtype_for_ndarray_dtype(dtype):
     for key, name, sc, types in dm_simple_names:
-        if key == dm_type:
-            return sc
-    return None
+        if numpy.dtype(sc) == dtype.newbyteorder('='):
+            return key
+    raise Exception("Unsupported dtype: {}".format(dtype))
+
+
+def get_array_nbytes(outdata):
+    if isinstance(outdata, structarray):
+        return outdata.data.nbytes
+    elif isinstance(outdata, numpy.ndarray):
+        return outdata.nbytes
+    elif isinstance(outdata, (str, unicode_type)):
+        return len(outdata.encode("utf_16_le"))
+    return len(outdata) * outdata.itemsize
+
+
+def tag_root_entries(outdata):
+    """The (name, value) pairs we write for the tag group or list outdata"""
+    if isinstance(outdata, list):
+        return [(None, v) for v in outdata if v is not None]
+    # don't write out invalid dict's
+    return [(k, v) for k, v in outdata.items() if k is not None and len(k) > 0 and v is not None]
+
+
+def get_structchar_for_dmtype(dm_type):
+    return dm_simple_structchars.get(dm_type)
 
 
 def get_dmtype_for_structchar(struct_char):
@@ -374,235 +998,286 @@ def get_dmtype_for_structchar(struct_char):
     return -1
 
 
-def standard_dm_read(datatype_num, desc):
+def standard_dm_read(datatype_num):
     """
     datatype_num is the number of the data type, see dm_simple_names
-    above. desc is a (nicename, struct_char) tuple. We return a function
-    that parses the data for us.
+    and dm_complex_names above. We return a function that parses
+    (or writes) the data for us.
     """
-    nicename, structchar, types = desc
-
     def dm_read_x(f, outdata=None):
-        """Reads (or write if outdata is given) a simple data type.
-        returns the data if reading and the number of bytes of header
-        """
-        if outdata is not None:  # this means we're WRITING to the file
-            if verbose:
-                print("dm_write start", structchar, outdata, "at", f.tell())
-            put_into_file(f, "<" + structchar, outdata)
-            if verbose:
-                print("dm_write end", f.tell())
-            return 0
-        else:
-            if verbose:
-                print("dm_read start", structchar, "at", f.tell())
-            result = get_from_file(f, "<" + structchar)
-            if verbose:
-                print("dm_read end", f.tell())
-            return result, 0
+        return DMFile(f).dm_read(datatype_num, outdata)
 
     return dm_read_x
 
 dm_types = {}
 for key, name, sc, types in dm_simple_names:
-    dm_types[key] = standard_dm_read(key, (name, sc, types))
-# 8 is boolean, and relatively easy:
+    dm_types[key] = standard_dm_read(key)
+for key in dm_complex_names:
+    dm_types[key] = standard_dm_read(key)
 
 
-def dm_read_bool(f, outdata=None):
-    if outdata:  # this means we're WRITING to the file
-        if verbose:
-            print("dm_write_bool start", f.tell())
-        put_into_file(f, "<b", 1 if outdata else 0)
-        if verbose:
-            print("dm_write_bool end", f.tell())
-        return 0
-    else:
-        if verbose:
-            print("dm_read_bool start", f.tell())
-        result = get_from_file(f, "<b")
-        if verbose:
-            print("dm_read_bool end", f.tell())
-        return result != 0, 0
-dm_types[get_dmtype_for_name('bool')] = dm_read_bool
-# string is 18:
+tag_layouts = dict()
 
 
-# mfm 2013-05-13 looks like this is never used, and all strings are
-# treated as array?
-def dm_read_string(f, outdata=None):
-    header_size = 1  # just a length field
-    if outdata is not None:  # this means we're WRITING to the file
-        if verbose:
-            print("dm_write_string start", f.tell())
-        outdata = outdata.encode("utf_16_le")
-        slen = len(outdata)
-        put_into_file(f, ">L", slen)
-        put_into_file(f, ">" + str(slen) + "s", str_to_iso8859_bytes(outdata))
-        if verbose:
-            print("dm_write_string end", f.tell())
-        return header_size
-    else:
-        assert(False)
-        if verbose:
-            print("dm_read_string start", f.tell())
-        slen = get_from_file(f, ">L")
-        raws = get_from_file(f, ">" + str(slen) + "s")
-        if verbose:
-            print("dm_read_string end", f.tell())
-        return u(raws, "utf_16_le"), header_size
+def tag_layout(field_types):
+    """Return the struct chars and (packed) size of one element made of the dm types field_types"""
+    field_types = tuple(field_types)
+    layout = tag_layouts.get(field_types)
+    if layout is None:
+        typecodes = [get_structchar_for_dmtype(t) for t in field_types]
+        # dm structs are packed, so use standard sizes and no alignment
+        layout = tag_layouts.setdefault(field_types, (typecodes, compiled_struct("<" + "".join(typecodes)).size))
+    return layout
 
-dm_types[get_dmtype_for_name('string')] = dm_read_string
 
+class DMTagData(object):
+    """
+    Index entry for a data tag. We store where the value starts in the file
+    and how it is laid out; the value is read by read().
+
+    data_type is the dm type of the tag (a simple type, struct or array).
+    For arrays element_type is the dm type of the elements (a simple type or
+    struct) and count the number of elements. field_types lists the dm types
+    of the struct fields for structs and arrays of structs, and holds the
+    single simple type otherwise.
+    """
+    def __init__(self, dm_file, offset, data_type, field_types, element_type=None, count=None):
+        self.dm_file = dm_file
+        self.offset = offset
+        self.data_type = data_type
+        self.field_types = field_types
+        self.element_type = element_type
+        self.count = count
+        self.typecodes, self.itemsize = tag_layout(field_types)
+        # the bytes of the value if they were kept when indexing
+        self.raw_bytes = None
 
-# struct is 15
-def dm_read_struct_types(f, outtypes=None):
-    if outtypes is not None:
-        _len, nfields = 0, len(outtypes)
-        put_into_file(f, "> l l", _len, nfields)
-        for t in outtypes:
-            _len = 0
-            put_into_file(f, "> l l", _len, t)
-        return 2+2*len(outtypes)
-    else:
-        types = []
-        _len, nfields = get_from_file(f, "> {size} {size}".format(size=size_type))
-        assert(_len == 0)  # is it always?
-        for i in range(nfields):
-            _len, dtype = get_from_file(f, "> {size} {size}".format(size=size_type))
-            types.append(dtype)
-            assert(_len == 0)
-            assert(dtype != 15)  # we don't allow structs of structs?
-        return types, 2+2*nfields
-
-
-def dm_read_struct(f, outdata=None):
-    if outdata is not None:  # this means we're WRITING to the file
-        if verbose:
-            print("dm_write_struct start", f.tell())
-        start = f.tell()
-        types = [get_structdmtypes_for_python_typeorobject(x)[1]
-                 for x in outdata]
-        header = dm_read_struct_types(f, types)
-        for t, data in zip(types, outdata):
-            dm_types[t](f, data)
-        # we write length at the very end
-        # but _len is probably not len, it's set to 0 for the
-        # file I'm trying...
-        write_len = False
-        if write_len:
-            end = f.tell()
-            f.seek(start)
-            # dm_read_struct first writes a length which we overwrite here
-            # I think the length ignores the length field (4 bytes)
-            put_into_file(f, "> l", end-start-4)
-            f.seek(0, 2)  # the very end (2 is pos from end)
-            assert(f.tell() == end)
-        if verbose:
-            print("dm_write_struct end", f.tell())
-        return header
-    else:
-        if verbose:
-            print("dm_read_struct start", f.tell())
-        types, header = dm_read_struct_types(f)
-        ret = []
-        for t in types:
-            d, h = dm_types[t](f)
-            ret.append(d)
-        if verbose:
-            print("dm_read_struct end", f.tell())
-        return tuple(ret), header
+    def __repr__(self):
+        return "DMTagData({}, {}, {}, {})".format(self.offset, self.data_type, self.field_types, self.count)
+
+    @property
+    def f(self):
+        return self.dm_file.f
+
+    @property
+    def byte_order(self):
+        return self.dm_file.byte_order
+
+    @property
+    def is_array(self):
+        return self.data_type == TAG_TYPE_ARRAY
+
+    @property
+    def nbytes(self):
+        return self.itemsize * (self.count if self.is_array else 1)
+
+    def read_bytes(self):
+        """Return the bytes of the value, reading them from the file if they were not kept"""
+        if self.raw_bytes is not None:
+            return self.raw_bytes
+        self.f.seek(self.offset)
+        return self.f.read(self.nbytes)
+
+    def read_buffer(self):
+        """Like read_bytes, but returns a new bytearray that numpy arrays can share"""
+        if self.raw_bytes is not None:
+            return bytearray(self.raw_bytes)
+        self.f.seek(self.offset)
+        return read_buffer(self.f, self.nbytes)
+
+    def decode(self, name=None, decode_arrays=False):
+        """
+        Read the value of the tag called name. Arrays of name tags are
+        returned as strings, see string_for_name_tag. If decode_arrays is
+        True, other ushort arrays are returned as strings too and other simple
+        arrays as lists (see DMTagGroup.to_python).
+        """
+        if self.is_array and self.element_type != TAG_TYPE_STRUCT:
+            typecode = self.typecodes[0]
+            if self.count and name and string_tag_names.match(name) or decode_arrays and typecode == 'H':
+                s = decode_string_bytes(self.read_bytes(), typecode, self.byte_order)
+                if s is not None:
+                    return s
+            if decode_arrays:
+                return self.read().tolist()
+        return string_for_name_tag(name, self.read())
+
+    def read(self):
+        """Read the value from the file. Returns the same types as parse_dm_tag_data"""
+        if self.is_array:
+            if self.element_type == TAG_TYPE_STRUCT:
+                ret = structarray(self.typecodes, self.byte_order)
+                ret.data = numpy.frombuffer(self.read_buffer(), ret.dtype)
+            else:
+                ret = array.array(self.typecodes[0])
+                if self.count:
+                    ret.frombytes(self.read_bytes())
+                    if self.byte_order != native_byte_order:
+                        ret.byteswap()
+            return ret
+        values = compiled_struct(self.byte_order + "".join(self.typecodes)).unpack(self.read_bytes())
+        values = tuple(v != 0 if t == TAG_TYPE_BOOL else v for t, v in zip(self.field_types, values))
+        if self.data_type == TAG_TYPE_STRUCT:
+            return values
+        return values[0]
+
+
+class DMTagGroup(object):
+    """
+    Index entry for a tag group (a dict once decoded) or a tag list (a list).
+    Indexing returns decoded values for data tags and DMTagGroup objects for
+    nested groups, so only what is accessed is read. Use to_python() to
+    decode the whole subtree into the dicts and lists parse_dm_header returns.
+    """
+    def __init__(self, offset, is_dict, entries):
+        self.offset = offset
+        self.is_dict = is_dict
+        self.__names = [name for name, tag in entries]
+        self.__tags = [tag for name, tag in entries]
+        # as in parse_dm_tag_root, a repeated name overrides the earlier tag
+        self.__indexes = {name: i for i, name in enumerate(self.__names)} if is_dict else None
 
-dm_types[get_dmtype_for_name('struct')] = dm_read_struct
+    def __repr__(self):
+        return "DMTagGroup({}, {}, {})".format(self.offset, self.is_dict, list(self.keys()))
 
+    def __len__(self):
+        return len(self.__indexes) if self.is_dict else len(self.__tags)
 
-# array is TAG_TYPE_ARRAY
-def dm_read_array(f, outdata=None):
-    array_header = 2  # type, length
-    if outdata is not None:  # this means we're WRITING to the file
-        if verbose:
-            print("dm_write_array start", f.tell())
-        if isinstance(outdata, structarray):
-            # we write type, struct_types, length
-            outdmtypes = [get_dmtype_for_structchar(s) for s in outdata.typecodes]
-            put_into_file(f, "> l", get_dmtype_for_name('struct'))
-            struct_header = dm_read_struct_types(f, outtypes=outdmtypes)
-            put_into_file(f, "> L", outdata.num_elements())
-            outdata.to_file(f)
-            if verbose:
-                print("dm_write_array1 end", f.tell())
-            return struct_header + array_header
-        elif isinstance(outdata, (str, unicode_type, array.array)):
-            if isinstance(outdata, (str, unicode_type)):
-                outdata = array.array('H', outdata.encode("utf_16_le"))
-            assert(isinstance(outdata, array.array))
-            dtype = get_dmtype_for_structchar(outdata.typecode)
-            if dtype < 0:
-                print("typecode %s" % outdata.typecode)
-            assert dtype >= 0
-            put_into_file(f, "> l", dtype)
-            put_into_file(f, "> L", int(len(outdata.tostring()) / struct.calcsize(outdata.typecode)))
-            if verbose:
-                print("dm_write_array2 end", dtype, len(outdata), outdata.typecode, f.tell())
-            if isinstance(f, file_type):
-                outdata.tofile(f)
-            else:
-                f.write(outdata.tostring())
-            if verbose:
-                print("dm_write_array3 end", f.tell())
-            return array_header
-        else:
-            logging.warn("Unsupported type for conversion to array:%s", outdata)
+    def __contains__(self, key):
+        return key in self.__indexes if self.is_dict else key in self.values()
 
-    else:
-        # supports arrays of structs and arrays of types,
-        # but not arrays of arrays (Is this possible)
-        # actually lets just use the array object, which only allows arrays of
-        # simple types!
-
-        # arrays of structs are pretty common, eg in a simple image CLUT
-        # data["DocumentObjectList"][0]["ImageDisplayInfo"]["CLUT"] is an
-        # array of 3 bytes
-        # we can't handle arrays of structs easily, as we use lists for
-        # taglists, dicts for taggroups and arrays for array data.
-        # But array.array only supports simple types. We need a new type, then.
-        # let's make a structarray
-        if verbose:
-            print("dm_read_array start", f.tell())
-        pos = f.tell()
-        dtype = get_from_file(f, "> {size}".format(size=size_type))
-        if dtype == get_dmtype_for_name('struct'):
-            types, struct_header = dm_read_struct_types(f)
-            # NB this was '> L', but changing to > {size}. May break things!
-            alen = get_from_file(f, "> {size}".format(size=size_type))
-            ret = structarray([get_structchar_for_dmtype(d) for d in types])
-            ret.from_file(f, alen)
-            if verbose:
-                print("dm_read_array1 end", f.tell())
-            return ret, array_header + struct_header
-        else:
-            # mfm 2013-08-02 struct.calcsize('l') is 4 on win and 8 on Mac!
-            # however >l, <l is 4 on both... could be a bug?
-            # Can we get around this by adding '>' to out structchar?
-            # nope, array only takes a sinlge char. Trying i, I instead
-            struct_char = get_structchar_for_dmtype(dtype)
-            ret = array.array(struct_char)
-            # NB this was '> L', but changing to > {size}. May break things!
-            alen = get_from_file(f, "> {size}".format(size=size_type))
-            if alen:
-                # faster to read <1024f than <f 1024 times. probly
-                # stype = "<" + str(alen) + dm_simple_names[dtype][1]
-                # ret = get_from_file(f, stype)
-                if verbose:
-                    print("dm_read_array2 end", dtype, alen, ret.typecode, f.tell())
-                if isinstance(f, file_type):
-                    ret.fromfile(f, alen)
+    def __iter__(self):
+        # iterate like the dict or list this group decodes to
+        return iter(self.keys()) if self.is_dict else iter(self.values())
+
+    def __getitem__(self, key):
+        index = self.__indexes[key] if self.is_dict else key
+        tag = self.__tags[index]
+        return tag if isinstance(tag, DMTagGroup) else tag.decode(self.__names[index])
+
+    def keys(self):
+        return list(self.__indexes.keys()) if self.is_dict else list(range(len(self.__tags)))
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def get(self, key, default=None):
+        if self.is_dict:
+            return self[key] if key in self.__indexes else default
+        return self[key] if -len(self.__tags) <= key < len(self.__tags) else default
+
+    def tag(self, key):
+        """Return the index entry (DMTagData or DMTagGroup) for key without decoding it"""
+        return self.__tags[self.__indexes[key] if self.is_dict else key]
+
+    def to_python(self, skip=(), decode_arrays=False):
+        """
+        Decode this group and everything below it. Index entries listed in
+        skip (e.g. a pixel data tag that is read separately) are left out.
+        If decode_arrays is True, arrays are decoded like
+        dm3_image_utils.fix_strings does, but straight from the file bytes
+        in the same pass: ushort arrays become strings, other simple arrays
+        lists. As there, anything under a 'Data' tag is left as it is.
+        """
+        values = list()
+        for name, tag in zip(self.__names, self.__tags):
+            if not any(tag is skip_tag for skip_tag in skip):
+                decode_tag_arrays = decode_arrays and name != 'Data'
+                if isinstance(tag, DMTagGroup):
+                    value = tag.to_python(skip, decode_tag_arrays)
                 else:
-                    ret.fromstring(f.read(alen*struct.calcsize(ret.typecode)))
-            # if dtype == get_dmtype_for_name('ushort'):
-            #     ret = ret.tostring().decode("utf-16")
-            if verbose:
-                print("dm_read_array3 end", f.tell())
-            return ret, array_header
+                    value = tag.decode(name, decode_tag_arrays)
+                values.append((name, value))
+        if self.is_dict:
+            return dict(values)
+        return [value for name, value in values]
+
+    # path queries. A path names the groups from here down to a tag, separated
+    # by '/', with list entries given by their index:
+    # "ImageList/1/ImageTags/ImageScanned/EHT". Only what the query reaches is
+    # read, and only the matched values are decoded.
+
+    def find(self, path):
+        """
+        Return the index entry (DMTagData or DMTagGroup) at path (a string
+        or a sequence of names and indexes). Raises KeyError if there is none.
+        """
+        tag = self
+        for component in split_tag_path(path):
+            if not isinstance(tag, DMTagGroup):
+                raise KeyError(path)
+            try:
+                tag = tag.tag(component if tag.is_dict else int(component))
+            except (KeyError, IndexError, ValueError):
+                raise KeyError(path)
+        return tag
+
+    def lookup(self, path, default=None, decode_arrays=True):
+        """
+        Return the decoded value at path, or default if there is none.
+        Groups are decoded with to_python. By default arrays are decoded as
+        load_image decodes them (strings and lists, see to_python).
+        """
+        try:
+            tag = self.find(path)
+        except KeyError:
+            return default
+        components = split_tag_path(path)
+        return decode_tag(tag, components[-1] if components else None, decode_arrays)
+
+    def glob(self, pattern, decode_arrays=True):
+        """
+        Return a list of (path, value) for the tags matching pattern, a path
+        in which components may contain the fnmatch wildcards *, ? and [...]
+        (e.g. "ImageList/*/ImageTags/*/EHT"); a component ** matches any
+        number of levels ("**/EHT" finds EHT anywhere). Values are decoded as
+        by lookup.
+        """
+        results = list()
+        self.__glob(split_tag_path(pattern), list(), decode_arrays, results)
+        return results
+
+    def __glob(self, components, path, decode_arrays, results):
+        if not components:
+            return
+        component, rest = components[0], components[1:]
+        if component == "**":
+            # zero levels, or one level and still in a **
+            self.__glob(rest, path, decode_arrays, results)
+            for key, name, tag in self.__entries():
+                if isinstance(tag, DMTagGroup):
+                    tag.__glob(components, path + [str(key)], decode_arrays, results)
+                elif not rest:
+                    results.append(("/".join(path + [str(key)]), decode_tag(tag, name, decode_arrays)))
+            return
+        for key, name, tag in self.__entries():
+            if fnmatch.fnmatchcase(str(key), component):
+                if not rest:
+                    results.append(("/".join(path + [str(key)]), decode_tag(tag, name, decode_arrays)))
+                elif isinstance(tag, DMTagGroup):
+                    tag.__glob(rest, path + [str(key)], decode_arrays, results)
+
+    def __entries(self):
+        # (key, name, tag) of the entries, as keys() sees them
+        if self.is_dict:
+            return [(name, name, self.__tags[i]) for name, i in self.__indexes.items()]
+        return [(i, name, tag) for i, (name, tag) in enumerate(zip(self.__names, self.__tags))]
+
+
+def split_tag_path(path):
+    """Return the components of a tag path, a '/' separated string or a sequence"""
+    if isinstance(path, str):
+        return [component for component in path.split("/") if component]
+    return list(path)
+
+
+def decode_tag(tag, name, decode_arrays):
+    """Decode the index entry tag called name like DMTagGroup.to_python does"""
+    decode_arrays = decode_arrays and name != 'Data'
+    if isinstance(tag, DMTagGroup):
+        return tag.to_python(decode_arrays=decode_arrays)
+    return tag.decode(name, decode_arrays)
 
-dm_types[get_dmtype_for_name('array')] = dm_read_array
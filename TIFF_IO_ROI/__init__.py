@@ -6,6 +6,8 @@
     files created with imagej or files that were exported with Nion Swift.
     Files exported with Nion Swift will keep their metadata when exported. This metadata will also be restored on re-import.
     Currently the support is limited to greyscale/rgb(a) data of 1 to 4 dimensions.
+    Exports that do not fit into a classic (4 GB) tif file are written as BigTIFF. These keep the imagej metadata, but
+    only Fiji (not ImageJ itself) can open them, and tifffile warns about this when they are written.
 
 """
 
@@ -21,6 +23,7 @@ with warnings.catch_warnings():
 import numpy
 import datetime
 import json
+import struct
 from . import write_ij_metadata
 
 # local libraries
@@ -32,6 +35,39 @@ _ = gettext.gettext
 
 NION_TAG = 'nion.1'
 
+# offsets in classic TIFF files are unsigned 32 bit integers
+CLASSIC_TIFF_LIMIT = 2**32 - 1
+
+
+def estimate_tiff_size(shape, dtype, metadata, extratags):
+    """
+    Return an upper estimate of the size of the TIFF file write_tiff writes for data of the 6d (TZCYXS) shape and
+    dtype: the image data, an IFD with the extratags for every image plane and the description with the metadata.
+    """
+    planes = int(numpy.prod(shape[:3]))
+    data_size = int(numpy.prod(shape)) * numpy.dtype(dtype).itemsize
+    extratags_size = sum(tag[2] * struct.calcsize(tag[1]) for tag in extratags)
+    description_size = len(json.dumps(metadata)) + 1024
+    return data_size + planes * (1024 + extratags_size) + description_size
+
+
+def write_tiff(file_path, data, dtype, channel_order=None, bigtiff=False, imagej=False, software=None, **kwargs):
+    """
+    Write the 6d (TZCYXS) array data to file_path like tifffile.imsave, in big endian byte order.
+    The data is written in chunks along the first of its T, Z and C axes longer than 1 (tifffile stores consecutive
+    chunks contiguously and updates the image description with the full shape), so only one chunk at a time is
+    converted to dtype, reordered to channel_order (if not None) and byte swapped. kwargs are passed to
+    TiffWriter.save.
+    """
+    axis = next((i for i, n in enumerate(data.shape[:3]) if n > 1), None)
+    chunks = [data] if axis is None else data.reshape(data.shape[axis:])
+    photometric = 'rgb' if data.shape[-1] in (3, 4) else 'minisblack'
+    with tifffile.TiffWriter(file_path, bigtiff=bigtiff, byteorder='>', software=software, imagej=imagej) as tif:
+        for chunk in chunks:
+            if channel_order is not None:
+                chunk = chunk[..., channel_order]
+            tif.save(numpy.asarray(chunk, dtype), photometric=photometric, **kwargs)
+
 
 class TIFFIODelegate(object):
 
@@ -269,20 +305,21 @@ class TIFFIODelegate(object):
             # TODO: support data that is a sequence AND a collection
 
             # create shape that is used for tif so that array is interpreted correctly by imagej
-            tifffile_shape = numpy.ones(6, dtype=numpy.int)
+            tifffile_shape = numpy.ones(6, dtype=int)
 
             # last data axis depends on whether data is rgb(a) or not
             last_data_axis = -1
 
-            # check and adapt for rgb(a) data
+            # check and adapt for rgb(a) data, the channels are reordered while writing
+            channel_order = None
             if data_and_metadata.is_data_rgb:
-                data = data[...,(2, 1, 0)]
+                channel_order = (2, 1, 0)
                 data_shape = data_shape[:-1]
                 tifffile_shape[-1] = 3
                 last_data_axis = -2
             if data_and_metadata.is_data_rgba:
                 data_shape = data_shape[:-1]
-                data = data[...,(2, 1, 0, 3)]
+                channel_order = (2, 1, 0, 3)
                 tifffile_shape[-1] = 4
                 last_data_axis = -2
 
@@ -352,6 +389,7 @@ class TIFFIODelegate(object):
             if unit is not None:
                 tifffile_metadata['unit'] = unit
 
+            # only adds length-1 axes, so this is a view of the data
             data = data.reshape(tuple(tifffile_shape))
 
             # Create ROI metadata for imagej if tractor_beam beam position is in metadata
@@ -371,14 +409,18 @@ class TIFFIODelegate(object):
 
             tifffile_metadata['version'] = '1.51j'
             # Change dtype if necessary to make tif compatible with imagej
-            if not data.dtype in [numpy.float32, numpy.uint8, numpy.uint16]:
-                data = data.astype(numpy.float32)
+            dtype = data.dtype
+            if not dtype in [numpy.float32, numpy.uint8, numpy.uint16]:
+                dtype = numpy.dtype(numpy.float32)
+            # Files that do not fit into 4 GB are written as BigTIFF (which ImageJ itself cannot read, but Fiji can).
+            # The imagej metadata is kept for Fiji, so tifffile warns about writing an "incompatible bigtiff ImageJ".
+            bigtiff = estimate_tiff_size(data.shape, dtype, tifffile_metadata, extratags) > CLASSIC_TIFF_LIMIT
             try:
-                tifffile.imsave(file_path, data, resolution=resolution, imagej=True, metadata=tifffile_metadata,
-                                software='Nion Swift', byteorder='>', extratags=extratags)
+                write_tiff(file_path, data, dtype, channel_order, bigtiff=bigtiff, imagej=True, software='Nion Swift',
+                           resolution=resolution, metadata=tifffile_metadata, extratags=extratags)
             except Exception as detail:
-                tifffile.imsave(file_path, data, resolution=resolution, metadata=tifffile_metadata, byteorder='>',
-                                extratags=extratags)
+                write_tiff(file_path, data, dtype, channel_order, bigtiff=bigtiff, resolution=resolution,
+                           metadata=tifffile_metadata, extratags=extratags)
                 logging.warn('Could not save metadata in tiff. Reason: ' + str(detail))
 
     def extract_data_element_dict_from_data_and_metadata(self, data_and_metadata):
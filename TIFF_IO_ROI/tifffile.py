@@ -258,11 +258,14 @@ import math
 import zlib
 import time
 import json
+import queue
 import struct
 import warnings
 import tempfile
 import datetime
+import threading
 import collections
+import concurrent.futures
 from fractions import Fraction
 from xml.etree import cElementTree as etree
 
@@ -292,6 +295,7 @@ __version__ = '2016.10.28'
 __docformat__ = 'restructuredtext en'
 __all__ = (
     'imsave', 'imread', 'imshow', 'TiffFile', 'TiffWriter', 'TiffSequence',
+    'TiffBackgroundWriter',
     # utility functions used in oiffile and czifile
     'FileHandle', 'lazyattr', 'natural_sorted', 'decode_lzw', 'stripnull')
 
@@ -312,8 +316,9 @@ def imsave(file, data, **kwargs):
         Parameters 'byteorder', 'bigtiff', 'software', and 'imagej', are passed
         to the TiffWriter class.
         Parameters 'photometric', 'planarconfig', 'resolution', 'compress',
-        'colormap', 'tile', 'description', 'datetime', 'metadata', 'contiguous'
-        and 'extratags' are passed to the TiffWriter.save function.
+        'colormap', 'tile', 'description', 'datetime', 'metadata',
+        'contiguous', 'extratags', 'subfiletype', 'pyramid', 'rowsperstrip',
+        and 'maxworkers' are passed to the TiffWriter.save function.
 
     Examples
     --------
@@ -444,7 +449,8 @@ class TiffWriter(object):
     def save(self, data, photometric=None, planarconfig=None, tile=None,
              contiguous=True, compress=0, colormap=None,
              description=None, datetime=None, resolution=None,
-             metadata={}, extratags=()):
+             metadata={}, extratags=(), subfiletype=0, pyramid=0,
+             rowsperstrip=None, maxworkers=1):
         """Write image data and tags to TIFF file.
 
         Image data are written in one stripe per plane by default.
@@ -484,12 +490,13 @@ class TiffWriter(object):
             previous ones, if any, the data are stored contiguously after
             the previous one. Parameters 'photometric' and 'planarconfig' are
             ignored.
-        compress : int or 'lzma'
+        compress : int, 'lzma', or 'packbits'
             Values from 0 to 9 controlling the level of zlib compression.
             If 0, data are written uncompressed (default).
             Compression cannot be used to write contiguous files.
             If 'lzma', LZMA compression is used, which is not available on
             all platforms.
+            If 'packbits', PackBits run-length encoding is used.
         colormap : numpy.ndarray
             RGB color values for the corresponding data value.
             Must be of shape (3, 2**(data.itemsize*8)) and dtype uint16.
@@ -522,6 +529,24 @@ class TiffWriter(object):
                 'Count' values compatible with 'dtype'.
             writeonce : bool
                 If True, the tag is written to the first page only.
+        subfiletype : int
+            Bitfield of the new_subfile_type tag. 1: reduced resolution
+            version of another image, 2: page of a multi-page image,
+            4: transparency mask. Default: 0.
+        pyramid : int
+            Number of reduced resolution levels to write after the image.
+            Each level is half the size of the previous one, computed as
+            the mean of 2x2 blocks (palette images are subsampled), and is
+            saved as a page with subfile type 1, using the same
+            compression and tiling. See TiffPage.levels.
+            Only single images can be saved with pyramid levels.
+        rowsperstrip : int
+            The number of rows per strip of images that are not tiled.
+            By default, image data are written in one strip per plane.
+        maxworkers : int or None
+            Maximum number of threads that compress strips or tiles.
+            If None, one thread per CPU is used. Default: 1.
+            The compressed chunks are written in order.
 
         """
         # TODO: refactor this function
@@ -543,7 +568,7 @@ class TiffWriter(object):
                     self._data_shape[1:] != data.shape or
                     self._data_dtype != data.dtype or
                     (compress and self._tags) or
-                    tile or
+                    tile or pyramid or subfiletype or
                     not numpy.array_equal(colormap, self._colormap)):
                 # incompatible shape, dtype, compression mode, or colormap
                 self._write_remaining_pages()
@@ -568,6 +593,9 @@ class TiffWriter(object):
             raise ValueError("invalid photometric %s" % photometric)
         if planarconfig not in (None, 'contig', 'planar'):
             raise ValueError("invalid planarconfig %s" % planarconfig)
+        if pyramid and self._imagej:
+            raise ValueError("ImageJ does not support pyramid levels")
+        level_compress = compress
 
         # prepare compression
         if not compress:
@@ -578,6 +606,11 @@ class TiffWriter(object):
             compress_tag = 34925
             if self._imagej:
                 raise ValueError("ImageJ can not handle LZMA compression")
+        elif compress == 'packbits':
+            def compress(data):
+                # rows of width * samples
+                return encode_packbits(data.reshape(data.shape[:-2] + (-1,)))
+            compress_tag = 32773
         elif not 0 <= compress <= 9:
             raise ValueError("invalid compression level %s" % compress)
         elif compress:
@@ -729,6 +762,9 @@ class TiffWriter(object):
         if photometric == 'rgb' and samplesperpixel == 2:
             raise ValueError("not a RGB image (samplesperpixel=2)")
 
+        if pyramid and shape[0] != 1:
+            raise ValueError("pyramid levels require a single image")
+
         bytestr = bytes if sys.version[0] == '2' else (
             lambda x: bytes(x, 'utf-8') if isinstance(x, str) else x)
         tags = []  # list of (code, ifdentry, ifdvalue, writeonce)
@@ -834,7 +870,7 @@ class TiffWriter(object):
             if tile[0] > 1:
                 addtag('image_depth', 'I', 1, shape[-4])
                 addtag('tile_depth', 'I', 1, tile[0])
-        addtag('new_subfile_type', 'I', 1, 0)
+        addtag('new_subfile_type', 'I', 1, subfiletype)
         addtag('sample_format', 'H', 1,
                {'u': 1, 'i': 2, 'f': 3, 'c': 6}[data.dtype.kind])
         addtag('photometric', 'H', 1, {'miniswhite': 0, 'minisblack': 1,
@@ -865,7 +901,10 @@ class TiffWriter(object):
                 resolution_unit = 2
             addtag('resolution_unit', 'H', 1, resolution_unit)
         if not tile:
-            addtag('rows_per_strip', 'I', 1, shape[-3])  # * shape[-4]
+            if rowsperstrip is None:
+                rowsperstrip = shape[-3]  # * shape[-4]
+            rowsperstrip = max(1, min(int(rowsperstrip), shape[-3]))
+            addtag('rows_per_strip', 'I', 1, rowsperstrip)
 
         if tile:
             # use one chunk per tile per plane
@@ -877,14 +916,40 @@ class TiffWriter(object):
                 product(tile) * shape[-1] * data.dtype.itemsize] * numtiles
             addtag(tag_byte_counts, offset_format, numtiles, strip_byte_counts)
             addtag(tag_offsets, offset_format, numtiles, [0] * numtiles)
-            # allocate tile buffer
-            chunk = numpy.empty(tile + (shape[-1],), dtype=data.dtype)
+
+            def chunks(pageindex):
+                # tiles of page in order, padded with zeros at the edges
+                for plane in data[pageindex]:
+                    for tz in range(tiles[0]):
+                        for ty in range(tiles[1]):
+                            for tx in range(tiles[2]):
+                                chunk = plane[tz*tile[0]:(tz+1)*tile[0],
+                                              ty*tile[1]:(ty+1)*tile[1],
+                                              tx*tile[2]:(tx+1)*tile[2]]
+                                if chunk.shape[:3] != tile:
+                                    padded = numpy.zeros(
+                                        tile + (shape[-1],), data.dtype)
+                                    padded[:chunk.shape[0], :chunk.shape[1],
+                                           :chunk.shape[2]] = chunk
+                                    chunk = padded
+                                yield numpy.ascontiguousarray(chunk)
         else:
-            # use one strip per plane
-            strip_byte_counts = [
-                data[0, 0].size * data.dtype.itemsize] * shape[1]
-            addtag(tag_byte_counts, offset_format, shape[1], strip_byte_counts)
-            addtag(tag_offsets, offset_format, shape[1], [0] * shape[1])
+            # use one strip per rowsperstrip rows of each plane
+            numstrips = (shape[-3] + rowsperstrip - 1) // rowsperstrip
+            row_size = data[0, 0, 0, 0].size * data.dtype.itemsize
+            strip_byte_counts = shape[1] * (
+                [rowsperstrip * row_size] * (numstrips - 1) +
+                [(shape[-3] - (numstrips - 1) * rowsperstrip) * row_size])
+            numstrips *= shape[1]
+            addtag(tag_byte_counts, offset_format, numstrips,
+                   strip_byte_counts)
+            addtag(tag_offsets, offset_format, numstrips, [0] * numstrips)
+
+            def chunks(pageindex):
+                # strips of page in order
+                for plane in data[pageindex]:
+                    for row in range(0, shape[-3], rowsperstrip):
+                        yield plane[:, row:row+rowsperstrip]
 
         # add extra tags from user
         for t in extratags:
@@ -936,32 +1001,16 @@ class TiffWriter(object):
             # write image data
             data_offset = fh.tell()
             if compress:
+                # chunks are compressed in parallel and written in order
                 strip_byte_counts = []
-            if tile:
-                for plane in data[pageindex]:
-                    for tz in range(tiles[0]):
-                        for ty in range(tiles[1]):
-                            for tx in range(tiles[2]):
-                                c0 = min(tile[0], shape[2] - tz*tile[0])
-                                c1 = min(tile[1], shape[3] - ty*tile[1])
-                                c2 = min(tile[2], shape[4] - tx*tile[2])
-                                chunk[c0:, c1:, c2:] = 0
-                                chunk[:c0, :c1, :c2] = plane[
-                                    tz*tile[0]:tz*tile[0]+c0,
-                                    ty*tile[1]:ty*tile[1]+c1,
-                                    tx*tile[2]:tx*tile[2]+c2]
-                                if compress:
-                                    t = compress(chunk)
-                                    strip_byte_counts.append(len(t))
-                                    fh.write(t)
-                                else:
-                                    fh.write_array(chunk)
-                                    fh.flush()
-            elif compress:
-                for plane in data[pageindex]:
-                    plane = compress(plane)
-                    strip_byte_counts.append(len(plane))
-                    fh.write(plane)
+                for chunk in parallel_map(compress, chunks(pageindex),
+                                          maxworkers):
+                    strip_byte_counts.append(len(chunk))
+                    fh.write(chunk)
+            elif tile:
+                for chunk in chunks(pageindex):
+                    fh.write_array(chunk)
+                fh.flush()
             else:
                 fh.write_array(data)
 
@@ -1007,6 +1056,34 @@ class TiffWriter(object):
         self._data_offset = data_offset
         self._data_byte_counts = strip_byte_counts
 
+        # write reduced resolution levels as pages following the image
+        level = data
+        for _ in range(pyramid):
+            if shape[3] == 1 and shape[4] == 1:
+                break
+            if colormap is not None:
+                level = level[:, :, :, ::2, ::2, :]
+            else:
+                level = block_mean(level, 2, axes=(3, 4))
+            shape = level.shape
+            if planarconfig == 'planar':
+                level_shape = shape[1:5] if volume else shape[1:2]+shape[3:5]
+            elif planarconfig == 'contig':
+                level_shape = shape[2:] if volume else shape[3:]
+            else:
+                level_shape = shape[2:5] if volume else shape[3:5]
+            if resolution:
+                resolution = tuple(
+                    (r[0], r[1] * 2) if isinstance(r, (tuple, list)) else r/2
+                    for r in resolution[:2]) + tuple(resolution[2:])
+            self.save(level.reshape(level_shape), photometric=photometric,
+                      planarconfig=planarconfig,
+                      tile=tile if volume else tile[1:],
+                      contiguous=False, compress=level_compress,
+                      colormap=colormap, datetime=datetime,
+                      resolution=resolution, metadata=None, subfiletype=1,
+                      rowsperstrip=rowsperstrip, maxworkers=maxworkers)
+
     def _write_remaining_pages(self):
         """Write outstanding IFDs and tags to file."""
         if not self._tags:
@@ -1131,6 +1208,241 @@ class TiffWriter(object):
         self.close()
 
 
+class TiffBackgroundWriter(object):
+    """Write images to TIFF file in a background thread.
+
+    Images passed to save are put in a bounded queue and written in order
+    by a dedicated thread using TiffWriter.save, so that the calling thread,
+    e.g. a camera acquisition loop, does not block on disk writes.
+    While one image is written, up to 'maxqueue' more can be queued.
+
+    Errors raised in the writer thread stop the writer and are raised again
+    by every later call to save, flush, or close. If a with block is left by
+    an exception, queued images are discarded and writer errors suppressed.
+
+    >>> with TiffBackgroundWriter('temp.tif', maxqueue=4) as tif:
+    ...     for i in range(8):
+    ...         _ = tif.save(numpy.zeros((301, 219), 'uint16'), compress=6)
+    >>> tif.metrics['frames_written']
+    8
+
+    """
+    OVERFLOW = ('block', 'drop', 'drop_oldest', 'raise')
+
+    def __init__(self, file, maxqueue=16, overflow='block', copy=True,
+                 **kwargs):
+        """Open TIFF file for writing and start writer thread.
+
+        Parameters
+        ----------
+        file : str, binary stream, or FileHandle
+            File name or writable binary stream, passed to TiffWriter.
+        maxqueue : int
+            Maximum number of images waiting to be written.
+        overflow : {'block', 'drop', 'drop_oldest', 'raise'}
+            What save does if the queue is full:
+            'block': wait until the writer thread made room (default).
+            'drop': discard the new image.
+            'drop_oldest': discard the oldest image in the queue.
+            'raise': raise queue.Full.
+        copy : bool
+            If True (default), images are copied before save returns, so
+            the caller may reuse its buffers.
+        kwargs : dict
+            Parameters 'bigtiff', 'byteorder', 'software', and 'imagej' are
+            passed to the TiffWriter class.
+
+        """
+        if overflow not in self.OVERFLOW:
+            raise ValueError("invalid overflow policy %s" % overflow)
+        if maxqueue < 1:
+            raise ValueError("invalid queue size %s" % maxqueue)
+        self._writer = TiffWriter(file, **kwargs)
+        self._maxqueue = int(maxqueue)
+        self._overflow = overflow
+        self._copy = copy
+        self._queue = collections.deque()
+        self._condition = threading.Condition()
+        self._writing = False
+        self._closed = False
+        self._error = None
+
+        self._frames_written = 0
+        self._frames_dropped = 0
+        self._bytes_written = 0
+        self._write_time = 0.0
+        self._latency = 0.0
+        self._max_latency = 0.0
+        self._max_queue_depth = 0
+
+        self._thread = threading.Thread(target=self._run,
+                                        name='TiffBackgroundWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, data, timeout=None, **kwargs):
+        """Queue image data to be written with TiffWriter.save.
+
+        Return False if the image was dropped because the queue is full,
+        else True.
+
+        Parameters
+        ----------
+        data : numpy.ndarray
+            Input image, see TiffWriter.save.
+        timeout : float
+            Maximum time in seconds to wait for room in a full queue if the
+            overflow policy is 'block'. If exceeded, queue.Full is raised.
+            If None (default), wait as long as needed.
+        kwargs : dict
+            Parameters passed to TiffWriter.save.
+
+        """
+        data = numpy.array(data) if self._copy else numpy.asarray(data)
+        with self._condition:
+            self._raise_error()
+            if self._closed:
+                raise ValueError("writer is closed")
+            if len(self._queue) >= self._maxqueue:
+                if self._overflow == 'block':
+                    if not self._condition.wait_for(
+                            lambda: (len(self._queue) < self._maxqueue or
+                                     self._error is not None),
+                            timeout):
+                        raise queue.Full("writer queue is full")
+                    self._raise_error()
+                elif self._overflow == 'drop':
+                    self._frames_dropped += 1
+                    return False
+                elif self._overflow == 'drop_oldest':
+                    self._queue.popleft()
+                    self._frames_dropped += 1
+                else:
+                    raise queue.Full("writer queue is full")
+            self._queue.append((data, kwargs, time.perf_counter()))
+            self._max_queue_depth = max(self._max_queue_depth,
+                                        len(self._queue))
+            self._condition.notify_all()
+        return True
+
+    def flush(self, timeout=None):
+        """Wait until all queued images are written.
+
+        Return False if the timeout expired, else True.
+
+        """
+        with self._condition:
+            done = self._condition.wait_for(
+                lambda: ((not self._queue and not self._writing) or
+                         self._error is not None),
+                timeout)
+            self._raise_error()
+        return done
+
+    @property
+    def queue_depth(self):
+        """Return number of images waiting to be written."""
+        with self._condition:
+            return len(self._queue)
+
+    @property
+    def metrics(self):
+        """Return dict of writer statistics.
+
+        queue_depth, max_queue_depth : int
+            Current and largest number of images waiting to be written.
+        frames_written, frames_dropped : int
+            Number of images written to file and discarded on overflow.
+        bytes_written : int
+            Size of the written image data.
+        bytes_per_second : float
+            Image data written per second spent writing.
+        write_latency, max_write_latency : float
+            Mean and largest time in seconds from save until the image was
+            written.
+
+        """
+        with self._condition:
+            frames = self._frames_written
+            return {
+                'queue_depth': len(self._queue),
+                'max_queue_depth': self._max_queue_depth,
+                'frames_written': frames,
+                'frames_dropped': self._frames_dropped,
+                'bytes_written': self._bytes_written,
+                'bytes_per_second': (self._bytes_written / self._write_time
+                                     if self._write_time else 0.0),
+                'write_latency': self._latency / frames if frames else 0.0,
+                'max_write_latency': self._max_latency}
+
+    def close(self, truncate=False):
+        """Write queued images (if not truncate), stop thread, close file."""
+        with self._condition:
+            if self._closed:
+                self._raise_error()
+                return
+            self._closed = True
+            if truncate:
+                self._frames_dropped += len(self._queue)
+                self._queue.clear()
+            self._condition.notify_all()
+        self._thread.join()
+        self._writer.close(truncate)
+        with self._condition:
+            self._raise_error()
+
+    def _run(self):
+        """Write queued images until the writer is closed."""
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._queue or self._closed)
+                if not self._queue:
+                    return
+                data, kwargs, queued = self._queue.popleft()
+                self._writing = True
+                self._condition.notify_all()
+            start = time.perf_counter()
+            try:
+                self._writer.save(data, **kwargs)
+            except Exception as e:
+                with self._condition:
+                    self._error = e
+                    self._writing = False
+                    self._frames_dropped += len(self._queue) + 1
+                    self._queue.clear()
+                    self._condition.notify_all()
+                return
+            end = time.perf_counter()
+            with self._condition:
+                self._writing = False
+                self._frames_written += 1
+                self._bytes_written += data.nbytes
+                self._write_time += end - start
+                self._latency += end - queued
+                self._max_latency = max(self._max_latency, end - queued)
+                self._condition.notify_all()
+            del data
+
+    def _raise_error(self):
+        """Raise exception of writer thread, if any."""
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # do not write queued images or replace the exception being raised
+        try:
+            self.close(truncate=True)
+        except Exception:
+            pass
+
+
 def imread(files, **kwargs):
     """Return image data from TIFF file(s) as numpy array.
 
@@ -1208,8 +1520,8 @@ class TiffFile(object):
 
     Attributes
     ----------
-    pages : list of TiffPage
-        All TIFF pages in file.
+    pages : TiffPages
+        All TIFF pages in file, read on first access.
     series : list of TiffPageSeries
         TIFF pages with compatible shapes and types.
     micromanager_metadata: dict
@@ -1312,19 +1624,12 @@ class TiffFile(object):
             self.offset_size = 4
         else:
             raise ValueError("not a TIFF file")
-        self.pages = []
-        while True:
-            try:
-                page = TiffPage(self)
-                self.pages.append(page)
-            except StopIteration:
-                break
-            if maxpages and len(self.pages) > maxpages:
-                break
-            if fastij:
-                if page._patch_imagej():
-                    break  # only read the first page of ImageJ files
-                fastij = False
+        # pages are parsed on first access, only their offsets are read here
+        self.pages = TiffPages(self)
+        if fastij and self.pages and self.pages[0]._patch_imagej():
+            pass  # only read the first page of ImageJ files
+        else:
+            self.pages._index_ifds(maxpages)
 
         if not self.pages:
             raise ValueError("empty TIFF file")
@@ -1382,7 +1687,8 @@ class TiffFile(object):
                 page.strip_byte_counts = tuple(
                     strips[offset] for offset in page.strip_offsets)
 
-    def asarray(self, key=None, series=None, memmap=False, tempdir=None):
+    def asarray(self, key=None, series=None, memmap=False, tempdir=None,
+                maxworkers=1):
         """Return image data from multiple TIFF pages as numpy array.
 
         By default the first image series is returned.
@@ -1399,6 +1705,9 @@ class TiffFile(object):
             file is created.
         tempdir : str
             The directory where the memory-mapped file will be created.
+        maxworkers : int or None
+            Maximum number of threads that decode the strips or tiles of
+            a page. See TiffPage.asarray.
 
         """
         if key is None and series is None:
@@ -1428,13 +1737,15 @@ class TiffFile(object):
 
         if self.is_nih:
             if pages[0].is_indexed:
-                result = stack_pages(pages, colormapped=False, squeeze=False)
+                result = stack_pages(pages, colormapped=False, squeeze=False,
+                                     maxworkers=maxworkers)
                 result = apply_colormap(result, pages[0].color_map)
             else:
                 result = stack_pages(pages, memmap=memmap, tempdir=tempdir,
-                                     colormapped=False, squeeze=False)
+                                     colormapped=False, squeeze=False,
+                                     maxworkers=maxworkers)
         elif len(pages) == 1:
-            result = pages[0].asarray(memmap=memmap)
+            result = pages[0].asarray(memmap=memmap, maxworkers=maxworkers)
         elif self.is_ome:
             assert not self.is_indexed, "color mapping disabled for ome-tiff"
             if any(p is None for p in pages):
@@ -1473,7 +1784,7 @@ class TiffFile(object):
                 keep.open(page)
                 if page:
                     a = page.asarray(memmap=False, colormapped=False,
-                                     reopen=False)
+                                     reopen=False, maxworkers=maxworkers)
                 else:
                     a = nopage
                 try:
@@ -1492,7 +1803,8 @@ class TiffFile(object):
                 result = self.filehandle.read_array(
                     series.dtype, product(series.shape))
         else:
-            result = stack_pages(pages, memmap=memmap, tempdir=tempdir)
+            result = stack_pages(pages, memmap=memmap, tempdir=tempdir,
+                                 maxworkers=maxworkers)
 
         if key is None:
             try:
@@ -1903,6 +2215,125 @@ class TiffFile(object):
         return len(self.pages) and self.pages[0].is_tvips
 
 
+class TiffPages(object):
+    """Sequence of TIFF pages that are read from file on first access.
+
+    Only the offsets of the IFDs are read when the page list is indexed,
+    by following the chain of IFDs and skipping their tags. TiffPage
+    instances are created and cached when they are accessed.
+
+    """
+    def __init__(self, parent):
+        """Initialize instance with the first IFD of parent's file.
+
+        File cursor must be at storage position of first IFD offset.
+
+        """
+        self.parent = parent
+        self._offsets = []
+        self._pages = []
+        self._indexed = False
+        offset = self._read_offset()
+        if offset and self._read_numtags(offset) is not None:
+            self._offsets.append(offset)
+            self._pages.append(None)
+
+    def _read_offset(self):
+        """Return IFD offset at file cursor or 0 if invalid."""
+        fh = self.parent.filehandle
+        offset_size = self.parent.offset_size
+        fmt = {4: 'I', 8: 'Q'}[offset_size]
+        offset = struct.unpack(self.parent.byteorder + fmt,
+                               fh.read(offset_size))[0]
+        if offset >= fh.size:
+            warnings.warn("invalid page offset > file size")
+            return 0
+        return offset
+
+    def _read_numtags(self, offset):
+        """Return number of tags in IFD at offset or None if corrupted."""
+        fh = self.parent.filehandle
+        fmt, size = {4: ('H', 2), 8: ('Q', 8)}[self.parent.offset_size]
+        fh.seek(offset)
+        try:
+            numtags = struct.unpack(self.parent.byteorder + fmt,
+                                    fh.read(size))[0]
+            if numtags > 4096:
+                raise ValueError("suspicious number of tags")
+        except Exception:
+            warnings.warn("corrupted page list at offset %i" % offset)
+            return None
+        return numtags
+
+    def _index_ifds(self, maxpages=None):
+        """Read offsets of all IFDs following the first IFD."""
+        if self._indexed or not self._offsets:
+            return
+        offset_size = self.parent.offset_size
+        size, tagsize = {4: (2, 12), 8: (8, 20)}[offset_size]
+        seen = set(self._offsets)
+        offset = self._offsets[-1]
+        numtags = self._read_numtags(offset)
+        while not (maxpages and len(self._offsets) > maxpages):
+            self.parent.filehandle.seek(offset + size + numtags * tagsize)
+            offset = self._read_offset()
+            if not offset:
+                break
+            if offset in seen:
+                warnings.warn("circular page list at offset %i" % offset)
+                break
+            numtags = self._read_numtags(offset)
+            if numtags is None:
+                break
+            seen.add(offset)
+            self._offsets.append(offset)
+            self._pages.append(None)
+        self._indexed = True
+
+    def _page(self, index):
+        """Return TiffPage at index, reading it from file if necessary."""
+        page = self._pages[index]
+        if page is None:
+            # processing the tags may access this page through the parent,
+            # e.g. TiffFile.is_lsm, so it is cached before it is initialized
+            page = self._pages[index] = TiffPage.__new__(TiffPage)
+            # pages can be accessed after the file was closed
+            fh = self.parent.filehandle
+            closed = fh.closed
+            if closed:
+                fh.open()
+            try:
+                page.__init__(self.parent, index=index,
+                              offset=self._offsets[index])
+            except Exception:
+                self._pages[index] = None
+                raise
+            finally:
+                if closed:
+                    fh.close()
+        return page
+
+    def __len__(self):
+        """Return number of pages in file."""
+        return len(self._offsets)
+
+    def __getitem__(self, key):
+        """Return specified page or list of pages."""
+        if isinstance(key, slice):
+            return [self._page(i) for i in range(*key.indices(len(self)))]
+        index = int(key)
+        if index < 0:
+            index += len(self._offsets)
+        if not 0 <= index < len(self._offsets):
+            raise IndexError("page index out of range")
+        return self._page(index)
+
+    def __iter__(self):
+        """Return iterator over pages."""
+        for i in range(len(self._offsets)):
+            yield self._page(i)
+
+
 class TiffPage(object):
     """A TIFF image file directory (IFD).
 
@@ -1947,24 +2378,28 @@ class TiffPage(object):
     5. contig samples_per_pixel.
 
     """
-    def __init__(self, parent):
-        """Initialize instance from file."""
+    def __init__(self, parent, index=None, offset=None):
+        """Initialize instance from file.
+
+        If 'offset' is None, the IFD offset is read at the file cursor.
+
+        """
         self.parent = parent
-        self.index = len(parent.pages)
+        self.index = len(parent.pages) if index is None else index
         self.shape = self._shape = ()
         self.dtype = self._dtype = None
         self.axes = ""
         self.tags = TiffTags()
         self._offset = 0
 
-        self._fromfile()
+        self._fromfile(offset)
         self._process_tags()
 
-    def _fromfile(self):
+    def _fromfile(self, offset=None):
         """Read TIFF IFD structure and its tags from file.
 
-        File cursor must be at storage position of IFD offset and is left at
-        offset to next IFD.
+        Unless the IFD 'offset' is given, file cursor must be at storage
+        position of IFD offset. File cursor is left at offset to next IFD.
 
         Raises StopIteration if offset (first bytes read) is 0
         or a corrupted page list is encountered.
@@ -1974,9 +2409,10 @@ class TiffPage(object):
         byteorder = self.parent.byteorder
         offset_size = self.parent.offset_size
 
-        # read offset to this IFD
-        fmt = {4: 'I', 8: 'Q'}[offset_size]
-        offset = struct.unpack(byteorder + fmt, fh.read(offset_size))[0]
+        if offset is None:
+            # read offset to this IFD
+            fmt = {4: 'I', 8: 'Q'}[offset_size]
+            offset = struct.unpack(byteorder + fmt, fh.read(offset_size))[0]
         if not offset:
             raise StopIteration()
         if offset >= fh.size:
@@ -2314,7 +2750,7 @@ class TiffPage(object):
 
     def asarray(self, squeeze=True, colormapped=True, rgbonly=False,
                 scale_mdgel=False, memmap=False, reopen=True,
-                maxsize=64*1024*1024*1024):
+                maxsize=64*1024*1024*1024, maxworkers=1):
         """Read image data from file and return as numpy array.
 
         Raise ValueError if format is unsupported.
@@ -2342,6 +2778,11 @@ class TiffPage(object):
         maxsize: int or None
             Maximum size of data before a ValueError is raised.
             Can be used to catch DOS. Default: 64 GB.
+        maxworkers : int or None
+            Maximum number of threads that decode strips or tiles.
+            If None, one thread per CPU is used. Default: 1.
+            Decoding zlib and lzma compressed data scales with threads,
+            other compressions only if the _tifffile module is available.
 
         """
         if not self._shape:
@@ -2417,13 +2858,13 @@ class TiffPage(object):
                         # needs the raw byte order
                         typecode = dtype
                     try:
-                        return numpy.fromstring(x, typecode)
+                        return numpy.frombuffer(x, typecode)
                     except ValueError as e:
                         # strips may be missing EOI
                         warnings.warn("unpack: %s" % e)
                         xlen = ((len(x) // (bits_per_sample // 8)) *
                                 (bits_per_sample // 8))
-                        return numpy.fromstring(x[:xlen], typecode)
+                        return numpy.frombuffer(x[:xlen], typecode)
 
             elif isinstance(bits_per_sample, tuple):
                 def unpack(x):
@@ -2439,16 +2880,22 @@ class TiffPage(object):
                 def decompress(x):
                     return decode_jpeg(x, table, self.photometric)
 
+            def decode(chunk):
+                if lsb2msb:
+                    chunk = reverse_bitorder(chunk)
+                return unpack(decompress(chunk))
+
+            # chunks are read in the calling thread and decoded in parallel
+            chunks = fh.read_segments(offsets, byte_counts)
+
             if self.is_tiled:
                 result = numpy.empty(shape, dtype)
-                tw, tl, td, pl = 0, 0, 0, 0
-                for offset, bytecount in zip(offsets, byte_counts):
-                    fh.seek(offset)
-                    tile = fh.read(bytecount)
-                    if lsb2msb:
-                        tile = reverse_bitorder(tile)
-                    tile = decompress(tile)
-                    tile = unpack(tile)
+                tiles = (shape[1], shape[2] // tile_depth,
+                         shape[3] // tile_length, shape[4] // tile_width)
+
+                def decode_tile(index_tile):
+                    index, tile = index_tile
+                    tile = decode(tile)
                     try:
                         tile.shape = tile_shape
                     except ValueError:
@@ -2458,39 +2905,63 @@ class TiffPage(object):
                         s = min(tile.size, t.size)
                         t[:s] = tile[:s]
                         tile = t.reshape(tile_shape)
+                    pl, td, tl, tw = numpy.unravel_index(index, tiles)
+                    td *= tile_depth
+                    tl *= tile_length
+                    tw *= tile_width
+                    out = result[0, pl, td:td+tile_depth,
+                                 tl:tl+tile_length, tw:tw+tile_width, :]
+                    # decoded tiles are read-only views of the decompressed
+                    # data, the predictor is undone into the result
                     if self.predictor == 'horizontal':
-                        numpy.cumsum(tile, axis=-2, dtype=dtype, out=tile)
+                        numpy.cumsum(tile, axis=-2, dtype=dtype, out=out)
                     elif self.predictor == 'float':
                         raise NotImplementedError()
-                    result[0, pl, td:td+tile_depth,
-                           tl:tl+tile_length, tw:tw+tile_width, :] = tile
-                    del tile
-                    tw += tile_width
-                    if tw >= shape[4]:
-                        tw, tl = 0, tl + tile_length
-                        if tl >= shape[3]:
-                            tl, td = 0, td + tile_depth
-                            if td >= shape[2]:
-                                td, pl = 0, pl + 1
+                    else:
+                        out[...] = tile
+
+                for _ in parallel_map(decode_tile, enumerate(chunks),
+                                      maxworkers):
+                    pass
                 result = result[...,
                                 :image_depth, :image_length, :image_width, :]
             else:
                 strip_size = (self.rows_per_strip * self.image_width *
                               self.samples_per_pixel)
-                result = numpy.empty(shape, dtype).reshape(-1)
                 index = 0
-                for offset, bytecount in zip(offsets, byte_counts):
-                    fh.seek(offset)
-                    strip = fh.read(bytecount)
-                    if lsb2msb:
-                        strip = reverse_bitorder(strip)
-                    strip = decompress(strip)
-                    strip = unpack(strip)
-                    size = min(result.size, strip.size, strip_size,
-                               result.size - index)
-                    result[index:index+size] = strip[:size]
-                    del strip
-                    index += size
+                if (maxworkers == 1 and self.compression != 'jpeg' and
+                        bits_per_sample in (8, 16, 32, 64, 128)):
+                    # strips are decompressed directly into the result, which
+                    # has the byte order of the file until all are decoded
+                    if self.predictor == 'float':
+                        typecode = dtype
+                    result = numpy.empty(product(shape), typecode)
+                    out = result.view('uint8')
+                    itemsize = result.itemsize
+                    for strip in chunks:
+                        if lsb2msb:
+                            strip = reverse_bitorder(strip)
+                        stop = min(index + strip_size, result.size)
+                        size = decompress_into(
+                            strip, out[index*itemsize:stop*itemsize],
+                            self.compression)
+                        del strip
+                        if size % itemsize:
+                            # strips may be missing EOI
+                            warnings.warn("unpack: incomplete item in strip")
+                        index += size // itemsize
+                    if not result.dtype.isnative:
+                        result = result.byteswap(True).view(dtype)
+                else:
+                    result = numpy.empty(shape, dtype).reshape(-1)
+                    # strips are placed in order, their positions depend on
+                    # the sizes of all previous strips
+                    for strip in parallel_map(decode, chunks, maxworkers):
+                        size = min(result.size, strip.size, strip_size,
+                                   result.size - index)
+                        result[index:index+size] = strip[:size]
+                        del strip
+                        index += size
 
         result.shape = self._shape
 
@@ -2547,6 +3018,153 @@ class TiffPage(object):
             fh.close()
         return result
 
+    def read_region(self, region, squeeze=True, reopen=True, maxworkers=1):
+        """Read window of image data from file and return as numpy array.
+
+        Only the strips or tiles intersecting the window are read and
+        decoded; of uncompressed strips only the rows in the window are read.
+        Color maps are not applied and extra samples are not removed.
+
+        Parameters
+        ----------
+        region : tuple of slices
+            The (y, x) or (y, x, z) window to read. Slices must have step 1.
+        squeeze : bool
+            If True, length-1 dimensions of the page (except Y and X) are
+            squeezed out from result.
+        reopen : bool
+            If True and the parent file handle is closed, the file is
+            temporarily re-opened (and closed if no exception occurs).
+        maxworkers : int or None
+            Maximum number of threads that decode strips or tiles.
+
+        """
+        if not self._shape:
+            return
+        if len(region) not in (2, 3):
+            raise ValueError("region must be (y, x) or (y, x, z) slices")
+        bounds = []
+        for window, size in zip(tuple(region) + (slice(None), ),
+                                (self.image_length, self.image_width,
+                                 self.image_depth)):
+            start, stop, step = window.indices(size)
+            if step != 1:
+                raise ValueError("region slices must have step 1")
+            bounds.append((start, max(start, stop)))
+        (y0, y1), (x0, x1), (z0, z1) = bounds
+
+        if self.is_tiled:
+            chunk = (self.tile_depth if 'tile_depth' in self.tags else 1,
+                     self.tile_length, self.tile_width)
+            offsets = self.tile_offsets
+            byte_counts = self.tile_byte_counts
+        else:
+            chunk = (1, min(self.rows_per_strip, self.image_length),
+                     self.image_width)
+            offsets = self.strip_offsets
+            byte_counts = self.strip_byte_counts
+        image = (self.image_depth, self.image_length, self.image_width)
+        grid = tuple((i + c - 1) // c for i, c in zip(image, chunk))
+        planes, samples = self._shape[1], self._shape[5]
+
+        if (self._shape[0] != 1 or self.dtype is None or
+                self.compression not in TIFF_DECOMPESSORS or
+                self.bits_per_sample not in (8, 16, 32, 64, 128) or
+                self.is_chroma_subsampled or self.predictor == 'float' or
+                (self.image_depth > 1 and not self.is_tiled) or
+                len(offsets) != planes * product(grid)):
+            # decode the whole page
+            result = self.asarray(squeeze=False, colormapped=False,
+                                  rgbonly=False, reopen=reopen,
+                                  maxworkers=maxworkers)
+            result = result[..., z0:z1, y0:y1, x0:x1, :].copy()
+        else:
+            fh = self.parent.filehandle
+            closed = fh.closed
+            if closed:
+                if reopen:
+                    fh.open()
+                else:
+                    raise IOError("file handle is closed")
+
+            dtype = self._dtype
+            typecode = self.parent.byteorder + dtype
+            lsb2msb = self.fill_order == 'lsb2msb'
+            predictor = self.predictor == 'horizontal' and not (
+                self.parent.is_lsm and not self.compression)
+            decompress = TIFF_DECOMPESSORS[self.compression]
+            cd, cl, cw = chunk
+            rowsize = cw * samples
+            rowbytes = rowsize * numpy.dtype(typecode).itemsize
+
+            # (plane, chunk position, first row, number of rows) of the
+            # chunks to read, their file offsets and byte counts
+            segments = []
+            segment_offsets = []
+            segment_byte_counts = []
+            for p in range(planes):
+                for d in range(z0 // cd, (z1 + cd - 1) // cd):
+                    for l in range(y0 // cl, (y1 + cl - 1) // cl):
+                        for w in range(x0 // cw, (x1 + cw - 1) // cw):
+                            i = ((p * grid[0] + d) * grid[1] + l) * grid[2] + w
+                            offset = offsets[i]
+                            byte_count = byte_counts[i]
+                            row = 0
+                            rows = cd * cl
+                            if not self.compression and not self.is_tiled:
+                                # read only the rows in the window
+                                row = max(y0 - l * cl, 0)
+                                rows = min(y1 - l * cl, cl) - row
+                                offset += row * rowbytes
+                                byte_count = min(rows * rowbytes,
+                                                 byte_count - row * rowbytes)
+                            if byte_count <= 0:
+                                continue
+                            segments.append((p, d, l, w, row, rows))
+                            segment_offsets.append(offset)
+                            segment_byte_counts.append(byte_count)
+
+            result = numpy.zeros((1, planes, z1 - z0, y1 - y0, x1 - x0,
+                                  samples), dtype)
+
+            def decode_chunk(segment_data):
+                (p, d, l, w, row, rows), data = segment_data
+                if lsb2msb:
+                    data = reverse_bitorder(data)
+                data = numpy.frombuffer(decompress(data), typecode)
+                size = min(data.size // rowsize, rows) * rowsize
+                block = data[:size].reshape(-1, cw, samples)
+                if len(block) < rows:
+                    # incomplete chunks; the last strip may be shorter
+                    if self.is_tiled:
+                        warnings.warn("invalid tile data")
+                    padded = numpy.zeros((rows, cw, samples), typecode)
+                    padded[:len(block)] = block
+                    block = padded
+                block = block.reshape(cd, rows // cd, cw, samples)
+                if predictor:
+                    block = numpy.cumsum(block, axis=-2, dtype=dtype)
+                # intersect the chunk with the window
+                zs, ys, xs = d * cd, l * cl + row, w * cw
+                za, zb = max(z0, zs), min(z1, zs + cd)
+                ya, yb = max(y0, ys), min(y1, ys + rows // cd)
+                xa, xb = max(x0, xs), min(x1, xs + cw)
+                result[0, p, za-z0:zb-z0, ya-y0:yb-y0, xa-x0:xb-x0, :] = (
+                    block[za-zs:zb-zs, ya-ys:yb-ys, xa-xs:xb-xs, :])
+
+            chunks = fh.read_segments(segment_offsets, segment_byte_counts)
+            for _ in parallel_map(decode_chunk, zip(segments, chunks),
+                                  maxworkers):
+                pass
+
+            if closed:
+                fh.close()
+
+        if squeeze:
+            result.shape = tuple(n for i, n in enumerate(result.shape)
+                                 if self._shape[i] != 1 or i in (3, 4))
+        return result
+
     @lazyattr
     def _byte_counts_offsets(self):
         """Return simplified byte_counts and offsets."""
@@ -2726,6 +3344,33 @@ class TiffPage(object):
         return ('new_subfile_type' in self.tags and
                 self.tags['new_subfile_type'].value & 1)
 
+    @lazyattr
+    def levels(self):
+        """Return pyramid levels, the page and the reduced pages following it.
+
+        Levels are sorted by decreasing size.
+
+        """
+        levels = [self]
+        if not self.is_reduced:
+            pages = self.parent.pages
+            index = self.index + 1
+            while index < len(pages) and pages[index].is_reduced:
+                levels.append(pages[index])
+                index += 1
+        return sorted(levels, key=lambda page: -product(page.shape))
+
+    def select_level(self, length, width):
+        """Return smallest pyramid level of at least length x width pixels.
+
+        If no level is that large, the page itself is returned.
+
+        """
+        for page in reversed(self.levels):
+            if page.image_length >= length and page.image_width >= width:
+                return page
+        return self
+
     @lazyattr
     def is_chroma_subsampled(self):
         """Page contains chroma subsampled image."""
@@ -3440,6 +4085,34 @@ class FileHandle(object):
             size = self._size
         return self._fh.read(size)
 
+    def read_segments(self, offsets, bytecounts, buffersize=64*1024*1024):
+        """Return iterator over segments of file as byte strings.
+
+        Segments that are adjacent in the file are read with one call,
+        up to 'buffersize' bytes.
+
+        """
+        i = 0
+        count = len(offsets)
+        while i < count:
+            start = offsets[i]
+            end = start + bytecounts[i]
+            j = i + 1
+            while (j < count and offsets[j] == end and
+                    end - start + bytecounts[j] <= buffersize):
+                end += bytecounts[j]
+                j += 1
+            self.seek(start)
+            data = self._fh.read(end - start)
+            if j == i + 1:
+                yield data
+            else:
+                for k in range(i, j):
+                    pos = offsets[k] - start
+                    yield data[pos:pos+bytecounts[k]]
+            del data
+            i = j
+
     def write(self, bytestring):
         """Write bytestring to file."""
         return self._fh.write(bytestring)
@@ -4212,24 +4885,96 @@ def decode_packbits(encoded):
 
     PackBits is a simple byte-oriented run-length compression scheme.
 
+    Only the positions of the run headers are found in a loop. The literal
+    bytes and repeated values are then selected and expanded with numpy.
+
     """
+    data = numpy.frombuffer(encoded, 'u1')
+    size = len(data)
+    if not size:
+        return b''
     func = ord if sys.version[0] == '2' else lambda x: x
-    result = []
-    result_extend = result.extend
+    headers = []
+    headers_append = headers.append
     i = 0
-    try:
-        while True:
-            n = func(encoded[i]) + 1
-            i += 1
-            if n < 129:
-                result_extend(encoded[i:i+n])
-                i += n
-            elif n > 129:
-                result_extend(encoded[i:i+1] * (258-n))
-                i += 1
-    except IndexError:
-        pass
-    return b''.join(result) if sys.version[0] == '2' else bytes(result)
+    while i < size:
+        headers_append(i)
+        n = func(encoded[i])
+        i += n + 2 if n < 128 else (2 if n > 128 else 1)
+    headers = numpy.array(headers, 'i8')
+    n = data[headers].astype('i8')
+    start = headers + 1
+    literal = n < 128
+    # number of literal bytes or repeats, truncated at the end of data
+    count = numpy.where(literal, n + 1, numpy.where(n > 128, 257 - n, 0))
+    count = numpy.where(literal, numpy.minimum(count, size - start),
+                        numpy.where(start < size, count, 0))
+    # select the bytes following headers, repeat values of replicate runs
+    end = start + numpy.where(literal, count, count > 0)
+    select = (numpy.bincount(start, minlength=size + 1) -
+              numpy.bincount(end, minlength=size + 1))
+    select = numpy.cumsum(select[:-1]).astype(bool)
+    replicate = (~literal) & (count > 0)
+    if not replicate.any():
+        return data[select].tobytes()
+    repeats = numpy.ones(size, 'i4')
+    repeats[start[replicate]] = count[replicate]
+    return numpy.repeat(data[select], repeats[select]).tobytes()
+
+
+def encode_packbits(data):
+    """Compress numpy array or byte string with PackBits.
+
+    The rows along the last axis of arrays are encoded separately, as the
+    TIFF specification requires for image rows. Runs of three or more
+    equal bytes are encoded as replicate runs, other bytes as literal runs.
+
+    >>> encode_packbits(b'\\x00\\x00\\x00\\x01\\x02')
+    b'\\xfe\\x00\\x01\\x01\\x02'
+
+    """
+    if isinstance(data, numpy.ndarray):
+        data = numpy.ascontiguousarray(data)
+        rowlen = data.shape[-1] * data.itemsize if data.ndim else 1
+        data = data.reshape(-1).view('u1')
+    else:
+        data = numpy.frombuffer(data, 'u1')
+        rowlen = len(data)
+    size = len(data)
+    if not size:
+        return b''
+    rowstart = numpy.zeros(size, bool)
+    rowstart[::max(rowlen, 1)] = True
+    # runs of equal bytes, not crossing rows
+    runstart = rowstart.copy()
+    runstart[1:] |= data[1:] != data[:-1]
+    runstart = numpy.flatnonzero(runstart)
+    runlen = numpy.diff(numpy.append(runstart, size))
+    replicate = runlen >= 3
+    # consecutive literal runs in a row form one literal segment
+    segment = replicate | rowstart[runstart]
+    segment[1:] |= replicate[:-1]
+    segment = numpy.flatnonzero(segment)
+    segstart = runstart[segment]
+    seglen = numpy.diff(numpy.append(segstart, size))
+    replicate = replicate[segment]
+    # split segments into pieces of at most 128 bytes
+    pieces = (seglen + 127) // 128
+    offset = numpy.arange(int(pieces.sum())) - numpy.repeat(
+        numpy.cumsum(pieces) - pieces, pieces)
+    start = numpy.repeat(segstart, pieces) + offset * 128
+    length = numpy.minimum(numpy.repeat(seglen, pieces) - offset * 128, 128)
+    replicate = numpy.repeat(replicate, pieces)
+    # a header followed by one value or by the literal bytes
+    payload = numpy.where(replicate, 1, length)
+    position = numpy.cumsum(payload + 1) - payload - 1
+    result = numpy.empty(int(position[-1] + payload[-1] + 1), 'u1')
+    result[position] = numpy.where(replicate, 257 - length, length - 1) & 255
+    isdata = numpy.ones(len(result), bool)
+    isdata[position] = False
+    result[isdata] = data[numpy.repeat(start - position - 1, payload) +
+                          numpy.flatnonzero(isdata)]
+    return result.tobytes()
 
 
 @_replace_by('_tifffile.decode_lzw')
@@ -4241,81 +4986,151 @@ def decode_lzw(encoded):
     This is an implementation of the LZW decoding algorithm described in (1).
     It is not compatible with old style LZW compressed files like quad-lzw.tif.
 
+    Between two CLEAR codes the width of a code only depends on its
+    position, so all codes of a table are extracted at once with numpy.
+    Each string added to the table is a decoded string followed by the
+    first byte of the next one. Hence byte i of a decoded string is the last
+    byte of its prefix of length i+1, which is found by pointer jumping.
+    Strips of long strings (large uniform areas) are decoded from a table
+    of byte strings instead.
+
     """
     len_encoded = len(encoded)
-    bitcount_max = len_encoded * 8
-    unpack = struct.unpack
-
-    if sys.version[0] == '2':
-        newtable = [chr(i) for i in range(256)]
-    else:
-        newtable = [bytes([i]) for i in range(256)]
-    newtable.extend((0, 0))
-
-    def next_code():
-        """Return integer of 'bitw' bits at 'bitcount' position in encoded."""
-        start = bitcount // 8
-        s = encoded[start:start+4]
-        try:
-            code = unpack('>I', s)[0]
-        except Exception:
-            code = unpack('>I', s + b'\x00'*(4-len(s)))[0]
-        code <<= bitcount % 8
-        code &= mask
-        return code >> shr
-
-    switchbitch = {  # code: bit-width, shr-bits, bit-mask
-        255: (9, 23, int(9*'1'+'0'*23, 2)),
-        511: (10, 22, int(10*'1'+'0'*22, 2)),
-        1023: (11, 21, int(11*'1'+'0'*21, 2)),
-        2047: (12, 20, int(12*'1'+'0'*20, 2)), }
-    bitw, shr, mask = switchbitch[255]
-    bitcount = 0
-
     if len_encoded < 4:
         raise ValueError("strip must be at least 4 characters long")
+    bitcount_max = len_encoded * 8
+
+    # 32 bit big endian window starting at each byte
+    data = numpy.zeros(len_encoded + 3, 'u4')
+    data[:len_encoded] = numpy.frombuffer(encoded, 'u1')
+    windows = ((data[:-3] << 24) | (data[1:-2] << 16) |
+               (data[2:-1] << 8) | data[3:])
+    del data
 
-    if next_code() != 256:
+    if int(windows[0]) >> 23 != 256:
         raise ValueError("strip must begin with CLEAR code")
 
-    code = 0
-    oldcode = 0
-    result = []
-    result_append = result.append
+    # extract codes in chunks of positions in a table
+    chunksize = 4096
+    tables = []
+    table = []
+    code = 256
+    bitcount = 9
+    start = 0
     while True:
-        code = next_code()  # ~5% faster when inlining this function
-        bitcount += bitw
-        if code == 257 or bitcount >= bitcount_max:  # EOI
-            break
-        if code == 256:  # CLEAR
-            table = newtable[:]
-            table_append = table.append
-            lentable = 258
-            bitw, shr, mask = switchbitch[255]
-            code = next_code()
-            bitcount += bitw
+        position = numpy.arange(start, start + chunksize)
+        # the code width switches one code early
+        width = (9 + (position >= 254) + (position >= 766) +
+                 (position >= 1790)).astype('u8')
+        bitpos = numpy.cumsum(width)
+        bitpos += bitcount
+        # codes ending at the end of the strip are ignored
+        count = int(numpy.searchsorted(bitpos, bitcount_max))
+        width = width[:count]
+        bitpos = bitpos[:count] - width
+        chunk = windows[bitpos >> 3].astype('u8') << (bitpos & 7)
+        chunk &= 0xffffffff
+        chunk >>= 32 - width
+        chunk = chunk.astype('i8')
+        control = numpy.flatnonzero((chunk == 256) | (chunk == 257))
+        if len(control):
+            i = int(control[0])
+            table.append(chunk[:i])
+            tables.append(numpy.concatenate(table))
+            table = []
+            start = 0
+            code = int(chunk[i])
+            bitcount = int(bitpos[i] + width[i])
             if code == 257:  # EOI
                 break
-            result_append(table[code])
-        else:
-            if code < lentable:
-                decoded = table[code]
-                newcode = table[oldcode] + decoded[:1]
-            else:
-                newcode = table[oldcode]
-                newcode += newcode[:1]
-                decoded = newcode
-            result_append(decoded)
-            table_append(newcode)
-            lentable += 1
-        oldcode = code
-        if lentable in switchbitch:
-            bitw, shr, mask = switchbitch[lentable]
+            continue  # CLEAR
+        table.append(chunk)
+        if count < chunksize:
+            # end of strip
+            tables.append(numpy.concatenate(table))
+            if count:
+                code = int(chunk[-1])
+            break
+        start += chunksize
+        bitcount = int(bitpos[-1] + width[-1])
+    del windows
 
     if code != 257:
         warnings.warn("unexpected end of lzw stream (code %i)" % code)
 
-    return b''.join(result)
+    tables = [t for t in tables if len(t)]
+    if not tables:
+        return b''
+    codes = numpy.concatenate(tables)
+    index = numpy.arange(len(codes))
+    # index of first code of the table of each code
+    first = numpy.repeat(numpy.cumsum([0] + [len(t) for t in tables[:-1]]),
+                         [len(t) for t in tables])
+    literal = codes < 256
+    if not literal[first].all():
+        raise ValueError("invalid code following CLEAR code")
+    # table entry 258+i is decoded string i of the table plus one byte,
+    # the code following the end of the table denotes the entry being added
+    if (~literal & (codes - 258 > index - first - 1)).any():
+        raise ValueError("corrupted LZW stream")
+    prefix = numpy.where(literal, index, first + codes - 258)
+    del first
+
+    # length and first byte of decoded strings by pointer jumping,
+    # ancestors[i] is the 2**i-th prefix of each code
+    length = (~literal).astype('i8')
+    ancestors = [prefix]
+    root = prefix
+    while True:
+        parent = root[root]
+        if numpy.array_equal(parent, root):
+            break
+        length += length[root]
+        root = parent
+        ancestors.append(ancestors[-1][ancestors[-1]])
+    length += 1
+    size = int(length.sum())
+
+    if size > 16 * len(codes):
+        # few long strings
+        newtable = [bytes([i]) for i in range(256)] + [b'', b'']
+        result = []
+        result_append = result.append
+        for codes in tables:
+            codes = codes.tolist()
+            table = newtable[:]
+            table_append = table.append
+            oldcode = codes[0]
+            result_append(table[oldcode])
+            for code in codes[1:]:
+                if code < len(table):
+                    decoded = table[code]
+                    table_append(table[oldcode] + decoded[:1])
+                else:
+                    decoded = table[oldcode]
+                    decoded += decoded[:1]
+                    table_append(decoded)
+                result_append(decoded)
+                oldcode = code
+        return b''.join(result)
+
+    # the last byte of a string is the first byte of the next one
+    last = numpy.where(literal, codes,
+                       codes[root[numpy.minimum(prefix + 1, index)]])
+    del root, parent, literal, tables
+
+    # byte i of decoded string k is the last byte of the prefix of k
+    # with length i+1, which is the prefix at depth len(k)-i-1
+    itype = 'i4' if size < 2**31 else 'i8'
+    owner = numpy.repeat(index.astype(itype), length)
+    depth = numpy.cumsum(length, dtype=itype)[owner]
+    depth -= numpy.arange(1, size + 1, dtype=itype)
+    for ancestor in ancestors:
+        if not depth.any():
+            break
+        owner = numpy.where(depth & 1, ancestor.astype(itype)[owner], owner)
+        depth >>= 1
+    return last[owner].astype('u1').tobytes()
 
 
 @_replace_by('_tifffile.unpack_ints')
@@ -4563,6 +5378,37 @@ def reshape_nd(image, ndim):
     return image
 
 
+def block_mean(data, factor=2, axes=(-2, -1)):
+    """Return data downsampled by the mean of blocks of factor samples.
+
+    Axes whose length is not a multiple of factor are padded by repeating
+    the last sample. The result has the dtype of data, integers are rounded.
+
+    >>> block_mean(numpy.array([[0, 1, 2], [3, 4, 5]], 'uint8'))
+    array([[2, 4]], dtype=uint8)
+
+    """
+    data = numpy.asarray(data)
+    axes = [axis % data.ndim for axis in axes]
+    padding = [(0, -size % factor if axis in axes else 0)
+               for axis, size in enumerate(data.shape)]
+    if any(after for before, after in padding):
+        data = numpy.pad(data, padding, mode='edge')
+    shape = []
+    block_axes = []
+    for axis, size in enumerate(data.shape):
+        if axis in axes:
+            shape.extend((size // factor, factor))
+            block_axes.append(len(shape) - 1)
+        else:
+            shape.append(size)
+    result = data.reshape(shape).mean(axis=tuple(block_axes),
+                                      dtype='float64')
+    if data.dtype.kind in 'iub':
+        result = numpy.rint(result)
+    return result.astype(data.dtype)
+
+
 def squeeze_axes(shape, axes, skip='XY'):
     """Return shape and axes with single-dimensional entries removed.
 
@@ -4678,6 +5524,69 @@ def stack_pages(pages, memmap=False, tempdir=None, *args, **kwargs):
     return data
 
 
+def parallel_map(func, iterable, maxworkers=1):
+    """Return iterator over results of func applied to items of iterable.
+
+    If 'maxworkers' is greater than 1 or None (one per CPU), func is
+    called on a pool of threads. Results are returned in order and at most
+    two items per thread are taken from iterable ahead of the results.
+
+    """
+    if maxworkers is None:
+        maxworkers = os.cpu_count() or 1
+    if maxworkers <= 1:
+        for item in iterable:
+            yield func(item)
+        return
+    with concurrent.futures.ThreadPoolExecutor(maxworkers) as executor:
+        pending = collections.deque()
+        for item in iterable:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= 2 * maxworkers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def decompress_into(data, out, compression=None, buffersize=4*1024*1024):
+    """Decompress TIFF strip or tile and write it to out. Return size.
+
+    'out' is a writable buffer, e.g. a slice of the uint8 view of the
+    output array. Decompressed data that do not fit into out are discarded.
+    Deflate compressed data are decompressed in pieces of at most
+    'buffersize' bytes, so no temporary of the size of the strip is needed.
+
+    >>> out = bytearray(4)
+    >>> decompress_into(zlib.compress(b'abcdef'), out, 'deflate'), out
+    (4, bytearray(b'abcd'))
+
+    """
+    out = memoryview(out).cast('B')
+    if compression in ('deflate', 'adobe_deflate'):
+        # the input is passed in pieces too, unconsumed input is copied
+        data = memoryview(data)
+        decompressor = zlib.decompressobj()
+        size = pos = 0
+        tail = b''
+        while size < len(out) and not decompressor.eof:
+            if not tail:
+                if pos >= len(data):
+                    break
+                tail = data[pos:pos+65536]
+                pos += 65536
+            chunk = decompressor.decompress(
+                tail, min(len(out) - size, buffersize))
+            out[size:size+len(chunk)] = chunk
+            size += len(chunk)
+            tail = decompressor.unconsumed_tail
+        return size
+    if compression is not None:
+        data = TIFF_DECOMPESSORS[compression](data)
+    size = min(len(data), len(out))
+    out[:size] = memoryview(data)[:size]
+    return size
+
+
 def stripnull(string, null=b'\x00'):
     """Return string truncated at first null character.
 
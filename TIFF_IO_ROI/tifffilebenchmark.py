@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for decoding compressed TIFF strips.
+
+LZW: encodes synthetic strips of typical images (noisy 16 bit EM images,
+8 bit images with a uniform background, as written by ImageJ) and reports
+MB/second of decoded data for tifffile.decode_lzw and for the decoder
+tifffile used before (decode_lzw_loop), which unpacks and looks up one code
+at a time.
+
+PackBits: encodes strips of 8 and 16 bit EM images and of an image with a
+uniform background and reports MB/second for tifffile.encode_packbits,
+tifffile.decode_packbits and the byte by byte decoder tifffile used before
+(decode_packbits_loop).
+
+Run from the extensions directory with
+    python -m TIFF_IO_ROI.tifffilebenchmark [--size 512] [--rows-per-strip 64] [--repeat 3]
+"""
+
+import argparse
+import collections
+import struct
+import sys
+import time
+import warnings
+
+import numpy
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore")
+    from TIFF_IO_ROI import tifffile
+
+
+BenchmarkResult = collections.namedtuple("BenchmarkResult", ["name", "elapsed", "rate", "unit"])
+
+
+def make_image(size, kind):
+    """Return a synthetic size x size image of kind 'em16', 'em8' or 'background8'"""
+    random = numpy.random.RandomState(0)
+    if kind in ("em16", "em8"):
+        y, x = numpy.mgrid[0:size, 0:size]
+        signal = 1000 + 200 * numpy.sin(x / 17.0) * numpy.cos(y / 23.0)
+        image = random.poisson(signal)
+        if kind == "em8":
+            # scaled to 8 bit with saturated areas
+            return numpy.clip((image - 900) * 2, 0, 255).astype(numpy.uint8)
+        return image.astype(numpy.uint16)
+    image = numpy.zeros((size, size), numpy.uint8)
+    y, x = numpy.mgrid[0:size, 0:size]
+    blobs = ((x - size // 3) ** 2 + (y - size // 2) ** 2 < (size // 5) ** 2) | ((x - 2 * size // 3) ** 2 + (y - size // 3) ** 2 < (size // 8) ** 2)
+    image[blobs] = random.randint(80, 200, size=int(blobs.sum()))
+    return image
+
+
+def make_strips(image, rows_per_strip):
+    """Return the bytes of image split into strips of rows_per_strip rows"""
+    return [image[i:i + rows_per_strip].tobytes() for i in range(0, image.shape[0], rows_per_strip)]
+
+
+def encode_lzw(data):
+    """Return data encoded as TIFF LZW strip (MSB first, early change, CLEAR when the table is full)"""
+    newtable = {bytes([i]): i for i in range(256)}
+    table = dict(newtable)
+    result = bytearray()
+    buffer, bitcount = 0, 0
+    position = 0
+
+    def write_code(code):
+        nonlocal buffer, bitcount, position
+        width = 9 + (position >= 254) + (position >= 766) + (position >= 1790)
+        buffer = (buffer << width) | code
+        bitcount += width
+        position += 1
+        while bitcount >= 8:
+            bitcount -= 8
+            result.append((buffer >> bitcount) & 0xff)
+        buffer &= (1 << bitcount) - 1
+
+    write_code(256)
+    position = 0
+    string = b""
+    for i in range(len(data)):
+        byte = data[i:i + 1]
+        if string + byte in table:
+            string += byte
+            continue
+        write_code(table[string])
+        table[string + byte] = len(table) + 2
+        string = byte
+        if len(table) + 2 >= 4094:
+            write_code(256)
+            position = 0
+            table = dict(newtable)
+    if string:
+        write_code(table[string])
+    write_code(257)
+    if bitcount:
+        result.append((buffer << (8 - bitcount)) & 0xff)
+    return bytes(result)
+
+
+def decode_lzw_loop(encoded):
+    """The LZW decoder tifffile used before decode_lzw was vectorized, as reference"""
+    len_encoded = len(encoded)
+    bitcount_max = len_encoded * 8
+    unpack = struct.unpack
+
+    newtable = [bytes([i]) for i in range(256)]
+    newtable.extend((0, 0))
+
+    def next_code():
+        start = bitcount // 8
+        s = encoded[start:start+4]
+        try:
+            code = unpack('>I', s)[0]
+        except Exception:
+            code = unpack('>I', s + b'\x00'*(4-len(s)))[0]
+        code <<= bitcount % 8
+        code &= mask
+        return code >> shr
+
+    switchbitch = {  # code: bit-width, shr-bits, bit-mask
+        255: (9, 23, int(9*'1'+'0'*23, 2)),
+        511: (10, 22, int(10*'1'+'0'*22, 2)),
+        1023: (11, 21, int(11*'1'+'0'*21, 2)),
+        2047: (12, 20, int(12*'1'+'0'*20, 2)), }
+    bitw, shr, mask = switchbitch[255]
+    bitcount = 0
+
+    if len_encoded < 4:
+        raise ValueError("strip must be at least 4 characters long")
+
+    if next_code() != 256:
+        raise ValueError("strip must begin with CLEAR code")
+
+    code = 0
+    oldcode = 0
+    result = []
+    result_append = result.append
+    while True:
+        code = next_code()
+        bitcount += bitw
+        if code == 257 or bitcount >= bitcount_max:  # EOI
+            break
+        if code == 256:  # CLEAR
+            table = newtable[:]
+            table_append = table.append
+            lentable = 258
+            bitw, shr, mask = switchbitch[255]
+            code = next_code()
+            bitcount += bitw
+            if code == 257:  # EOI
+                break
+            result_append(table[code])
+        else:
+            if code < lentable:
+                decoded = table[code]
+                newcode = table[oldcode] + decoded[:1]
+            else:
+                newcode = table[oldcode]
+                newcode += newcode[:1]
+                decoded = newcode
+            result_append(decoded)
+            table_append(newcode)
+            lentable += 1
+        oldcode = code
+        if lentable in switchbitch:
+            bitw, shr, mask = switchbitch[lentable]
+
+    if code != 257:
+        warnings.warn("unexpected end of lzw stream (code %i)" % code)
+
+    return b''.join(result)
+
+
+def decode_packbits_loop(encoded):
+    """The PackBits decoder tifffile used before decode_packbits was vectorized, as reference"""
+    result = []
+    result_extend = result.extend
+    i = 0
+    try:
+        while True:
+            n = encoded[i] + 1
+            i += 1
+            if n < 129:
+                result_extend(encoded[i:i+n])
+                i += n
+            elif n > 129:
+                result_extend(encoded[i:i+1] * (258-n))
+                i += 1
+    except IndexError:
+        pass
+    return bytes(result)
+
+
+def best_time(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_lzw(size=512, rows_per_strip=64, repeat=3):
+    """Run the LZW decoding benchmarks, return a list of BenchmarkResult"""
+    results = list()
+    for kind in ("em16", "background8"):
+        image = make_image(size, kind)
+        strips = [encode_lzw(strip) for strip in make_strips(image, rows_per_strip)]
+        megabytes = image.nbytes / 1e6
+        for name, decode in (("decode_lzw", tifffile.decode_lzw), ("decode_lzw_loop", decode_lzw_loop)):
+            assert b"".join(decode(strip) for strip in strips) == image.tobytes()
+
+            def decode_strips():
+                for strip in strips:
+                    decode(strip)
+
+            elapsed = best_time(decode_strips, repeat)
+            results.append(BenchmarkResult("lzw {} {}x{} {} rows/strip: {}".format(kind, size, size, rows_per_strip, name), elapsed, megabytes / elapsed, "MB/s"))
+    return results
+
+
+def run_packbits(size=512, rows_per_strip=64, repeat=3):
+    """Run the PackBits encoding and decoding benchmarks, return a list of BenchmarkResult"""
+    results = list()
+    for kind in ("em16", "em8", "background8"):
+        image = make_image(size, kind)
+        rows = [image[i:i + rows_per_strip] for i in range(0, image.shape[0], rows_per_strip)]
+        strips = [tifffile.encode_packbits(strip) for strip in rows]
+        megabytes = image.nbytes / 1e6
+        name = "packbits {} {}x{} {} rows/strip".format(kind, size, size, rows_per_strip)
+
+        def encode_strips():
+            for strip in rows:
+                tifffile.encode_packbits(strip)
+
+        elapsed = best_time(encode_strips, repeat)
+        results.append(BenchmarkResult("{}: encode_packbits ({:.2f} of size)".format(name, sum(len(strip) for strip in strips) / image.nbytes), elapsed, megabytes / elapsed, "MB/s"))
+        for decode_name, decode in (("decode_packbits", tifffile.decode_packbits), ("decode_packbits_loop", decode_packbits_loop)):
+            assert b"".join(decode(strip) for strip in strips) == image.tobytes()
+
+            def decode_strips():
+                for strip in strips:
+                    decode(strip)
+
+            elapsed = best_time(decode_strips, repeat)
+            results.append(BenchmarkResult("{}: {}".format(name, decode_name), elapsed, megabytes / elapsed, "MB/s"))
+    return results
+
+
+def print_results(results):
+    for result in results:
+        print("{:72s} {:8.3f} s {:12.1f} {}".format(result.name, result.elapsed, result.rate, result.unit))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark decoding compressed TIFF strips.")
+    parser.add_argument("--size", type=int, default=512, help="width and height of the images")
+    parser.add_argument("--rows-per-strip", type=int, default=64, help="number of image rows per strip")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best is reported")
+    args = parser.parse_args(argv)
+    results = run_lzw(args.size, args.rows_per_strip, args.repeat)
+    results.extend(run_packbits(args.size, args.rows_per_strip, args.repeat))
+    print_results(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+Tests for reading and writing TIFF files with tifffile.
+"""
+
+import contextlib
+import datetime
+import io
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+import warnings
+import zlib
+
+import numpy
+
+import TIFF_IO_ROI
+from TIFF_IO_ROI import tifffile
+from TIFF_IO_ROI import tifffilebenchmark
+
+
+class TestTiffFile(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def file_path(self, name="test.tif"):
+        return os.path.join(self.directory.name, name)
+
+    def write_pages(self, data, bigtiff=False, **kwargs):
+        # write every frame of data as a page of its own
+        file_path = self.file_path()
+        with tifffile.TiffWriter(file_path, bigtiff=bigtiff) as tif:
+            for frame in data:
+                tif.save(frame, **kwargs)
+        return file_path
+
+    def test_pages_are_read_on_first_access(self):
+        data = numpy.random.randint(0, 1000, size=(50, 16, 12)).astype(numpy.uint16)
+        for bigtiff in (False, True):
+            file_path = self.write_pages(data, bigtiff=bigtiff)
+            with tifffile.TiffFile(file_path) as tif:
+                self.assertEqual(len(tif.pages), 50)
+                # only the first page is read to identify the file format
+                self.assertTrue(all(page is None for page in tif.pages._pages[1:]))
+                numpy.testing.assert_array_equal(tif.pages[37].asarray(), data[37])
+                numpy.testing.assert_array_equal(tif.pages[-1].asarray(), data[-1])
+                self.assertEqual(sum(page is not None for page in tif.pages._pages), 3)
+                self.assertIs(tif.pages[37], tif.pages[37])
+                self.assertEqual(tif.pages[37].index, 37)
+                self.assertEqual([page.index for page in tif.pages[10:20:3]], [10, 13, 16, 19])
+                with self.assertRaises(IndexError):
+                    tif.pages[50]
+                numpy.testing.assert_array_equal(tif.asarray(), data)
+                numpy.testing.assert_array_equal(numpy.array([page.asarray() for page in tif]), data)
+
+    def test_pages_are_read_after_close(self):
+        data = numpy.random.randint(0, 1000, size=(5, 16, 12)).astype(numpy.uint16)
+        file_path = self.write_pages(data)
+        with tifffile.TiffFile(file_path) as tif:
+            pass
+        self.assertTrue(tif.filehandle.closed)
+        self.assertEqual(tif.pages[3].shape, (16, 12))
+        self.assertTrue(tif.filehandle.closed)
+        numpy.testing.assert_array_equal(tif.pages[3].asarray(), data[3])
+
+    def test_multifile_ome_series(self):
+        data = numpy.random.randint(0, 255, size=(4, 8, 6)).astype(numpy.uint8)
+        omexml = ('<?xml version="1.0" encoding="UTF-8"?>'
+                  '<OME xmlns="http://www.openmicroscopy.org/Schemas/OME/2016-06" UUID="urn:uuid:{}">'
+                  '<Image ID="Image:0"><Pixels ID="Pixels:0" DimensionOrder="XYCZT" Type="uint8" '
+                  'SizeX="6" SizeY="8" SizeC="1" SizeZ="1" SizeT="4">'
+                  '<TiffData FirstT="0" IFD="0" PlaneCount="2"><UUID FileName="a.ome.tif">urn:uuid:a</UUID></TiffData>'
+                  '<TiffData FirstT="2" IFD="0" PlaneCount="2"><UUID FileName="b.ome.tif">urn:uuid:b</UUID></TiffData>'
+                  '</Pixels></Image></OME>')
+        for i, name in enumerate("ab"):
+            with tifffile.TiffWriter(self.file_path(name + ".ome.tif")) as tif:
+                for frame in data[2 * i:2 * i + 2]:
+                    tif.save(frame, description=omexml.format(name))
+        # the second file is closed before its pages are read
+        with tifffile.TiffFile(self.file_path("a.ome.tif"), multifile_close=True) as tif:
+            self.assertTrue(tif.is_ome)
+            self.assertEqual(tif.series[0].shape, (4, 8, 6))
+            numpy.testing.assert_array_equal(tif.asarray(), data)
+
+    def test_maxpages_limits_page_list(self):
+        data = numpy.zeros((10, 4, 4), numpy.uint8)
+        file_path = self.write_pages(data)
+        with tifffile.TiffFile(file_path, maxpages=3) as tif:
+            # like the page reader, one page more than maxpages is read
+            self.assertEqual(len(tif.pages), 4)
+
+    def test_imagej_file_reads_only_first_page(self):
+        data = numpy.random.randint(0, 1000, size=(5, 16, 12)).astype(numpy.uint16)
+        file_path = self.file_path()
+        tifffile.imsave(file_path, data, imagej=True)
+        with tifffile.TiffFile(file_path) as tif:
+            self.assertEqual(len(tif.pages), 1)
+            numpy.testing.assert_array_equal(tif.asarray(), data)
+
+    def test_circular_page_list_is_cut(self):
+        data = numpy.zeros((3, 4, 4), numpy.uint8)
+        file_path = self.write_pages(data)
+        with tifffile.TiffFile(file_path) as tif:
+            offsets = list(tif.pages._offsets)
+            numtags = len(tif.pages[-1].tags)
+        # let the last IFD point back to the first one
+        with open(file_path, "r+b") as f:
+            f.seek(offsets[-1] + 2 + numtags * 12)
+            f.write(numpy.array(offsets[0], "<u4").tobytes())
+        with warnings.catch_warnings(record=True):
+            warnings.simplefilter("always")
+            with tifffile.TiffFile(file_path) as tif:
+                self.assertEqual(len(tif.pages), 3)
+
+    def test_parallel_decode_matches_serial_decode(self):
+        data = numpy.random.randint(0, 1000, size=(3, 200, 150)).astype(numpy.uint16)
+        for kwargs in (dict(compress=6), dict(compress=6, tile=(32, 48)), dict(compress=0, tile=(64, 64))):
+            file_path = self.write_pages(data, **kwargs)
+            with tifffile.TiffFile(file_path) as tif:
+                for maxworkers in (1, 4, None):
+                    numpy.testing.assert_array_equal(tif.pages[1].asarray(maxworkers=maxworkers), data[1])
+                    numpy.testing.assert_array_equal(tif.asarray(key=slice(None), maxworkers=maxworkers), data)
+
+    def test_strips_are_decoded_into_result(self):
+        data = numpy.random.randint(0, 1000, size=(2, 200, 150)).astype(numpy.uint16)
+        for byteorder in ("<", ">"):
+            for compress in (6, "packbits"):
+                file_path = self.file_path()
+                with tifffile.TiffWriter(file_path, byteorder=byteorder) as tif:
+                    for frame in data:
+                        tif.save(frame, compress=compress)
+                with tifffile.TiffFile(file_path) as tif:
+                    for maxworkers in (1, 2):
+                        result = tif.asarray(key=slice(None), maxworkers=maxworkers)
+                        self.assertTrue(result.dtype.isnative)
+                        numpy.testing.assert_array_equal(result, data)
+
+    def test_decompress_into_truncates_strip(self):
+        data = numpy.random.randint(0, 4, 100000).astype(numpy.uint8).tobytes()
+        for size in (0, 1000, len(data), len(data) + 10):
+            out = bytearray(size)
+            n = tifffile.decompress_into(zlib.compress(data), out, "deflate", buffersize=777)
+            self.assertEqual(n, min(size, len(data)))
+            self.assertEqual(bytes(out[:n]), data[:n])
+            out = numpy.zeros(size, numpy.uint8)
+            self.assertEqual(tifffile.decompress_into(data, out), min(size, len(data)))
+            self.assertEqual(out.tobytes()[:n], data[:n])
+
+    def test_read_region_matches_asarray(self):
+        data = numpy.random.randint(0, 1000, size=(200, 150, 3)).astype(numpy.uint16)
+        regions = ((slice(10, 77), slice(33, 140)), (slice(None), slice(None)), (slice(199, 200), slice(0, 1)),
+                   (slice(-20, None), slice(100, 1000)))
+        for kwargs in (dict(), dict(compress=6), dict(tile=(32, 48)), dict(compress=6, tile=(32, 48)),
+                       dict(planarconfig="planar"), dict(compress="packbits", planarconfig="planar", tile=(64, 64))):
+            file_path = self.file_path()
+            tifffile.imsave(file_path, data, **kwargs)
+            with tifffile.TiffFile(file_path) as tif:
+                page = tif.pages[0]
+                for region in regions:
+                    expected = page.asarray()[..., region[0], region[1]] if page.axes == "SYX" else data[region]
+                    numpy.testing.assert_array_equal(page.read_region(region), expected)
+                self.assertEqual(page.read_region(region, squeeze=False).ndim, 6)
+                with self.assertRaises(ValueError):
+                    page.read_region((slice(0, 10, 2), slice(None)))
+
+    def test_read_region_decodes_only_intersecting_tiles(self):
+        data = numpy.random.randint(0, 1000, size=(256, 256)).astype(numpy.uint16)
+        file_path = self.file_path()
+        tifffile.imsave(file_path, data, compress=6, tile=(64, 64))
+        with tifffile.TiffFile(file_path) as tif:
+            offsets, byte_counts = tif.pages[0].tile_offsets, tif.pages[0].tile_byte_counts
+        # corrupt all tiles but the ones of the window
+        with open(file_path, "r+b") as f:
+            for index, (offset, byte_count) in enumerate(zip(offsets, byte_counts)):
+                if index not in (5, 6):
+                    f.seek(offset)
+                    f.write(bytes(byte_count))
+        with tifffile.TiffFile(file_path) as tif:
+            numpy.testing.assert_array_equal(tif.pages[0].read_region((slice(70, 120), slice(80, 180))),
+                                             data[70:120, 80:180])
+            with self.assertRaises(zlib.error):
+                tif.pages[0].asarray()
+
+    def test_pyramid_levels_are_written_and_selected(self):
+        data = numpy.random.randint(0, 1000, size=(300, 201)).astype(numpy.uint16)
+        file_path = self.file_path()
+        with tifffile.TiffWriter(file_path) as tif:
+            tif.save(data, compress=6, tile=(64, 64), pyramid=3)
+            tif.save(data[:50, :50])
+        with tifffile.TiffFile(file_path) as tif:
+            self.assertEqual(len(tif.pages), 5)
+            levels = tif.pages[0].levels
+            self.assertEqual([level.shape for level in levels], [(300, 201), (150, 101), (75, 51), (38, 26)])
+            self.assertTrue(all(level.is_reduced for level in levels[1:]))
+            expected = data
+            for level in levels[1:]:
+                expected = tifffile.block_mean(expected)
+                numpy.testing.assert_array_equal(level.asarray(), expected)
+            self.assertIs(tif.pages[0].select_level(60, 40), levels[2])
+            self.assertIs(tif.pages[0].select_level(10, 10), levels[3])
+            self.assertIs(tif.pages[0].select_level(1000, 10), levels[0])
+            self.assertEqual(tif.pages[4].levels, [tif.pages[4]])
+        with tifffile.TiffWriter(file_path) as tif:
+            with self.assertRaises(ValueError):
+                tif.save(numpy.zeros((2, 32, 32), numpy.uint8), compress=6, pyramid=1)
+
+    def test_block_mean(self):
+        data = numpy.arange(30, dtype=numpy.uint8).reshape(5, 6)
+        numpy.testing.assert_array_equal(tifffile.block_mean(data), [[4, 6, 8], [16, 18, 20], [24, 26, 28]])
+        numpy.testing.assert_allclose(tifffile.block_mean(data.astype(numpy.float32), 3, axes=(1,)),
+                                      data.reshape(5, 2, 3).mean(axis=-1))
+
+    def test_parallel_encode_matches_serial_encode(self):
+        data = numpy.random.randint(0, 1000, size=(4, 130, 150)).astype(numpy.uint16)
+        for kwargs in (dict(compress=6, rowsperstrip=16), dict(compress="packbits", tile=(32, 48)),
+                       dict(compress=6, tile=(64, 64))):
+            contents = []
+            for maxworkers in (1, 4, None):
+                file_path = self.file_path("{}.tif".format(maxworkers))
+                tifffile.imsave(file_path, data, maxworkers=maxworkers, datetime=datetime.datetime(2016, 1, 1), **kwargs)
+                with open(file_path, "rb") as f:
+                    contents.append(f.read())
+                with tifffile.TiffFile(file_path) as tif:
+                    numpy.testing.assert_array_equal(tif.asarray(), data)
+            self.assertEqual(contents[1], contents[0])
+            self.assertEqual(contents[2], contents[0])
+
+    def test_save_rows_per_strip(self):
+        data = numpy.random.randint(0, 1000, size=(5, 64, 60)).astype(numpy.uint16)
+        for kwargs in (dict(), dict(compress=6), dict(compress="packbits", maxworkers=2)):
+            file_path = self.file_path()
+            tifffile.imsave(file_path, data, rowsperstrip=10, **kwargs)
+            with tifffile.TiffFile(file_path) as tif:
+                self.assertEqual(tif.pages[0].rows_per_strip, 10)
+                self.assertEqual(len(tif.pages[0].strip_offsets), 7)
+                numpy.testing.assert_array_equal(tif.asarray(), data)
+                numpy.testing.assert_array_equal(tif.pages[2].read_region((slice(15, 33), slice(5, 50))), data[2, 15:33, 5:50])
+
+    def test_background_writer_writes_frames_in_order(self):
+        data = numpy.random.randint(0, 1000, size=(20, 64, 48)).astype(numpy.uint16)
+        file_path = self.file_path()
+        with tifffile.TiffBackgroundWriter(file_path, maxqueue=3) as tif:
+            for frame in data.copy():
+                self.assertTrue(tif.save(frame, compress=6))
+                frame[:] = 0  # frames are copied
+            self.assertTrue(tif.flush())
+            metrics = tif.metrics
+        self.assertEqual(metrics["frames_written"], 20)
+        self.assertEqual(metrics["frames_dropped"], 0)
+        self.assertEqual(metrics["queue_depth"], 0)
+        self.assertLessEqual(metrics["max_queue_depth"], 3)
+        self.assertEqual(metrics["bytes_written"], data.nbytes)
+        self.assertGreater(metrics["bytes_per_second"], 0)
+        with tifffile.TiffFile(file_path) as tif:
+            numpy.testing.assert_array_equal(tif.asarray(key=slice(None)), data)
+
+    def test_background_writer_overflow_policies(self):
+
+        class BlockingStream(io.BytesIO):
+            def __init__(self):
+                super().__init__()
+                self.gate = threading.Event()
+                self.gate.set()
+
+            def write(self, b):
+                self.gate.wait()
+                return super().write(b)
+
+        frames = [numpy.full((16, 16), i, numpy.uint8) for i in range(5)]
+        for overflow, written in (("block", [0, 1, 2]), ("drop", [0, 1, 2]), ("drop_oldest", [0, 2, 3]),
+                                  ("raise", [0, 1, 2])):
+            stream = BlockingStream()
+            tif = tifffile.TiffBackgroundWriter(stream, maxqueue=2, overflow=overflow)
+            stream.gate.clear()
+            tif.save(frames[0], contiguous=False)
+            while tif.queue_depth:  # the writer thread is blocked writing frame 0
+                time.sleep(0.001)
+            tif.save(frames[1], contiguous=False)
+            tif.save(frames[2], contiguous=False)
+            if overflow == "block":
+                with self.assertRaises(queue.Full):
+                    tif.save(frames[3], timeout=0.01, contiguous=False)
+            elif overflow == "raise":
+                with self.assertRaises(queue.Full):
+                    tif.save(frames[3], contiguous=False)
+            elif overflow == "drop":
+                self.assertFalse(tif.save(frames[3], contiguous=False))
+            else:
+                self.assertTrue(tif.save(frames[3], contiguous=False))
+            self.assertEqual(tif.queue_depth, 2)
+            stream.gate.set()
+            tif.close()
+            self.assertEqual(tif.metrics["frames_dropped"], 0 if overflow in ("block", "raise") else 1)
+            stream.seek(0)
+            with tifffile.TiffFile(stream) as tiff:
+                self.assertEqual([int(page.asarray()[0, 0]) for page in tiff.pages], written)
+
+    def test_background_writer_raises_errors_of_writer_thread(self):
+        tif = tifffile.TiffBackgroundWriter(self.file_path(), maxqueue=1)
+        tif.save(numpy.zeros((0, 16), numpy.uint8))
+        with self.assertRaises(ValueError):
+            tif.flush()
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                tif.save(numpy.zeros((16, 16), numpy.uint8))
+            with self.assertRaises(ValueError):
+                tif.flush()
+        self.assertEqual(tif.metrics['frames_written'], 0)
+        for i in range(2):
+            with self.assertRaises(ValueError):
+                tif.close()
+        with self.assertRaises(ValueError):
+            tif.save(numpy.zeros((16, 16), numpy.uint8))
+        # errors of the writer thread do not replace the exception leaving the with block
+        with self.assertRaises(KeyError):
+            with tifffile.TiffBackgroundWriter(self.file_path()) as tif:
+                tif.save(numpy.zeros((0, 16), numpy.uint8))
+                with self.assertRaises(ValueError):
+                    tif.flush()
+                raise KeyError()
+
+    def test_export_writes_chunks_and_bigtiff(self):
+        data = numpy.random.rand(4, 3, 1, 40, 30, 1)
+        metadata = {"unit": "nm", TIFF_IO_ROI.NION_TAG: "{}"}
+        for bigtiff in (False, True):
+            file_path = self.file_path()
+            # tifffile warns that ImageJ itself cannot read BigTIFF files
+            with self.assertWarns(UserWarning) if bigtiff else contextlib.nullcontext():
+                TIFF_IO_ROI.write_tiff(file_path, data, numpy.dtype(numpy.float32), bigtiff=bigtiff, imagej=True,
+                                       metadata=metadata)
+            self.assertLessEqual(os.path.getsize(file_path),
+                                 TIFF_IO_ROI.estimate_tiff_size(data.shape, numpy.float32, metadata, ()))
+            with tifffile.TiffFile(file_path) as tif:
+                self.assertEqual(tif.is_bigtiff, bigtiff)
+                self.assertEqual((tif.pages[0].imagej_tags["frames"], tif.pages[0].imagej_tags["slices"]), (4, 3))
+                self.assertEqual(tif.pages[0].imagej_tags["unit"], "nm")
+                numpy.testing.assert_array_equal(tif.asarray(), data.astype(numpy.float32).reshape(4, 3, 40, 30))
+        rgb = numpy.random.randint(0, 256, size=(1, 1, 1, 40, 30, 3)).astype(numpy.uint8)
+        file_path = self.file_path()
+        with self.assertWarns(UserWarning):
+            TIFF_IO_ROI.write_tiff(file_path, rgb, rgb.dtype, (2, 1, 0), bigtiff=True, imagej=True)
+        with tifffile.TiffFile(file_path) as tif:
+            numpy.testing.assert_array_equal(tif.asarray(), rgb[0, 0, 0, ..., ::-1])
+
+    def test_read_segments_joins_adjacent_segments(self):
+        file_path = self.file_path("segments.bin")
+        with open(file_path, "wb") as f:
+            f.write(bytes(range(100)))
+        with tifffile.FileHandle(file_path) as fh:
+            segments = list(fh.read_segments([10, 15, 20, 50, 0], [5, 5, 3, 10, 2], buffersize=8))
+        self.assertEqual(segments, [bytes(range(10, 15)), bytes(range(15, 20)), bytes(range(20, 23)),
+                                    bytes(range(50, 60)), bytes(range(0, 2))])
+
+    def test_decode_lzw_matches_reference_decoder(self):
+        random = numpy.random.RandomState(0)
+        images = (tifffilebenchmark.make_image(64, "em16"), tifffilebenchmark.make_image(128, "background8"),
+                  random.randint(0, 256, 20000).astype(numpy.uint8), numpy.zeros(50000, numpy.uint8))
+        for image in images:
+            data = image.tobytes()
+            encoded = tifffilebenchmark.encode_lzw(data)
+            self.assertEqual(tifffile.decode_lzw(encoded), data)
+            self.assertEqual(tifffilebenchmark.decode_lzw_loop(encoded), data)
+            # strips that end without EOI code decode as far as possible
+            with warnings.catch_warnings(record=True) as caught:
+                warnings.simplefilter("always")
+                truncated = encoded[:len(encoded) * 2 // 3]
+                self.assertEqual(tifffile.decode_lzw(truncated), tifffilebenchmark.decode_lzw_loop(truncated))
+            self.assertTrue(caught)
+        with self.assertRaises(ValueError):
+            tifffile.decode_lzw(b"\x00\x00\x00\x00")
+        # codes beyond the next table entry are invalid: CLEAR, "A", "B", 258 ("AB"), 262, EOI
+        for codes, decoded in (((256, 65, 66, 258, 259, 257), b"ABABBA"), ((256, 65, 66, 258, 262, 257), None)):
+            bits = "".join("{:09b}".format(code) for code in codes)
+            bits += "0" * (-len(bits) % 8)
+            encoded = int(bits, 2).to_bytes(len(bits) // 8, "big")
+            if decoded is None:
+                with self.assertRaisesRegex(ValueError, "corrupted LZW stream"):
+                    tifffile.decode_lzw(encoded)
+            else:
+                self.assertEqual(tifffile.decode_lzw(encoded), decoded)
+
+    def test_packbits_round_trip(self):
+        random = numpy.random.RandomState(0)
+        images = (tifffilebenchmark.make_image(64, "em16"), tifffilebenchmark.make_image(64, "em8"),
+                  numpy.repeat(random.randint(0, 4, 300), random.randint(1, 300, 300)).astype(numpy.uint8)[:40000].reshape(200, 200))
+        for image in images:
+            encoded = tifffile.encode_packbits(image)
+            self.assertEqual(tifffile.decode_packbits(encoded), image.tobytes())
+            self.assertEqual(tifffilebenchmark.decode_packbits_loop(encoded), image.tobytes())
+            # rows are encoded separately
+            self.assertEqual(encoded, b"".join(tifffile.encode_packbits(row.tobytes()) for row in image))
+        self.assertEqual(tifffile.encode_packbits(b"\x07" * 300), b"\x81\x07\x81\x07\xd5\x07")
+        # truncated data decodes like the byte by byte decoder
+        for encoded in (b"\x05\x01\x02", b"\x01\x02\x03\xfd", b"\x80\x80\x00"):
+            self.assertEqual(tifffile.decode_packbits(encoded), tifffilebenchmark.decode_packbits_loop(encoded))
+
+    def test_save_packbits_compressed_pages(self):
+        data = tifffilebenchmark.make_image(96, "em16").reshape(3, 32, 96)
+        for kwargs in (dict(compress='packbits'), dict(compress='packbits', tile=(16, 32))):
+            file_path = self.write_pages(data, **kwargs)
+            with tifffile.TiffFile(file_path) as tif:
+                self.assertEqual(tif.pages[0].compression, 'packbits')
+                numpy.testing.assert_array_equal(tif.asarray(key=slice(None)), data)
+
+
+if __name__ == '__main__':
+    unittest.main()